@@ -80,8 +80,8 @@ if conv:
     thin = 200
     k0 = 20
     K = k0*exp(-thin*(sqr(x-xPar)+sqr(y-yPar)))
-    convr = ParameterLF(fes1.TestFunction()*K, r2, convOrder)
-    convb = ParameterLF(fes1.TestFunction()*K, b2, convOrder)
+    convrb = ParameterLF(fes1.TestFunction()*K, [r2, b2], convOrder)
+    convr, convb = convrb[0], convrb[1]
 else:
     convr = 0
     convb = 0
@@ -92,8 +92,8 @@ if conv:
     #K = CompactlySupportedKernel(0.05)
 
     #K = exp(-sqrt(sqr(x-xPar)*x+sqr(y-yPar)))
-    convr = ParameterLF(fes1.TestFunction()*K, r2, conv_order)# repeat=0, patchSize=[dx, dy])
-    convb = ParameterLF(fes1.TestFunction()*K, b2, conv_order) #, repeat=0, patchSize=[dx, dy])
+    convrb = ParameterLF(fes1.TestFunction()*K, [r2, b2], conv_order)# repeat=0, patchSize=[dx, dy])
+    convr, convb = convrb[0], convrb[1]
 else:
     convr = 0
     convb = 0
@@ -101,6 +101,9 @@ rho2.Set(CoefficientFunction(0.5))
 
 # set up coefficient function for convolution terms
 conv = ParameterLF(phi*K, rho2, conv_order)
+# build the lookup tables for g.Set(conv) in parallel
+with TaskManager():
+    conv.Prebuild(2*order)
 
 # special values for DG
 n = specialcf.normal(mesh.dim)
@@ -2,128 +2,105 @@ from ngsolve import *
 from ngsolve.comp import Region
 from ngsapps.plotting import *
 import matplotlib.pyplot as plt
-
-def sign(x):
-    if x < 0:
-        return -1
-    else:
-        return int(x > 0)
+import numpy as np
+from numpy.polynomial.legendre import leggauss, legvander
 
 def minmod(a1, a2, a3, h):
     mu = 1
 
-    if abs(a1) <= mu*h**2:
-        return a1
-    elif sign(a1) == sign(a2) == sign(a3):
-        return sign(a1)*min(abs(a1), abs(a2), abs(a3))
-    else:
-        return 0
+    s = np.sign(a1)
+    res = np.where((s == np.sign(a2)) & (s == np.sign(a3)),
+                   s*np.minimum(np.minimum(np.abs(a1), np.abs(a2)), np.abs(a3)), 0)
+    return np.where(np.abs(a1) <= mu*h**2, a1, res)
 
-def limitValues(leftElVals, thisElVals, rightElVals, size):
-    newLVal = thisElVals['avg'] - minmod(thisElVals['avg']-thisElVals['lval'],
-                                         thisElVals['avg']-leftElVals['avg'],
-                                         rightElVals['avg']-thisElVals['avg'], size)
-    newRVal = thisElVals['avg'] + minmod(thisElVals['rval']-thisElVals['avg'],
-                                         thisElVals['avg']-leftElVals['avg'],
-                                         rightElVals['avg']-thisElVals['avg'], size)
+def limitValues(lavg, avg, ravg, lval, rval, size):
+    newLVal = avg - minmod(avg-lval, avg-lavg, ravg-avg, size)
+    newRVal = avg + minmod(rval-avg, avg-lavg, ravg-avg, size)
     return newLVal, newRVal
 
-def stabilityLimiter(g, p1fes):
-    fes = g.__reduce__()[1][0]
-    # red = fes.__reduce__()
-    # red[1][2].Set('order', 1)
-    # p1fes = FESpace(*red[1])
-    # p1fes.__setstate__(red[2])
-    mesh = fes.mesh
-    p1gf = GridFunction(p1fes)
-    p1gf.Set(g)
-    ints = Integrate(g, mesh, element_wise=True)
-    els = []
-    for e in fes.Elements():
-        trafo = e.GetTrafo()
-        elmips = sorted([trafo(0), trafo(1)], key=lambda mip: mip.point[0])
-        size = elmips[1].point[0]-elmips[0].point[0]
-        lval, rval = g(elmips[0]), g(elmips[1])
-        p1lval, p1rval = p1gf(elmips[0]), p1gf(elmips[1])
-        els.append({'dofs': e.dofs,
-                    'midpoint': trafo(0.5).point[0],
-                    'left': elmips[0].point[0],
-                    'orig': {
-                        'lval': lval,
-                        'rval': rval,
-                        'avg': ints[e.nr]/size
-                        },
-                    'p1': {
-                        'lval': p1lval,
-                        'rval': p1rval,
-                        'avg': (p1lval+p1rval)/2
-                        },
-                    'size': size})
-
-    els = sorted(els, key=lambda el: el['midpoint'])
-
-    setgf = GridFunction(fes)
+_geometries = {}
+
+def elementGeometry(fes):
+    """
+    Dofs (one row per element, ordered from left to right), sizes and
+    orientations of the elements of a 1D L2 space, computed once per space.
+    The element basis is the Legendre polynomials in s, the orientation is
+    +1 if s increases from the left to the right end of the element.
+    """
+    if id(fes) not in _geometries:
+        probe = GridFunction(fes)
+        dofs, mids, sizes, lmips = [], [], [], []
+        for e in fes.Elements():
+            trafo = e.GetTrafo()
+            elmips = sorted([trafo(0), trafo(1)], key=lambda mip: mip.point[0])
+            dofs.append(list(e.dofs))
+            mids.append(trafo(0.5).point[0])
+            sizes.append(elmips[1].point[0]-elmips[0].point[0])
+            lmips.append(elmips[0])
+        dofs = np.array(dofs, dtype=int)
+        # the linear basis function is -1 at the left end of positively oriented elements
+        probe.vec[:] = 0
+        if dofs.shape[1] > 1:
+            probe.vec.FV().NumPy()[dofs[:, 1]] = 1
+        orient = np.array([1 if probe(mip) < 0 else -1 for mip in lmips])
+        order = np.argsort(mids)
+        # keep fes alive, such that its id is not reused
+        _geometries[id(fes)] = (fes, dofs[order], np.array(sizes)[order], orient[order])
+    return _geometries[id(fes)][1:]
+
+def setLinear(vals, dofs, orient, lval, rval):
+    vals[dofs] = 0
+    vals[dofs[:, 0]] = (lval+rval)/2
+    vals[dofs[:, 1]] = orient*(rval-lval)/2
+
+def stabilityLimiter(g, p1fes=None):
+    """
+    TVB limiter for a 1D L2 GridFunction g, applied to all elements at once.
+    Limited elements are replaced by the limited L2 projection onto P1, which
+    are the two lowest Legendre coefficients, so p1fes is not needed anymore.
+    """
+    fes = g.space
+    dofs, size, orient = elementGeometry(fes)
+    if dofs.shape[1] < 2:
+        return
+    vals = g.vec.FV().NumPy()
+    coeffs = vals[dofs]
+    k = np.arange(dofs.shape[1])
+    lval = np.sum(coeffs*(-orient[:, None])**k, axis=1)
+    rval = np.sum(coeffs*orient[:, None]**k, axis=1)
+    avg = coeffs[:, 0]
+    p1lval = avg - orient*coeffs[:, 1]
+    p1rval = avg + orient*coeffs[:, 1]
 
     # TODO: think about boundary conditions
-    for i in range(1, len(els)-1):
-        # input()
-        el = els[i]
-
-        # higher order
-        testlval, testrval = limitValues(els[i-1]['orig'], els[i]['orig'], els[i+1]['orig'], els[i]['size'])
-        if testlval != els[i]['orig']['lval'] or testrval != els[i]['orig']['rval']:
-            newlval, newrval = limitValues(els[i-1]['p1'], els[i]['p1'], els[i+1]['p1'], els[i]['size'])
-            setgf.Set(newlval + (x-els[i]['left'])*(newrval-newlval)/els[i]['size'])
-
-            for d in el['dofs']:
-                g.vec[d] = setgf.vec[d]
-
-        # plot.Redraw()
-        # plt.pause(0.05)
-
-from ngsolve.fem import BaseMappedIntegrationPoint
-
-def nonnegativityLimiter(g, p1fes):
-    fes = g.__reduce__()[1][0]
-    mesh = fes.mesh
-    p1gf = GridFunction(p1fes)
-    p1gf.Set(g)
-    setgf = GridFunction(fes)
-    els = []
-    for i, e in enumerate(fes.Elements()):
-        trafo = e.GetTrafo()
-        elmips = sorted([trafo(0), trafo(1)], key=lambda mip: mip.point[0])
-        lval, rval = g(elmips[0]), g(elmips[1])
-
-        ir = IntegrationRule(e.type, fes.globalorder)
-        negative = False
-        for p in ir:
-            if g(trafo(p)) < 0:
-                negative = True
-                break
-        if negative or lval < 0 or rval < 0:
-            # print('nonnegativityLimiter', e.nr)
-            # input()
-            # setgf.Set(p1gf,
-            #         definedon=Region(mesh, VOL, 'top'+str(i+1)))
-            # for d in e.dofs:
-            #     g.vec[d] = setgf.vec[d]
-
-            # plot.Redraw()
-            # plt.pause(0.05)
-            # input()
-            midpoint = trafo(0.5).point[0]
-            size = elmips[1].point[0]-elmips[0].point[0]
-            p1lval, p1rval = p1gf(elmips[0]), p1gf(elmips[1])
-            avg = (p1lval + p1rval) / 2
-            if p1lval < 0:
-                setgf.Set((1+2/size*(x-midpoint))*avg)
-
-            elif p1rval < 0:
-                setgf.Set((1-2/size*(x-midpoint))*avg)
-
-            for d in e.dofs:
-                g.vec[d] = setgf.vec[d]
-
-            # plot.Redraw()
-            # plt.pause(0.05)
+    inner = slice(1, len(avg)-1)
+    lavg, ravg = avg[:-2], avg[2:]
+    avg, size = avg[inner], size[inner]
+    testlval, testrval = limitValues(lavg, avg, ravg, lval[inner], rval[inner], size)
+    limit = (testlval != lval[inner]) | (testrval != rval[inner])
+    newlval, newrval = limitValues(lavg, avg, ravg, p1lval[inner], p1rval[inner], size)
+    setLinear(vals, dofs[inner][limit], orient[inner][limit], newlval[limit], newrval[limit])
+
+def nonnegativityLimiter(g, p1fes=None):
+    """
+    Replace the elements of a 1D L2 GridFunction g which are negative at the
+    end points or the integration points by a nonnegative linear function
+    with the same average, applied to all elements at once.
+    """
+    fes = g.space
+    dofs, size, orient = elementGeometry(fes)
+    if dofs.shape[1] < 2:
+        return
+    vals = g.vec.FV().NumPy()
+    coeffs = vals[dofs]
+    k = np.arange(dofs.shape[1])
+    # the Gauss points are symmetric, the orientation does not matter
+    pnts = np.concatenate(([-1, 1], leggauss(fes.globalorder//2+1)[0]))
+    negative = np.any(coeffs.dot(legvander(pnts, dofs.shape[1]-1).T) < 0, axis=1)
+
+    avg = coeffs[:, 0]
+    p1lval = avg - orient*coeffs[:, 1]
+    p1rval = avg + orient*coeffs[:, 1]
+    newlval = np.where(p1lval < 0, 0, np.where(p1rval < 0, 2*avg, p1lval))
+    newrval = np.where(p1lval < 0, 2*avg, np.where(p1rval < 0, 0, p1rval))
+    setLinear(vals, dofs[negative], orient[negative], newlval[negative], newrval[negative])
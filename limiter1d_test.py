@@ -0,0 +1,17 @@
+from ngsolve import *
+from ngsapps.utils import *
+from ngsapps.limiter import *
+
+# linear functions are not limited, also on elements oriented against x
+mesh = Mesh(Make1DMesh(0, 1, 0.05))
+fes = L2(mesh, order=2)
+p1fes = L2(mesh, order=1)
+g = GridFunction(fes)
+h = GridFunction(fes)
+g.Set(1+2*x)
+h.vec.data = g.vec
+stabilityLimiter(g, p1fes)
+nonnegativityLimiter(g, p1fes)
+err = Integrate(sqr(g-h), mesh)
+print(err)
+assert err < 1e-20
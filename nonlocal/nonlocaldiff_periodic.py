@@ -63,7 +63,7 @@ s = GridFunction(fes)
 q = s.vec.CreateVector()
 s1 = s.vec.CreateVector()
 rhs = s.vec.CreateVector()
-conv = ParameterLF(w*K, s, conv_order, repeat=1, patchSize=[dx, dy])
+conv = ParameterLF(w*K, s, conv_order, patchSize=[dx, dy], minimage=True)
 
 # bilinear-forms
 a1 = BilinearForm (fes, symmetric=False)
@@ -0,0 +1,15 @@
+from ngsolve import *
+from ngsapps.utils import *
+
+mesh = Mesh(GenerateGridMesh((-3,-3), (3,3), 60, 60))
+fes = H1(mesh, order=1)
+gf = GridFunction(fes)
+gf.Set(IfPos(1-sqr(x)-sqr(y), 1, 0))
+
+K = exp(-10*(sqr(x)+sqr(y)))
+fftconv = FFTConvolve(K, gf, [120, 120], periodic=True)
+conv = ParameterLF(fes.TestFunction()*exp(-10*(sqr(x-xPar)+sqr(y-yPar))), gf, 2, repeat=1, patchSize=[6, 6])
+
+Draw(gf, mesh, "gf")
+Draw(fftconv, mesh, "fftconv")
+Draw(conv, mesh, "conv")
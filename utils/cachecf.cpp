@@ -1,32 +1,39 @@
 #include "cachecf.hpp"
 
-namespace ngbla {
-  bool operator== (const Vector<double> &v1, const Vector<double> &v2)
+namespace ngfem
+{
+
+  CacheCoefficientFunction::CacheCoefficientFunction (shared_ptr<CoefficientFunction> ac, shared_ptr<ngcomp::MeshAccess> ama)
+    : CoefficientFunction(ac->Dimension(), ac->IsComplex()), c(ac), ma(ama),
+      entries(ma->GetNE()), SIMD_entries(ma->GetNE())
   {
-    if (v1.Size() != v2.Size()) return false;
-    for (int i = 0; i < v1.Size(); i++)
-      if (v1(i) != v2(i)) return false;
-    return true;
+    for (auto i : Range(ma->GetNE()))
+    {
+      entries[i] = nullptr;
+      SIMD_entries[i] = nullptr;
+    }
+    tracker.Track(*c);
   }
 
-  bool operator< (const Vector<double> &v1, const Vector<double> &v2)
+  template <typename TENTRY>
+  void CacheCoefficientFunction::DeleteEntries (vector<atomic<TENTRY*>> & heads)
   {
-    for (int i = 0; i < v1.Size(); i++)
+    for (auto &head : heads)
     {
-      if (v1(i) < v2(i)) return true;
-      else if (v2(i) < v1(i)) return false;
+      auto entry = head.exchange(nullptr);
+      while (entry)
+      {
+        auto next = entry->next;
+        delete entry;
+        entry = next;
+      }
     }
-    return false;
   }
-}
-
-namespace ngfem
-{
 
-  CacheCoefficientFunction::CacheCoefficientFunction (shared_ptr<CoefficientFunction> ac, shared_ptr<ngcomp::MeshAccess> ama)
-    : CoefficientFunction(ac->Dimension(), ac->IsComplex()), c(ac), ma(ama)
+  CacheCoefficientFunction::~CacheCoefficientFunction ()
   {
-    cache.max_load_factor(0.1);
+    DeleteEntries(entries);
+    DeleteEntries(SIMD_entries);
   }
 
   void CacheCoefficientFunction::PrintReport (ostream & ost) const
@@ -42,111 +49,175 @@ namespace ngfem
     func(*this);
   }
 
+  static bool SamePoint (const IntegrationPoint & a, const IntegrationPoint & b)
+  {
+    return a(0) == b(0) && a(1) == b(1) && a(2) == b(2);
+  }
+
+  static bool SamePoint (const SIMD<IntegrationPoint> & a, const SIMD<IntegrationPoint> & b)
+  {
+    for (int j = 0; j < 3; j++)
+      for (int k = 0; k < SIMD<double>::Size(); k++)
+        if (a(j)[k] != b(j)[k]) return false;
+    return true;
+  }
+
+  // rules of the same size on one element, e.g. for volume and element boundary
+  // integrals, are told apart by their points
+  template <typename TENTRY, typename TIR>
+  static bool Matches (const TENTRY & entry, const TIR & ir)
+  {
+    if (entry.ips.Size() != ir.Size()) return false;
+    for (auto i : Range(ir.Size()))
+      if (!SamePoint(entry.ips[i], ir.IR()[i])) return false;
+    return true;
+  }
+
+  template <typename TENTRY, typename TIR>
+  TENTRY & CacheCoefficientFunction::GetEntry (atomic<TENTRY*> & head, const TIR & ir) const
+  {
+    auto first = head.load(memory_order_acquire);
+    for (auto entry = first; entry; entry = entry->next)
+      if (Matches(*entry, ir)) return *entry;
+
+    auto newEntry = new TENTRY;
+    newEntry->ips.SetSize(ir.Size());
+    for (auto i : Range(ir.Size()))
+      newEntry->ips[i] = ir.IR()[i];
+    newEntry->values.SetSize(ir.Size()*Dimension());
+    newEntry->valid = false;
+    newEntry->next = first;
+    // on failure, next is set to the current head
+    while (!head.compare_exchange_weak(newEntry->next, newEntry, memory_order_acq_rel))
+    {
+      // another thread might have added the entry in the meantime
+      for (auto entry = newEntry->next; entry; entry = entry->next)
+        if (Matches(*entry, ir))
+        {
+          delete newEntry;
+          return *entry;
+        }
+    }
+    return *newEntry;
+  }
+
   double CacheCoefficientFunction::Evaluate (const BaseMappedIntegrationPoint & ip) const
   {
-    auto point = ip.GetPoint();
-    auto it = cache.find(point);
-    if (it == cache.end())
+    // single points are only looked up in the entries of the rules they belong to,
+    // e.g. dummy points of convolutioncf (number -666) aren't cached
+    auto ei = ip.GetTransformation().GetElementId();
+    int nr = ip.IP().Nr();
+    if (ei.VB() != VOL || ei.Nr() < 0 || ei.Nr() >= entries.size() || nr < 0)
+      return c->Evaluate(ip);
+
+    auto lock = tracker.Check([this] { InvalidateEntries(); });
+    for (auto entry = entries[ei.Nr()].load(memory_order_acquire); entry; entry = entry->next)
+    {
+      if (nr >= entry->ips.Size() || !entry->valid.load(memory_order_acquire)) continue;
+      if (SamePoint(entry->ips[nr], ip.IP()))
+        return entry->values[nr*Dimension()];
+    }
+    return c->Evaluate(ip);
+  }
+
+  void CacheCoefficientFunction::Evaluate (const BaseMappedIntegrationRule & ir,
+                                           FlatMatrix<double> values) const
+  {
+    auto ei = ir.GetTransformation().GetElementId();
+    if (ei.VB() != VOL || ei.Nr() < 0 || ei.Nr() >= entries.size())
     {
-      // cache miss
-      // cout << "MISS ";
-      ValueType vt(c->Evaluate(ip), ip.IP(), ip.GetTransformation().GetElementId());
-      auto noconst = const_cast<CacheCoefficientFunction*>(this);
-      std::lock_guard<std::mutex> guard(noconst->cacheWrite);
-      noconst->cache.insert(std::make_pair(Vector<double>(point), vt));
-      return vt.value;
-    } else {
-      // cache hit
-      return it->second.value;
+      c->Evaluate(ir, values);
+      return;
     }
+
+    auto lock = tracker.Check([this] { InvalidateEntries(); });
+    auto &entry = GetEntry(entries[ei.Nr()], ir);
+    FlatMatrix<double> cached(ir.Size(), Dimension(), entry.values.Addr(0));
+    if (!entry.valid.load(memory_order_acquire))
+    {
+      lock_guard<mutex> guard(entry.write);
+      if (!entry.valid.load(memory_order_relaxed))
+      {
+        c->Evaluate(ir, cached);
+        entry.valid.store(true, memory_order_release);
+      }
+    }
+    values = cached;
+  }
+
+  void CacheCoefficientFunction::Evaluate (const SIMD_BaseMappedIntegrationRule & ir, BareSliceMatrix<SIMD<double>> values) const
+  {
+    auto ei = ir.GetTransformation().GetElementId();
+    if (ei.VB() != VOL || ei.Nr() < 0 || ei.Nr() >= SIMD_entries.size())
+    {
+      c->Evaluate(ir, values);
+      return;
+    }
+
+    auto lock = tracker.Check([this] { InvalidateEntries(); });
+    auto &entry = GetEntry(SIMD_entries[ei.Nr()], ir);
+    FlatMatrix<SIMD<double>> cached(Dimension(), ir.Size(), entry.values.Addr(0));
+    if (!entry.valid.load(memory_order_acquire))
+    {
+      lock_guard<mutex> guard(entry.write);
+      if (!entry.valid.load(memory_order_relaxed))
+      {
+        c->Evaluate(ir, cached);
+        entry.valid.store(true, memory_order_release);
+      }
+    }
+    values.AddSize(Dimension(), ir.Size()) = cached;
   }
 
   void CacheCoefficientFunction::Invalidate()
   {
-    std::lock_guard<std::mutex> guard(cacheWrite);
+    InvalidateEntries();
+  }
+
+  void CacheCoefficientFunction::InvalidateEntries() const
+  {
     // should not deallocate reserved space
-    cache.clear();
-  }
-
-  // std::map version
-  // void CacheCoefficientFunction::Refresh()
-  // {
-  //   LocalHeap clh(100000, "cachecf refresh");
-  //   if (task_manager)
-  //   {
-  //     task_manager -> CreateJob
-  //       ( [&] (const TaskInfo & ti)
-  //         {
-  //           LocalHeap lh = clh.Split(ti.thread_nr, ti.nthreads);
-  //           size_t cnt = 0;
-  //           for (auto it = cache.begin(); it != cache.end(); ++it, cnt++)
-  //           {
-  //             if (cnt % ti.nthreads != ti.thread_nr) continue;
-
-  //             HeapReset hr(lh);
-
-  //             if (it->second.ip.Nr() == -666)
-  //             {
-  //               // dummy MappedIntegrationPoint used by convolutioncf
-  //               it->second.value = c->Evaluate(DummyMIPFromPoint(it->first, lh));
-  //             } else {
-  //               auto &trafo = ma->GetTrafo(it->second.ei, lh);
-  //               it->second.value = c->Evaluate(trafo(it->second.ip, lh));
-  //             }
-  //           }
-  //         } );
-  //   }
-  // }
+    for (auto &head : entries)
+      for (auto entry = head.load(); entry; entry = entry->next)
+        entry->valid = false;
+    for (auto &head : SIMD_entries)
+      for (auto entry = head.load(); entry; entry = entry->next)
+        entry->valid = false;
+  }
+
+  void CacheCoefficientFunction::Update()
+  {
+    Invalidate();
+    tracker.Changed();
+  }
 
   void CacheCoefficientFunction::Refresh()
   {
-    // ofstream ofile("cache.txt");
-    LocalHeap clh(100000, "cachecf refresh");
-    if (task_manager)
-    {
-      SharedLoop sl(cache.bucket_count());
-      // ofile << endl << "BUCKET CNT " << cache.bucket_count() << endl;;
-
-      task_manager -> CreateJob
-        ( [&] (const TaskInfo & ti)
-          {
-            LocalHeap lh = clh.Split(ti.thread_nr, ti.nthreads);
-            for (size_t mynr : sl)
-            {
-              auto it = cache.begin(mynr);
-              auto end = cache.end(mynr);
-              // int cnt = 0;
-              while (it != end)
-              {
-                HeapReset hr(lh);
-
-                // auto mip = it->second.eltrans(it->second.ip, lh);
-                if (it->second.ip.Nr() == -666)
-                {
-                  // dummy MappedIntegrationPoint used by convolutioncf
-                  it->second.value = c->Evaluate(DummyMIPFromPoint(it->first, lh));
-                } else {
-                  auto &trafo = ma->GetTrafo(it->second.ei, lh);
-                  it->second.value = c->Evaluate(trafo(it->second.ip, lh));
-                }
-                // cnt++;
-                ++it;
-              }
-              // ofile << cnt << " ";
-            }
-          } );
-      // ofile << endl << endl;
-    }
-    // TODO: else
-    // else
-    // {
-    //   for (auto i : Range(GetNE(vb)))
-    //   {
-    //     HeapReset hr(clh);
-    //     ElementId ei(vb, i);
-    //     Ngs_Element el(GetElement(ei), ei);
-    //     func (move(el), clh);
-    //   }
-    // }
+    tracker.Changed();
+    ParallelForRange
+      (Range(entries.size()), [&] (IntRange r)
+       {
+         LocalHeap lh(100000, "cachecf refresh");
+         for (auto i : r)
+         {
+           ElementId ei(VOL, i);
+           for (auto entry = entries[i].load(); entry; entry = entry->next)
+           {
+             HeapReset hr(lh);
+             auto &trafo = ma->GetTrafo(ei, lh);
+             IntegrationRule ir(entry->ips.Size(), entry->ips.Addr(0));
+             c->Evaluate(trafo(ir, lh), FlatMatrix<double>(ir.Size(), Dimension(), entry->values.Addr(0)));
+             entry->valid = true;
+           }
+           for (auto entry = SIMD_entries[i].load(); entry; entry = entry->next)
+           {
+             HeapReset hr(lh);
+             auto &trafo = ma->GetTrafo(ei, lh);
+             SIMD_IntegrationRule ir(entry->ips.Size(), entry->ips.Addr(0));
+             c->Evaluate(trafo(ir, lh), FlatMatrix<SIMD<double>>(Dimension(), ir.Size(), entry->values.Addr(0)));
+             entry->valid = true;
+           }
+         }
+       });
   }
 }
@@ -2,68 +2,64 @@
 
 #include <comp.hpp>
 #include <python_ngstd.hpp>
-#include <unordered_map>
 
-#include "utils.hpp"
-
-namespace ngbla {
-  bool operator== (const Vector<double> &v1, const Vector<double> &v2);
-  bool operator< (const Vector<double> &v1, const Vector<double> &v2);
-}
-
-// TODO: check sizeof(size_t)
-template <class T>
-inline void hash_combine(std::size_t& seed, const T& v)
-{
-  std::hash<T> hasher;
-  const std::size_t kMul = 0x9ddfea08eb382d69ULL;
-  std::size_t a = (hasher(v) ^ seed) * kMul;
-  a ^= (a >> 47);
-  std::size_t b = (seed ^ a) * kMul;
-  b ^= (b >> 47);
-  seed = b * kMul;
-}
+#include <atomic>
 
-namespace std {
-  template<> struct hash<Vector<double>> {
-    std::size_t operator()(const Vector<double> &v) const {
-      std::size_t ret = 0;
-      for (int i = 0; i < v.Size(); i++)
-        hash_combine(ret, v(i));
-      return ret;
-    }
-  };
-}
+#include "gftracker.hpp"
+#include "utils.hpp"
 
 namespace ngfem
 {
-  class CacheCoefficientFunction : public CoefficientFunction
+  class CacheCoefficientFunction : public CoefficientFunction, public ElementRuleCache
   {
-    struct ValueType
+    // cached values of c for one IntegrationRule on one volume element,
+    // identified by the element and the reference points of the rule
+    template <typename TIP, typename SCAL>
+    struct Entry
     {
-      double value;
-      IntegrationPoint ip;
-      ElementId ei;
-
-      ValueType(double aval, IntegrationPoint aip, ElementId aei) : value(aval), ip(aip), ei(aei) {}
+      Array<TIP> ips;
+      // points x components for scalar rules, components x points for SIMD rules
+      // written under the mutex, read without locking once valid is set
+      Array<SCAL> values;
+      atomic<bool> valid;
+      mutex write;
+      // entries are only prepended, so readers can traverse the list without locking
+      Entry * next;
     };
+    typedef Entry<IntegrationPoint, double> ScalarEntry;
+    typedef Entry<SIMD<IntegrationPoint>, SIMD<double>> SIMDEntry;
 
     shared_ptr<CoefficientFunction> c;
     shared_ptr<ngcomp::MeshAccess> ma;
-    std::unordered_map<Vector<double>, ValueType> cache;
-    // std::map<Vector<double>, ValueType> cache;
+    // lists of entries for each volume element
+    mutable vector<atomic<ScalarEntry*>> entries;
+    mutable vector<atomic<SIMDEntry*>> SIMD_entries;
+    // the entries are invalidated when the GridFunctions in c change
+    mutable GridFunctionTracker tracker;
 
-    std::mutex cacheWrite;
+    // the entry of ir, added if it is missing
+    template <typename TENTRY, typename TIR>
+    TENTRY & GetEntry (atomic<TENTRY*> & head, const TIR & ir) const;
+    template <typename TENTRY>
+    void DeleteEntries (vector<atomic<TENTRY*>> & heads);
+    void InvalidateEntries () const;
 
   public:
     CacheCoefficientFunction (shared_ptr<CoefficientFunction> ac, shared_ptr<ngcomp::MeshAccess> ama);
-    virtual ~CacheCoefficientFunction () {}
+    virtual ~CacheCoefficientFunction ();
     ///
     virtual double Evaluate (const BaseMappedIntegrationPoint & ip) const;
+    virtual void Evaluate (const BaseMappedIntegrationRule & ir,
+                           FlatMatrix<double> values) const;
+    virtual void Evaluate (const SIMD_BaseMappedIntegrationRule & ir, BareSliceMatrix<SIMD<double>> values) const;
     virtual void TraverseTree (const function<void(CoefficientFunction&)> & func);
     virtual void PrintReport (ostream & ost) const;
+    // the cached values are recomputed on their next use, the memory is kept
     virtual void Invalidate();
+    // recompute all cached values in parallel
     virtual void Refresh();
+    // invalidate the cached values after the GridFunctions in c have changed, otherwise
+    // this happens on their next use
+    void Update();
   };
 }
-
@@ -8,7 +8,7 @@ namespace ngfem
                                                           shared_ptr<CoefficientFunction> ac2,
                                                           shared_ptr<ngcomp::MeshAccess> ama)
   : CoefficientFunction(ac2->Dimension(), ac2->IsComplex()),
-    c1(ac1), c2(ac2), ma(ama)
+    c1(ac1), c2(ac2), ma(ama), pointwise(false)
   {
     if (ma)
     {
@@ -19,6 +19,12 @@ namespace ngfem
       IntegrationPoint dummy;
       ma->FindElementOfPoint(Vector<>({0, 0, 0}), dummy, true);
     }
+    c2->TraverseTree
+      ([&] (CoefficientFunction & nodecf)
+       {
+         if (dynamic_cast<ElementRuleCache*> (&nodecf))
+           pointwise = true;
+       });
   }
 
   void ComposeCoefficientFunction::PrintReport (ostream & ost) const
@@ -43,14 +49,14 @@ namespace ngfem
     c1->Evaluate(ip, res1);
     if (ma)
     {
-      LocalHeap lh(100000);
+      LocalHeapMem<10000> lh("composecf lh");
       int el = ma->FindElementOfPoint(res1, outip, false);
       if (el == -1) return 0;
       ElementTransformation & eltrans = ma->GetTrafo(el, lh);
       BaseMappedIntegrationPoint & mip = eltrans(outip, lh);
       return c2->Evaluate(mip);
     } else {
-      LocalHeap lh(1000);
+      LocalHeapMem<1000> lh("composecf lh");
       return c2->Evaluate(DummyMIPFromPoint(res1, lh));
     }
   }
@@ -68,7 +74,7 @@ namespace ngfem
     c1->Evaluate(ip, res1);
     if (ma)
     {
-      LocalHeap lh(100000);
+      LocalHeapMem<10000> lh("composecf lh");
       int el = ma->FindElementOfPoint(res1, outip, false);
       if (el == -1)
       {
@@ -79,9 +85,341 @@ namespace ngfem
       BaseMappedIntegrationPoint & mip = eltrans(outip, lh);
       c2->Evaluate(mip, result);
     } else {
-      // TODO: heap allocation too slow
-      LocalHeap lh(1000);
+      LocalHeapMem<1000> lh("composecf lh");
       c2->Evaluate(DummyMIPFromPoint(res1, lh), result);
     }
   }
+
+  static bool InReferenceElement (ELEMENT_TYPE et, const IntegrationPoint & ip, double eps)
+  {
+    switch (et)
+    {
+    case ET_SEGM:
+      return ip(0) >= -eps && ip(0) <= 1+eps;
+    case ET_TRIG:
+      return ip(0) >= -eps && ip(1) >= -eps && ip(0)+ip(1) <= 1+eps;
+    case ET_QUAD:
+      return ip(0) >= -eps && ip(0) <= 1+eps && ip(1) >= -eps && ip(1) <= 1+eps;
+    case ET_TET:
+      return ip(0) >= -eps && ip(1) >= -eps && ip(2) >= -eps && ip(0)+ip(1)+ip(2) <= 1+eps;
+    case ET_HEX:
+      return ip(0) >= -eps && ip(0) <= 1+eps && ip(1) >= -eps && ip(1) <= 1+eps
+        && ip(2) >= -eps && ip(2) <= 1+eps;
+    default:
+      // other element types are left to FindElementOfPoint
+      return false;
+    }
+  }
+
+  bool LocateInElement (const ngcomp::MeshAccess & ma, int el, FlatVector<> point, IntegrationPoint & ip, LocalHeap & lh)
+  {
+    HeapReset hr(lh);
+    int dim = ma.GetDimension();
+    auto & trafo = ma.GetTrafo(ElementId(VOL, el), lh);
+    double mappedMem[3], jacMem[9], invMem[9];
+    FlatVector<> mapped(dim, mappedMem);
+    FlatMatrix<> jac(dim, dim, jacMem);
+    FlatMatrix<> inv(dim, dim, invMem);
+
+    // start inside all reference elements, affine elements need a single step
+    ip = IntegrationPoint(0.25, dim > 1 ? 0.25 : 0, dim > 2 ? 0.25 : 0, 0);
+    double tol = 1e-12 * (1 + L2Norm(point));
+    bool converged = false;
+    for (int it = 0; it < 10 && !converged; it++)
+    {
+      trafo.CalcPointJacobian(ip, mapped, jac);
+      mapped -= point;
+      converged = L2Norm(mapped) < tol;
+      CalcInverse(jac, inv);
+      for (int d = 0; d < dim; d++)
+        for (int k = 0; k < dim; k++)
+          ip(d) -= inv(d, k) * mapped(k);
+    }
+    return converged && InReferenceElement(trafo.GetElementType(), ip, 1e-10);
+  }
+
+  void ComposeCoefficientFunction::EvaluatePoints (FlatMatrix<> points, FlatMatrix<> values, LocalHeap & lh) const
+  {
+    size_t n = points.Height();
+    if (!ma)
+    {
+      for (auto i : Range(n))
+      {
+        HeapReset hr(lh);
+        c2->Evaluate(DummyMIPFromPoint(points.Row(i), lh), values.Row(i));
+      }
+      return;
+    }
+
+    // the search in the previous element needs all coordinates of the point
+    bool useHint = c1->Dimension() == ma->GetDimension();
+    FlatArray<int> els(n, lh);
+    FlatArray<IntegrationPoint> ips(n, lh);
+    int hint = -1;
+    for (auto i : Range(n))
+    {
+      int el = -1;
+      if (useHint && hint != -1 && LocateInElement(*ma, hint, points.Row(i), ips[i], lh))
+        el = hint;
+      else
+        el = ma->FindElementOfPoint(points.Row(i), ips[i], false);
+      els[i] = el;
+      if (el != -1) hint = el;
+    }
+
+    FlatArray<bool> done(n, lh);
+    done = false;
+    FlatArray<int> group(n, lh);
+    FlatArray<IntegrationPoint> groupIPs(n, lh);
+    for (auto i : Range(n))
+    {
+      if (done[i]) continue;
+      if (els[i] == -1)
+      {
+        values.Row(i) = 0;
+        continue;
+      }
+      size_t cnt = 0;
+      for (auto j : Range(i, n))
+        if (!done[j] && els[j] == els[i])
+        {
+          done[j] = true;
+          group[cnt] = j;
+          groupIPs[cnt] = ips[j];
+          groupIPs[cnt].SetNr(cnt);
+          cnt++;
+        }
+
+      HeapReset hr(lh);
+      auto & trafo = ma->GetTrafo(ElementId(VOL, els[i]), lh);
+      if (pointwise)
+      {
+        for (auto k : Range(cnt))
+        {
+          HeapReset hr(lh);
+          c2->Evaluate(trafo(groupIPs[k], lh), values.Row(group[k]));
+        }
+        continue;
+      }
+      IntegrationRule groupIR(cnt, &groupIPs[0]);
+      auto & mir = trafo(groupIR, lh);
+      FlatMatrix<> groupVals(cnt, Dimension(), lh);
+      c2->Evaluate(mir, groupVals);
+      for (auto k : Range(cnt))
+        values.Row(group[k]) = groupVals.Row(k);
+    }
+  }
+
+  void ComposeCoefficientFunction::Evaluate (const BaseMappedIntegrationRule & ir,
+                                             FlatMatrix<double> values) const
+  {
+    LocalHeapMem<100000> lh("composecf lh");
+    FlatMatrix<> points(ir.Size(), c1->Dimension(), lh);
+    c1->Evaluate(ir, points);
+    EvaluatePoints(points, values, lh);
+  }
+
+  void ComposeCoefficientFunction::Evaluate (const SIMD_BaseMappedIntegrationRule & ir, BareSliceMatrix<SIMD<double>> values) const
+  {
+    LocalHeapMem<100000> lh("composecf lh");
+    constexpr auto lanes = SIMD<double>::Size();
+    int dim1 = c1->Dimension();
+    FlatMatrix<SIMD<double>> simdPoints(dim1, ir.Size(), lh);
+    c1->Evaluate(ir, simdPoints);
+    // one row per lane of each point
+    FlatMatrix<> points(ir.Size()*lanes, dim1, lh);
+    for (auto i : Range(ir.Size()))
+      for (auto d : Range(dim1))
+        for (auto m : Range(lanes))
+          points(i*lanes+m, d) = simdPoints(d, i)[m];
+    FlatMatrix<> vals(ir.Size()*lanes, Dimension(), lh);
+    EvaluatePoints(points, vals, lh);
+    for (auto i : Range(ir.Size()))
+      for (auto d : Range(Dimension()))
+        values(d, i) = SIMD<double>([&] (int m) { return vals(i*lanes+m, d); });
+  }
+
+  ComposeOperator::ComposeOperator (shared_ptr<CoefficientFunction> ainner, shared_ptr<ngcomp::FESpace> afes, int aorder)
+    : inner(ainner), fes(afes), ma(afes->GetMeshAccess()), order(aorder), firstRow(ma->GetNE()+1)
+  {
+    if (fes->GetDimension() != 1)
+      throw Exception("ComposeOperator needs a scalar FESpace");
+    if (inner->Dimension() != ma->GetDimension())
+      throw Exception("ComposeOperator: the inner function has to map to points of the mesh");
+    // search tree for FindElementOfPoint, see ComposeCoefficientFunction
+    IntegrationPoint dummy;
+    ma->FindElementOfPoint(Vector<>({0, 0, 0}), dummy, true);
+
+    firstRow[0] = 0;
+    for (auto i : Range(ma->GetNE()))
+    {
+      IntegrationRule ir(ma->GetElType(ElementId(VOL, i)), order);
+      firstRow[i+1] = firstRow[i] + ir.Size();
+    }
+
+    // dofs and shape functions of the located point of each row
+    vector<vector<pair<int, double>>> rows(firstRow.Last());
+    ParallelForRange
+      (Range(ma->GetNE()), [&] (IntRange r)
+       {
+         LocalHeap lh(1000000, "compose operator lh");
+         Array<int> dnums;
+         for (auto i : r)
+         {
+           HeapReset hr(lh);
+           ElementId ei(VOL, i);
+           auto & trafo = ma->GetTrafo(ei, lh);
+           // the same points as in Matches
+           const IntegrationRule & ir = SelectIntegrationRule(trafo.GetElementType(), order);
+           auto & mir = trafo(ir, lh);
+           FlatMatrix<> points(ir.Size(), inner->Dimension(), lh);
+           inner->Evaluate(mir, points);
+           int hint = -1;
+           for (auto j : Range(ir.Size()))
+           {
+             HeapReset hr(lh);
+             IntegrationPoint ip;
+             int el = -1;
+             if (hint != -1 && LocateInElement(*ma, hint, points.Row(j), ip, lh))
+               el = hint;
+             else
+               el = ma->FindElementOfPoint(points.Row(j), ip, false);
+             if (el == -1) continue;
+             hint = el;
+
+             ElementId sourceEi(VOL, el);
+             auto & fel = dynamic_cast<const BaseScalarFiniteElement&>(fes->GetFE(sourceEi, lh));
+             FlatVector<> shape(fel.GetNDof(), lh);
+             fel.CalcShape(ip, shape);
+             fes->GetDofNrs(sourceEi, dnums);
+             auto & row = rows[firstRow[i]+j];
+             for (auto k : Range(dnums))
+               if (dnums[k] != -1 && shape(k) != 0)
+                 row.push_back(make_pair(dnums[k], shape(k)));
+           }
+         }
+       });
+
+    firstInRow.SetSize(rows.size()+1);
+    firstInRow[0] = 0;
+    for (auto r : Range(rows.size()))
+      firstInRow[r+1] = firstInRow[r] + rows[r].size();
+    cols.SetSize(firstInRow.Last());
+    vals.SetSize(firstInRow.Last());
+    for (auto r : Range(rows.size()))
+      for (auto k : Range(rows[r].size()))
+      {
+        cols[firstInRow[r]+k] = rows[r][k].first;
+        vals[firstInRow[r]+k] = rows[r][k].second;
+      }
+  }
+
+  bool ComposeOperator::Matches (size_t elnr, const IntegrationRule & ir) const
+  {
+    if (elnr >= ma->GetNE() || Rows(elnr).Size() != ir.Size()) return false;
+    const auto & ref = SelectIntegrationRule(ma->GetElType(ElementId(VOL, elnr)), order);
+    for (auto j : Range(ir.Size()))
+      for (int d = 0; d < 3; d++)
+        if (ir[j](d) != ref[j](d)) return false;
+    return true;
+  }
+
+  bool ComposeOperator::Matches (size_t elnr, const SIMD_IntegrationRule & ir) const
+  {
+    constexpr size_t lanes = SIMD<double>::Size();
+    if (elnr >= ma->GetNE() || (Rows(elnr).Size()+lanes-1)/lanes != ir.Size()) return false;
+    const auto & ref = SelectIntegrationRule(ma->GetElType(ElementId(VOL, elnr)), order);
+    for (auto j : Range(ref.Size()))
+      for (int d = 0; d < 3; d++)
+        if (ir[j/lanes](d)[j%lanes] != ref[j](d)) return false;
+    return true;
+  }
+
+  void ComposeOperator::Mult (const BaseVector & x, BaseVector & y) const
+  {
+    y = 0.0;
+    MultAdd(1, x, y);
+  }
+
+  void ComposeOperator::MultAdd (double s, const BaseVector & x, BaseVector & y) const
+  {
+    auto fx = x.FVDouble();
+    auto fy = y.FVDouble();
+    ParallelForRange
+      (Range(VHeight()), [&] (IntRange r)
+       {
+         for (auto row : r)
+           fy(row) += s * RowTimes(row, fx);
+       });
+  }
+
+  void ComposeOperator::MultTransAdd (double s, const BaseVector & x, BaseVector & y) const
+  {
+    // rows share dofs, so the transpose is applied serially
+    auto fx = x.FVDouble();
+    auto fy = y.FVDouble();
+    for (auto row : Range(VHeight()))
+      for (auto k : Range(firstInRow[row], firstInRow[row+1]))
+        fy(cols[k]) += s * vals[k] * fx(row);
+  }
+
+  ComposedGridFunctionCF::ComposedGridFunctionCF (shared_ptr<ComposeOperator> aop, shared_ptr<ngcomp::GridFunction> agf)
+    : CoefficientFunction(1, false), op(aop), gf(agf)
+  {
+    if (gf->GetFESpace() != op->GetFESpace())
+      throw Exception("ComposeOperator: gf has to belong to the FESpace of the operator");
+    fallback = make_shared<ComposeCoefficientFunction>(op->GetInner(),
+                                                       make_shared<ngcomp::GridFunctionCoefficientFunction>(gf),
+                                                       op->GetFESpace()->GetMeshAccess());
+  }
+
+  void ComposedGridFunctionCF::PrintReport (ostream & ost) const
+  {
+    fallback->PrintReport(ost);
+  }
+
+  void ComposedGridFunctionCF::TraverseTree (const function<void(CoefficientFunction&)> & func)
+  {
+    fallback->TraverseTree (func);
+    func(*this);
+  }
+
+  double ComposedGridFunctionCF::Evaluate (const BaseMappedIntegrationPoint & ip) const
+  {
+    return fallback->Evaluate(ip);
+  }
+
+  void ComposedGridFunctionCF::Evaluate (const BaseMappedIntegrationRule & ir,
+                                         FlatMatrix<double> values) const
+  {
+    auto ei = ir.GetTransformation().GetElementId();
+    if (ei.VB() != VOL || !op->Matches(ei.Nr(), ir.IR()))
+    {
+      fallback->Evaluate(ir, values);
+      return;
+    }
+    auto gfvec = gf->GetVector().FVDouble();
+    auto rows = op->Rows(ei.Nr());
+    for (auto j : Range(ir.Size()))
+      values(j, 0) = op->RowTimes(rows.First()+j, gfvec);
+  }
+
+  void ComposedGridFunctionCF::Evaluate (const SIMD_BaseMappedIntegrationRule & ir, BareSliceMatrix<SIMD<double>> values) const
+  {
+    constexpr size_t lanes = SIMD<double>::Size();
+    auto ei = ir.GetTransformation().GetElementId();
+    if (ei.VB() != VOL || !op->Matches(ei.Nr(), ir.IR()))
+    {
+      fallback->Evaluate(ir, values);
+      return;
+    }
+    auto gfvec = gf->GetVector().FVDouble();
+    auto rows = op->Rows(ei.Nr());
+    for (auto i : Range(ir.Size()))
+      values(0, i) = SIMD<double>([&] (int m) -> double
+                                  {
+                                    size_t j = i*lanes+m;
+                                    return j < rows.Size() ? op->RowTimes(rows.First()+j, gfvec) : 0;
+                                  });
+  }
 }
@@ -1,13 +1,27 @@
+#pragma once
+
 #include <comp.hpp>
 #include <python_ngstd.hpp>
 
+#include "utils.hpp"
+
 namespace ngfem
 {
+  // local coordinates of point in element el of ma by Newton's method, false if it lies outside
+  bool LocateInElement (const ngcomp::MeshAccess & ma, int el, FlatVector<> point, IntegrationPoint & ip, LocalHeap & lh);
+
   class ComposeCoefficientFunction : public CoefficientFunction
   {
     shared_ptr<CoefficientFunction> c1;
     shared_ptr<CoefficientFunction> c2;
     shared_ptr<ngcomp::MeshAccess> ma;
+    // c2 is evaluated point by point if it contains an ElementRuleCache (ConvolveCF, ParameterLF,
+    // FFTConvolve, Cache, ComposeOperator), which the rules of located points would break
+    bool pointwise;
+
+    // values of c2 at the given points (one per row), points are located in the element of the
+    // previous point first and grouped by element, such that c2 is evaluated on one rule per element
+    void EvaluatePoints (FlatMatrix<> points, FlatMatrix<> values, LocalHeap & lh) const;
 
   public:
     ComposeCoefficientFunction (shared_ptr<CoefficientFunction> ac1,
@@ -17,6 +31,72 @@ namespace ngfem
     virtual double Evaluate (const BaseMappedIntegrationPoint & ip) const;
     virtual double EvaluateConst () const;
     virtual void Evaluate (const BaseMappedIntegrationPoint & ip, FlatVector<> result) const;
+    virtual void Evaluate (const BaseMappedIntegrationRule & ir,
+                           FlatMatrix<double> values) const;
+    virtual void Evaluate (const SIMD_BaseMappedIntegrationRule & ir, BareSliceMatrix<SIMD<double>> values) const;
+    virtual void TraverseTree (const function<void(CoefficientFunction&)> & func);
+    virtual void PrintReport (ostream & ost) const;
+  };
+
+  // interpolation of a scalar FESpace in the images under inner of the points of the IntegrationRules
+  // of the given order on all volume elements of its mesh, as a sparse matrix from the dofs to the
+  // values in these points (one row per point, ordered by element)
+  // the points are located once, for mappings which don't change in time
+  class ComposeOperator : public ngla::BaseMatrix
+  {
+    shared_ptr<CoefficientFunction> inner;
+    shared_ptr<ngcomp::FESpace> fes;
+    shared_ptr<ngcomp::MeshAccess> ma;
+    int order;
+    // rows of the points of each element
+    Array<size_t> firstRow;
+    // compressed rows, points outside of the mesh have empty rows
+    Array<size_t> firstInRow;
+    Array<int> cols;
+    Array<double> vals;
+
+  public:
+    ComposeOperator (shared_ptr<CoefficientFunction> ainner, shared_ptr<ngcomp::FESpace> afes, int aorder);
+    shared_ptr<CoefficientFunction> GetInner () const { return inner; }
+    shared_ptr<ngcomp::FESpace> GetFESpace () const { return fes; }
+    IntRange Rows (size_t elnr) const { return IntRange(firstRow[elnr], firstRow[elnr+1]); }
+    // true if ir consists of the points of the rows of element elnr
+    bool Matches (size_t elnr, const IntegrationRule & ir) const;
+    // the SIMD rule of the same order holds these points, padded to full SIMD lanes
+    bool Matches (size_t elnr, const SIMD_IntegrationRule & ir) const;
+    double RowTimes (size_t row, FlatVector<> x) const
+    {
+      double sum = 0;
+      for (auto k : Range(firstInRow[row], firstInRow[row+1]))
+        sum += vals[k] * x(cols[k]);
+      return sum;
+    }
+    virtual bool IsComplex () const { return false; }
+    virtual int VHeight () const { return firstRow.Last(); }
+    virtual int VWidth () const { return fes->GetNDof(); }
+    virtual AutoVector CreateVector () const { return CreateRowVector(); }
+    virtual AutoVector CreateRowVector () const { return make_shared<ngla::VVector<double>>(VWidth()); }
+    virtual AutoVector CreateColVector () const { return make_shared<ngla::VVector<double>>(VHeight()); }
+    virtual void Mult (const BaseVector & x, BaseVector & y) const;
+    virtual void MultAdd (double s, const BaseVector & x, BaseVector & y) const;
+    virtual void MultTransAdd (double s, const BaseVector & x, BaseVector & y) const;
+  };
+
+  // gf after the inner function of op, evaluated with op on the rules it was built for,
+  // other rules and single points are evaluated like Compose
+  class ComposedGridFunctionCF : public CoefficientFunction, public ElementRuleCache
+  {
+    shared_ptr<ComposeOperator> op;
+    shared_ptr<ngcomp::GridFunction> gf;
+    shared_ptr<CoefficientFunction> fallback;
+
+  public:
+    ComposedGridFunctionCF (shared_ptr<ComposeOperator> aop, shared_ptr<ngcomp::GridFunction> agf);
+    ///
+    virtual double Evaluate (const BaseMappedIntegrationPoint & ip) const;
+    virtual void Evaluate (const BaseMappedIntegrationRule & ir,
+                           FlatMatrix<double> values) const;
+    virtual void Evaluate (const SIMD_BaseMappedIntegrationRule & ir, BareSliceMatrix<SIMD<double>> values) const;
     virtual void TraverseTree (const function<void(CoefficientFunction&)> & func);
     virtual void PrintReport (ostream & ost) const;
   };
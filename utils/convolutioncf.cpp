@@ -2,21 +2,286 @@
 
 #include "utils.hpp"
 
+#include <iomanip>
+
 namespace ngfem
 {
   ConvolutionCoefficientFunction::ConvolutionCoefficientFunction (shared_ptr<CoefficientFunction> acf,
                                                                   shared_ptr<CoefficientFunction> akernel,
-                                                                  shared_ptr<ngcomp::MeshAccess> ama, int aorder)
-  : CoefficientFunction(acf->Dimension(), acf->IsComplex()),
-    cf(acf), kernel(akernel), ma(ama), order(aorder),
-    kernelLUT(ma->GetNE()), totalConvIRSize(0), SIMD_kernelLUT(ma->GetNE()), SIMD_totalConvIRSize(0)
+                                                                  shared_ptr<ngcomp::MeshAccess> ama, int aorder,
+                                                                  double acutoff, string cachedir, bool asinglePrecision,
+                                                                  bool agradient)
+  : CoefficientFunction(agradient ? ama->GetDimension()+1 : acf->Dimension(), acf->IsComplex()),
+    cf(acf), kernel(akernel), ma(ama), order(aorder), cutoff(acutoff), singlePrecision(asinglePrecision),
+    kernelLUT(ma->GetNE()), SIMD_kernelLUT(ma->GetNE()), budget(2*ma->GetNE())
   {
+    tracker.Track(*cf);
     // TODO: switch to FESpace as argument, use FESpace->Elements
-    for (auto &&el : ma->Elements())
+    if (agradient)
+    {
+      if (cf->Dimension() != 1)
+        throw Exception("ConvolveCF: the gradient is only available for scalar cf");
+      stencil = GradientStencil(ma->GetDimension(), 1e-5*BoxesDiameter(ElementBoundingBoxes(*ma)));
+    }
+    if (cutoff > 0)
+      elIndex = make_unique<ElementBoxIndex>(ElementBoundingBoxes(*ma), cutoff);
+
+    // the cutoff by element distance of the lookup tables doesn't factor into the two passes, so with a cutoff
+    // the separable kernel is treated like any other kernel
+    separableKernel = dynamic_pointer_cast<SeparableKernelCoefficientFunction>(kernel);
+    if (cutoff > 0)
+      separableKernel = nullptr;
+    if (separableKernel && ma->GetDimension() == 2 && cf->Dimension() == 1)
+      FindTensorGrid();
+
+    if (!cachedir.empty())
+    {
+      LUTHash hash;
+      hash.Add(string("ConvolveCF"));
+      hash.AddMesh(*ma);
+      hash.Add(order);
+      hash.Add(cutoff);
+      hash.Add(singlePrecision);
+      hash.Add(stencil.Size());
+      hash.Add(SIMD<double>::Size());
+      // the kernel tables don't depend on cf
+      // the constants of the kernel have to be distinguished to full precision
+      stringstream report;
+      report << setprecision(17);
+      kernel->PrintReport(report);
+      hash.Add(report.str());
+      lutKey = hash.Value();
+      cacheFile = cachedir + "/convolvecf_" + hash.Hex() + ".lut";
+      if (FileExists(cacheFile))
+        LoadLUT();
+    }
+  }
+
+  void ConvolutionCoefficientFunction::SaveLUT () const
+  {
+    if (cacheFile.empty())
+      throw Exception("ConvolutionCoefficientFunction::SaveLUT: no cachedir given");
+    LUTWriter out(cacheFile);
+    out.Write(LUT_FILE_MAGIC);
+    out.Write(lutKey);
+    out.Write(kernelLUT.size());
+    for (auto &lutElEntry : kernelLUT)
+    {
+      shared_lock<shared_timed_mutex> readLock(lutElEntry.second);
+      out.Write(lutElEntry.first.size());
+      for (const auto &entry : lutElEntry.first)
+      {
+        out.Write(entry.first);
+        entry.second.Save(out);
+      }
+    }
+    for (auto &lutElEntry : SIMD_kernelLUT)
+    {
+      shared_lock<shared_timed_mutex> readLock(lutElEntry.second);
+      out.Write(lutElEntry.first.size());
+      for (const auto &entry : lutElEntry.first)
+      {
+        out.Write(entry.first);
+        entry.second.Save(out);
+      }
+    }
+    out.Close();
+  }
+
+  void ConvolutionCoefficientFunction::LoadLUT ()
+  {
+    lutFile = make_shared<MappedFile>(cacheFile);
+    LUTReader in(lutFile);
+    if (in.Read() != LUT_FILE_MAGIC || in.Read() != lutKey || in.Read() != kernelLUT.size())
+    {
+      cout << "ConvolveCF: ignoring incompatible lookup table file " << cacheFile << endl;
+      lutFile = nullptr;
+      return;
+    }
+    for (auto &lutElEntry : kernelLUT)
+    {
+      auto numEntries = in.Read();
+      for (auto k : Range(numEntries))
+        lutElEntry.first[in.Read()].Load(in);
+    }
+    for (auto &lutElEntry : SIMD_kernelLUT)
+    {
+      auto numEntries = in.Read();
+      for (auto k : Range(numEntries))
+        lutElEntry.first[in.Read()].Load(in);
+    }
+  }
+
+  // sorted distinct values of coords, values closer than tol are identified
+  static void DistinctCoordinates (FlatArray<double> coords, double tol, Array<double> & distinct)
+  {
+    Array<double> sorted(coords.Size());
+    for (auto i : Range(coords)) sorted[i] = coords[i];
+    QuickSort(sorted);
+    distinct.SetSize(0);
+    for (auto c : sorted)
+      if (distinct.Size() == 0 || c - distinct.Last() > tol)
+        distinct.Append(c);
+  }
+
+  // index of the last distinct value not larger than c+tol
+  static int CoordinateIndex (FlatArray<double> distinct, double c, double tol)
+  {
+    int lo = 0, hi = distinct.Size();
+    while (hi - lo > 1)
     {
-      totalConvIRSize += IntegrationRule(el.GetType(), order).Size();
-      SIMD_totalConvIRSize += SIMD_IntegrationRule(el.GetType(), order).Size()*SIMD<IntegrationPoint>::Size();
+      int mid = (lo+hi)/2;
+      if (distinct[mid] <= c + tol) lo = mid;
+      else hi = mid;
     }
+    return lo;
+  }
+
+  void ConvolutionCoefficientFunction::FindTensorGrid ()
+  {
+    LocalHeap lh(100000, "convolutioncf grid lh");
+    Array<double> xs, ys;
+    gridOffsets.SetSize(ma->GetNE()+1);
+    gridOffsets[0] = 0;
+    for (auto i : Range(ma->GetNE()))
+    {
+      HeapReset hr(lh);
+      ElementId ei(VOL, i);
+      auto & trafo = ma->GetTrafo(ei, lh);
+      IntegrationRule convIR(trafo.GetElementType(), order);
+      auto & convMIR = trafo(convIR, lh);
+      for (auto k : Range(convIR.Size()))
+      {
+        xs.Append(convMIR[k].GetPoint()(0));
+        ys.Append(convMIR[k].GetPoint()(1));
+      }
+      gridOffsets[i+1] = xs.Size();
+    }
+
+    double extent = 1;
+    for (auto i : Range(xs))
+      extent = max(extent, max(fabs(xs[i]), fabs(ys[i])));
+    double tol = 1e-10*extent;
+    DistinctCoordinates(xs, tol, gridX);
+    DistinctCoordinates(ys, tol, gridY);
+
+    // every grid point has to be exactly one integration point, e.g. for quadrilateral grid meshes
+    bool isGrid = gridX.Size()*gridY.Size() == xs.Size();
+    Array<bool> used(xs.Size());
+    used = false;
+    gridPos.SetSize(xs.Size());
+    for (size_t i = 0; isGrid && i < xs.Size(); i++)
+    {
+      int pos = CoordinateIndex(gridX, xs[i], tol)*gridY.Size() + CoordinateIndex(gridY, ys[i], tol);
+      isGrid = !used[pos];
+      used[pos] = true;
+      gridPos[i] = pos;
+    }
+    if (!isGrid)
+    {
+      // fall back to the kernel lookup tables
+      gridX.SetSize(0);
+      gridY.SetSize(0);
+      gridPos.SetSize(0);
+    }
+  }
+
+  // the entry of passes for key, computed by compute if it is missing
+  static const Vector<> & CachedPass (map<double, Vector<>> & passes, shared_timed_mutex & mutex, double key,
+                                      size_t size, const function<void(FlatVector<>)> & compute)
+  {
+    {
+      shared_lock<shared_timed_mutex> readLock(mutex);
+      auto it = passes.find(key);
+      if (it != passes.end()) return it->second;
+    }
+    Vector<> vals(size);
+    compute(vals);
+    unique_lock<shared_timed_mutex> writeLock(mutex);
+    auto &entry = passes[key];
+    // another thread might have computed the entry in the meantime
+    if (entry.Size() == 0)
+    {
+      entry.SetSize(size);
+      entry = vals;
+    }
+    return entry;
+  }
+
+  double ConvolutionCoefficientFunction::SeparableConvolution (double x, double y) const
+  {
+    const auto &kxVals = CachedPass
+      (passX, passXMutex, x, gridX.Size(), [&] (FlatVector<> vals)
+       {
+         LocalHeap lh(10000, "convolutioncf separable lh");
+         for (auto ix : Range(gridX))
+           vals(ix) = separableKernel->EvaluateX(x-gridX[ix], 2, lh);
+       });
+    const auto &firstPass = CachedPass
+      (passY, passYMutex, y, gridX.Size(), [&] (FlatVector<> vals)
+       {
+         LocalHeap lh(10000, "convolutioncf separable lh");
+         Vector<> kyVals(gridY.Size());
+         for (auto iy : Range(gridY))
+           kyVals(iy) = separableKernel->EvaluateY(y-gridY[iy], 2, lh);
+         vals = gridValues * kyVals;
+       });
+    return InnerProduct(kxVals, firstPass);
+  }
+
+  void ConvolutionCoefficientFunction::SeparableConvolution (double x, double y, FlatVector<> vals) const
+  {
+    for (auto d : Range(stencil.Rows()))
+      vals(d) = 0;
+    for (auto st : Range(stencil.Size()))
+      vals(stencil.Row(st)) += stencil.Weight(st)
+        * SeparableConvolution(x+stencil.Shift(st, 0), y+stencil.Shift(st, 1));
+  }
+
+  void ConvolutionCoefficientFunction::GetConvElements (const Vec<3> & pmin, const Vec<3> & pmax, Array<int> & els) const
+  {
+    if (elIndex)
+      elIndex->GetElements(pmin, pmax, cutoff, els);
+    else
+    {
+      els.SetSize(ma->GetNE());
+      for (auto i : Range(els)) els[i] = i;
+    }
+  }
+
+  template <typename TIR, typename TLUTEntry>
+  void ConvolutionCoefficientFunction::BuildMissingLUTEntry (const TIR & ir, TLUTEntry & lutElEntry, size_t nr, LocalHeap & lh) const
+  {
+    {
+      unique_lock<shared_timed_mutex> writeLock(lutElEntry.second);
+      // another thread might have built the entry in the meantime
+      if (lutElEntry.first.find(ir.Size()) != lutElEntry.first.end()) return;
+      auto &entry = lutElEntry.first[ir.Size()];
+      BuildLUTEntry(ir, entry, lh);
+      if (singlePrecision) entry.ToSingle();
+      budget.Added(nr, entry.MemoryUsage());
+    }
+    budget.Shrink(nr, [this] (size_t i) { return EvictLUTEntries(i); });
+  }
+
+  bool ConvolutionCoefficientFunction::EvictLUTEntries (size_t nr) const
+  {
+    // the scalar entries are numbered first, then the SIMD entries
+    if (nr < kernelLUT.size())
+    {
+      unique_lock<shared_timed_mutex> writeLock(kernelLUT[nr].second, try_to_lock);
+      if (!writeLock.owns_lock()) return false;
+      kernelLUT[nr].first.clear();
+      budget.Removed(nr);
+    }
+    else
+    {
+      unique_lock<shared_timed_mutex> writeLock(SIMD_kernelLUT[nr-kernelLUT.size()].second, try_to_lock);
+      if (!writeLock.owns_lock()) return false;
+      SIMD_kernelLUT[nr-kernelLUT.size()].first.clear();
+      budget.Removed(nr);
+    }
+    return true;
   }
 
   ConvolutionCoefficientFunction::~ConvolutionCoefficientFunction ()
@@ -43,12 +308,20 @@ namespace ngfem
     // TODO: kernelLUT
     int dim = cf->Dimension();
     auto point = ip.GetPoint();
+    if (stencil.Rows() > 1)
+      throw Exception("ConvolveCF: the gradient is only available for IntegrationRules");
+    if (gridValues.Height())
+      return SeparableConvolution(point(0), point(1));
     Vector<> sum(dim);
     sum = 0.0;
     auto lh = LocalHeap(100000, "convolutioncf lh", true);
+    Vec<3> p(0.0);
+    for (int l = 0; l < point.Size(); l++) p(l) = point(l);
+    Array<int> els;
+    GetConvElements(p, p, els);
     // ma->IterateElements doesn't work if Evaluate was called inside a TaskManager task
     // because TaskManager gets stuck on nested tasks
-    for (auto i : Range(ma->GetNE()))
+    for (auto i : els)
     {
       HeapReset hr(lh);
       ElementId ei(VOL, i);
@@ -78,75 +351,125 @@ namespace ngfem
     return sum(0);
   }
 
-  void ConvolutionCoefficientFunction :: Evaluate (const BaseMappedIntegrationRule & ir,
-                                                FlatMatrix<double> values) const
+  void ConvolutionCoefficientFunction::BuildLUTEntry (const BaseMappedIntegrationRule & ir,
+                                                      ConvolutionLUTEntry<double> & entry, LocalHeap & lh) const
   {
-    // TODO: test test test
-    auto lh = LocalHeap(100000, "convolutioncf lh", true);
-    values = 0;
+    //cout << ir.IR() << endl << endl;
 
-    auto &lutElEntry = kernelLUT[ir.GetTransformation().GetElementNr()];
-    auto &irSizeMap = lutElEntry.first;
-    shared_lock<shared_timed_mutex> readLock(lutElEntry.second);
-    auto it = irSizeMap.find(ir.Size());
-    if (it == irSizeMap.end())
-    {
-      readLock.unlock();
-      unique_lock<shared_timed_mutex> writeLock(lutElEntry.second);
-      //cout << ir.IR() << endl << endl;
-
-      // cout << "cache miss " << ir.GetTransformation().GetElementNr() << " " << ir.Size() << endl;
-      auto &mat = irSizeMap.emplace(ir.Size(), Matrix<>(ir.Size(), totalConvIRSize)).first->second;
-      auto points = ir.GetPoints();
-      int col = 0;
-      // ma->IterateElements doesn't work if Evaluate was called inside a TaskManager task
-      // because TaskManager gets stuck on nested tasks
-      for (auto i : Range(ma->GetNE()))
+    // cout << "cache miss " << ir.GetTransformation().GetElementNr() << " " << ir.Size() << endl;
+    auto points = ir.GetPoints();
+    Vec<3> pmin(numeric_limits<double>::max()), pmax(-numeric_limits<double>::max());
+    for (auto j : Range(ir.Size()))
+      for (int l = 0; l < 3; l++)
       {
-        HeapReset hr(lh);
-        ElementId ei(VOL, i);
-        auto & trafo = ma->GetTrafo (ei, lh);
-
-        IntegrationRule convIR(trafo.GetElementType(), order);
-        BaseMappedIntegrationRule & convMIR = trafo(convIR, lh);
-        FlatMatrix<> vals1(convIR.Size(), 1, lh);
-
-        cf->Evaluate (convMIR, vals1);
+        double p = l < ir.DimSpace() ? points(j, l) : 0;
+        pmin(l) = min(pmin(l), p);
+        pmax(l) = max(pmax(l), p);
+      }
+    GetConvElements(pmin, pmax, entry.ownEls);
+    entry.ownOffsets.SetSize(entry.ownEls.Size()+1);
+    entry.ownOffsets[0] = 0;
+    for (auto k : Range(entry.ownEls))
+      entry.ownOffsets[k+1] = entry.ownOffsets[k] + IntegrationRule(ma->GetElType(ElementId(VOL, entry.ownEls[k])), order).Size();
+    entry.SetElements();
+    // one row per integration point and component of the value and gradient
+    entry.SetSize(ir.Size()*stencil.Rows(), entry.offsets.Last());
+    auto &mat = entry.mat;
+    mat = 0.0;
+    // ma->IterateElements doesn't work if Evaluate was called inside a TaskManager task
+    // because TaskManager gets stuck on nested tasks
+    for (auto idx : Range(entry.els))
+    {
+      HeapReset hr(lh);
+      auto i = entry.els[idx];
+      int col = entry.offsets[idx];
+      ElementId ei(VOL, i);
+      auto & trafo = ma->GetTrafo (ei, lh);
 
-        auto mirpts = convMIR.GetPoints();
+      IntegrationRule convIR(trafo.GetElementType(), order);
+      BaseMappedIntegrationRule & convMIR = trafo(convIR, lh);
+      auto mirpts = convMIR.GetPoints();
 
-        for (auto j : Range(ir.Size()))
+      for (auto j : Range(ir.Size()))
+      {
+        for (auto k : Range(convIR.Size()))
         {
-          for (auto k : Range(convIR.Size()))
+          for (auto st : Range(stencil.Size()))
           {
+            HeapReset hr(lh);
             FlatVector<double> newpt = points.Row(j) - mirpts.Row(k) | lh;
+            for (auto l : Range(newpt))
+              newpt(l) += stencil.Shift(st, l);
             // dummy MIP doesn't have the correct ElementTransformation
             // but it doesn't matter as long as kernel only uses the actual point, not the trafo
             // should be ok for most convolution kernels
-            auto val2 = convMIR[k].GetWeight() * kernel->Evaluate(DummyMIPFromPoint(newpt, lh));
-            mat(j, col+k) = val2;
-            values(j, 0) += vals1(k) * val2;
+            mat(j*stencil.Rows()+stencil.Row(st), col+k) += stencil.Weight(st) * convMIR[k].GetWeight()
+              * kernel->Evaluate(DummyMIPFromPoint(newpt, lh));
           }
         }
-        col += convIR.Size();
       }
+    }
+  }
 
-    } else {
-      int col = 0;
-      for (auto i : Range(ma->GetNE()))
-      {
-        HeapReset hr(lh);
-        ElementId ei(VOL, i);
-        auto & trafo = ma->GetTrafo (ei, lh);
-        IntegrationRule convIR(trafo.GetElementType(), order);
-        auto & convMIR = trafo(convIR, lh);
-        FlatMatrix<> vals1(convIR.Size(), 1, lh);
+  void ConvolutionCoefficientFunction :: Evaluate (const BaseMappedIntegrationRule & ir,
+                                                FlatMatrix<double> values) const
+  {
+    // TODO: test test test
+    auto lh = LocalHeap(100000, "convolutioncf lh", true);
+    values = 0;
 
-        cf->Evaluate(convMIR, vals1);
-        values += it->second.Cols(col, col+convIR.Size()) * vals1;
-        col += convIR.Size();
-      }
+    shared_lock<shared_timed_mutex> cfLock;
+    if (!cfLUT.empty() || gridValues.Height())
+      cfLock = tracker.Check([this] { FillCFCache(false); });
+
+    if (gridValues.Height())
+    {
+      auto points = ir.GetPoints();
+      for (auto j : Range(ir.Size()))
+        SeparableConvolution(points(j, 0), points(j, 1), values.Row(j));
+      return;
     }
+
+    auto &lutElEntry = kernelLUT[ir.GetTransformation().GetElementNr()];
+    auto &irSizeMap = lutElEntry.first;
+    shared_lock<shared_timed_mutex> readLock(lutElEntry.second);
+    auto it = irSizeMap.find(ir.Size());
+    if (it != irSizeMap.end())
+      budget.Hit(ir.GetTransformation().GetElementNr());
+    // the entry might be evicted by another thread before the read lock is taken again
+    while (it == irSizeMap.end())
+    {
+      readLock.unlock();
+      BuildMissingLUTEntry(ir, lutElEntry, ir.GetTransformation().GetElementNr(), lh);
+      readLock.lock();
+      it = irSizeMap.find(ir.Size());
+    }
+
+    const auto &entry = it->second;
+    // the rows of one point are the value and the gradient
+    FlatMatrix<> result(entry.height, 1, lh);
+    result = 0;
+    for (auto idx : Range(entry.els))
+    {
+      HeapReset hr(lh);
+      ElementId ei(VOL, entry.els[idx]);
+      auto & trafo = ma->GetTrafo (ei, lh);
+      IntegrationRule convIR(trafo.GetElementType(), order);
+      auto & convMIR = trafo(convIR, lh);
+      FlatMatrix<> vals1(convIR.Size(), 1, lh);
+
+      cf->Evaluate(convMIR, vals1);
+      if (!entry.single)
+        result += entry.mat.Cols(entry.offsets[idx], entry.offsets[idx+1]) * vals1;
+      else
+        // single precision kernel values, accumulated in double
+        for (auto j : Range(entry.height))
+          for (auto k : Range(convIR.Size()))
+            result(j, 0) += entry.Get(j, entry.offsets[idx]+k) * vals1(k, 0);
+    }
+    for (auto j : Range(ir.Size()))
+      for (auto d : Range(stencil.Rows()))
+        values(j, d) = result(j*stencil.Rows()+d, 0);
   }
 
   void PrintBare(const ABareMatrix<double> &mat, int h, int w)
@@ -163,90 +486,132 @@ namespace ngfem
   void ConvolutionCoefficientFunction::CacheCF()
   {
     cfLUT.resize(ma->GetNE());
-    LocalHeap glh(100000, "convolution cachecf lh");
-    ma->IterateElements
-      (VOL, glh, [&] (ngcomp::Ngs_Element el, LocalHeap & lh)
-       {
-         auto & trafo = ma->GetTrafo (el, lh);
-         SIMD_IntegrationRule convIR(trafo.GetElementType(), order);
-         auto & convMIR = trafo(convIR, lh);
-         cfLUT[el.Nr()].SetSize(1, convIR.Size());
-
-         cf->Evaluate(convMIR, cfLUT[el.Nr()]);
-       });
+    if (gridX.Size())
+      gridValues.SetSize(gridX.Size(), gridY.Size());
+    FillCFCache(true);
+    tracker.Changed();
   }
 
-
-  void ConvolutionCoefficientFunction :: Evaluate (const SIMD_BaseMappedIntegrationRule & ir, BareSliceMatrix<SIMD<double>> values) const
+  void ConvolutionCoefficientFunction::FillCFCache (bool parallel) const
   {
-    // TODO: test test test
-    //cout << "                SIMD !!!!!!!!!!!!!!!" << endl << endl;
-    auto lh = LocalHeap(100000, "convolutioncf lh", true);
-    values.AddSize(Dimension(), ir.Size()) = 0;
+    // ma->IterateElements doesn't work if called from Evaluate inside a TaskManager task,
+    // the elements are independent anyway
+    auto fill = [&] (IntRange r)
+      {
+        LocalHeap lh(100000, "convolution cachecf lh");
+        for (auto i : r)
+        {
+          HeapReset hr(lh);
+          ElementId ei(VOL, i);
+          auto & trafo = ma->GetTrafo (ei, lh);
+          if (!cfLUT.empty())
+          {
+            SIMD_IntegrationRule convIR(trafo.GetElementType(), order);
+            auto & convMIR = trafo(convIR, lh);
+            cfLUT[i].SetSize(1, convIR.Size());
 
-    auto &lutElEntry = SIMD_kernelLUT[ir.GetTransformation().GetElementNr()];
-    auto &irSizeMap = lutElEntry.first;
-    shared_lock<shared_timed_mutex> readLock(lutElEntry.second);
-    auto it = irSizeMap.find(ir.Size());
-    if (it == irSizeMap.end())
-    //if (1)
-    {
-      readLock.unlock();
-      unique_lock<shared_timed_mutex> writeLock(lutElEntry.second);
-      //cout << ir.IR() << endl << endl;
-      //cout << ir << endl << endl;
+            cf->Evaluate(convMIR, cfLUT[i]);
+          }
+          if (gridValues.Height())
+          {
+            IntegrationRule convIR(trafo.GetElementType(), order);
+            auto & convMIR = trafo(convIR, lh);
+            FlatMatrix<> vals(convIR.Size(), 1, lh);
+            cf->Evaluate(convMIR, vals);
+            for (auto k : Range(convIR.Size()))
+            {
+              int pos = gridPos[gridOffsets[i]+k];
+              gridValues(pos / gridY.Size(), pos % gridY.Size()) = convMIR[k].GetWeight() * vals(k, 0);
+            }
+          }
+        }
+      };
+    if (parallel)
+      ParallelForRange (Range(ma->GetNE()), fill);
+    else
+      fill(Range(ma->GetNE()));
+    passY.clear();
+  }
 
-      // cout << "cache miss " << ir.GetTransformation().GetElementNr() << " " << ir.Size() << endl;
-      auto &mat = irSizeMap.emplace(ir.Size(), Matrix<SIMD<double>>(SIMD_totalConvIRSize, ir.Size())).first->second;
-      auto points = ir.GetPoints();
-      int row = 0;
-      // ma->IterateElements doesn't work if Evaluate was called inside a TaskManager task
-      // because TaskManager gets stuck on nested tasks
-      for (auto i : Range(ma->GetNE()))
-      {
-        //cout << "element " << i << endl << endl;
-        HeapReset hr(lh);
-        ElementId ei(VOL, i);
-        auto & trafo = ma->GetTrafo (ei, lh);
+  void ConvolutionCoefficientFunction::ClearCFCache ()
+  {
+    cfLUT.clear();
+    gridValues.SetSize(0, 0);
+    passY.clear();
+  }
 
-        SIMD_IntegrationRule convIR(trafo.GetElementType(), order);
-        //cout << "convIR " << convIR << endl << endl;
-        auto & convMIR = trafo(convIR, lh);
-        //cout << "convMIR " << convMIR << endl << endl;
-        const FlatMatrix<SIMD<double>> *vals1;
-        if (! cfLUT.empty()) vals1 = &cfLUT[i];
-        else {
-          vals1 = new (lh) FlatMatrix<SIMD<double>>(1, convIR.Size(), lh);
 
-          cf->Evaluate(convMIR, *vals1);
-        }
-        //cout << "vals1 " << vals1 << endl << endl;
-
-        auto mirpts = convMIR.GetPoints();
-        //cout << "points" << endl;
-        //PrintBare(points, ir.Size(), 2);
-        //cout << "mirpts" << endl;
-        //PrintBare(mirpts, convMIR.Size(), 2);
-
-        size_t newSize = ir.Size()*convIR.Size()*SIMD<IntegrationPoint>::Size();
-        FlatArray<SIMD<IntegrationPoint>> newIPs(newSize, lh);
-        // dummy MIP doesn't have the correct ElementTransformation
-        // but it doesn't matter as long as kernel only uses the actual points, not the trafo
-        // should be ok for most convolution kernels
-        SIMD_BaseMappedIntegrationRule *newBMIR;
-        switch (ir.DimSpace())
+  void ConvolutionCoefficientFunction::BuildLUTEntry (const SIMD_BaseMappedIntegrationRule & ir,
+                                                      ConvolutionLUTEntry<SIMD<double>> & entry, LocalHeap & lh) const
+  {
+    //cout << ir.IR() << endl << endl;
+    //cout << ir << endl << endl;
+
+    // cout << "cache miss " << ir.GetTransformation().GetElementNr() << " " << ir.Size() << endl;
+    auto points = ir.GetPoints();
+    Vec<3> pmin(numeric_limits<double>::max()), pmax(-numeric_limits<double>::max());
+    for (auto j : Range(ir.Size()))
+      for (auto m : Range(SIMD<IntegrationPoint>::Size()))
+        for (int l = 0; l < 3; l++)
         {
-        case 1:
-          newBMIR = new (lh) SIMD_MappedIntegrationRule<0, 1>(SIMD_IntegrationRule(newSize, &newIPs[0]), DummyElementTransformation(1), -1, lh);
-          break;
-        case 2:
-          newBMIR = new (lh) SIMD_MappedIntegrationRule<0, 2>(SIMD_IntegrationRule(newSize, &newIPs[0]), DummyElementTransformation(2), -1, lh);
-          break;
-        case 3:
-          newBMIR = new (lh) SIMD_MappedIntegrationRule<0, 3>(SIMD_IntegrationRule(newSize, &newIPs[0]), DummyElementTransformation(3), -1, lh);
-          break;
+          double p = l < ir.DimSpace() ? points(j, l)[m] : 0;
+          pmin(l) = min(pmin(l), p);
+          pmax(l) = max(pmax(l), p);
         }
+    GetConvElements(pmin, pmax, entry.ownEls);
+    entry.ownOffsets.SetSize(entry.ownEls.Size()+1);
+    entry.ownOffsets[0] = 0;
+    for (auto k : Range(entry.ownEls))
+      entry.ownOffsets[k+1] = entry.ownOffsets[k] + SIMD_IntegrationRule(ma->GetElType(ElementId(VOL, entry.ownEls[k])), order).Size()*SIMD<IntegrationPoint>::Size();
+    entry.SetElements();
+    // one column per integration point and component of the value and gradient
+    entry.SetSize(entry.offsets.Last(), ir.Size()*stencil.Rows());
+    auto &mat = entry.mat;
+    mat = SIMD<double>(0.0);
+    // ma->IterateElements doesn't work if Evaluate was called inside a TaskManager task
+    // because TaskManager gets stuck on nested tasks
+    for (auto idx : Range(entry.els))
+    {
+      //cout << "element " << i << endl << endl;
+      HeapReset hr(lh);
+      auto i = entry.els[idx];
+      int row = entry.offsets[idx];
+      ElementId ei(VOL, i);
+      auto & trafo = ma->GetTrafo (ei, lh);
+
+      SIMD_IntegrationRule convIR(trafo.GetElementType(), order);
+      //cout << "convIR " << convIR << endl << endl;
+      auto & convMIR = trafo(convIR, lh);
+      //cout << "convMIR " << convMIR << endl << endl;
+
+      auto mirpts = convMIR.GetPoints();
+      //cout << "points" << endl;
+      //PrintBare(points, ir.Size(), 2);
+      //cout << "mirpts" << endl;
+      //PrintBare(mirpts, convMIR.Size(), 2);
+
+      size_t newSize = ir.Size()*convIR.Size()*SIMD<IntegrationPoint>::Size();
+      FlatArray<SIMD<IntegrationPoint>> newIPs(newSize, lh);
+      // dummy MIP doesn't have the correct ElementTransformation
+      // but it doesn't matter as long as kernel only uses the actual points, not the trafo
+      // should be ok for most convolution kernels
+      SIMD_BaseMappedIntegrationRule *newBMIR;
+      switch (ir.DimSpace())
+      {
+      case 1:
+        newBMIR = new (lh) SIMD_MappedIntegrationRule<0, 1>(SIMD_IntegrationRule(newSize, &newIPs[0]), DummyElementTransformation(1), -1, lh);
+        break;
+      case 2:
+        newBMIR = new (lh) SIMD_MappedIntegrationRule<0, 2>(SIMD_IntegrationRule(newSize, &newIPs[0]), DummyElementTransformation(2), -1, lh);
+        break;
+      case 3:
+        newBMIR = new (lh) SIMD_MappedIntegrationRule<0, 3>(SIMD_IntegrationRule(newSize, &newIPs[0]), DummyElementTransformation(3), -1, lh);
+        break;
+      }
 
+      FlatMatrix<SIMD<double>> kernelVals(1, newSize, lh);
+      for (auto st : Range(stencil.Size()))
+      {
         for (auto j : Range(convIR.Size()))
         {
           for (auto m : Range(SIMD<IntegrationPoint>::Size()))
@@ -254,63 +619,124 @@ namespace ngfem
             for (auto k : Range(ir.Size()))
             {
               for (auto l : Range(ir.DimSpace()))
-                newBMIR->GetPoints()(j*SIMD<IntegrationPoint>::Size()*ir.Size()+m*ir.Size()+k, l) = points(k, l) - mirpts(j, l)[m];
+                newBMIR->GetPoints()(j*SIMD<IntegrationPoint>::Size()*ir.Size()+m*ir.Size()+k, l)
+                  = points(k, l) + stencil.Shift(st, l) - mirpts(j, l)[m];
             }
           }
         }
 
         //cout << "newBMIR " << *newBMIR << endl << endl;
-        kernel->Evaluate(*newBMIR, mat.Rows(row, row+SIMD<IntegrationPoint>::Size()*convIR.Size()));
-        //cout << "vals 2 " << endl << mat.Rows(row, SIMD<IntegrationPoint>::Size()*row+convIR.Size()) << endl << endl;
-        //cout << "weights" << endl;
-        for (auto j : Range(convIR.Size()))
-        {
-          for (auto m : Range(SIMD<IntegrationPoint>::Size()))
-          {
-            mat.Row(row+j*SIMD<IntegrationPoint>::Size()+m) *= convMIR[j].GetWeight()[m];
-            for (auto k : Range(ir.Size()))
-              values(0, k) += (*vals1)(j)[m] * mat(row+j*SIMD<IntegrationPoint>::Size()+m, k);
-            // values(0, k) += vals1(j)[m] * mat(row+j*SIMD<IntegrationPoint>::Size()+m, k);
-          }
-          // cout << k << ": " << convMIR[k].GetMeasure() << " " << convMIR[k].IP().Weight() << " " << "w " <<  convMIR[k].GetWeight() << endl;
-        }
-        //cout << endl << endl;
-        //cout << mat.Rows(row, row+SIMD<IntegrationPoint>::Size()*convIR.Size()) << endl << endl;
+        kernel->Evaluate(*newBMIR, kernelVals);
+        for (auto j : Range(convIR.Size()*SIMD<IntegrationPoint>::Size()))
+          for (auto k : Range(ir.Size()))
+            mat(row+j, k*stencil.Rows()+stencil.Row(st)) += stencil.Weight(st) * kernelVals(0, j*ir.Size()+k);
+      }
+      //cout << "vals 2 " << endl << mat.Rows(row, SIMD<IntegrationPoint>::Size()*row+convIR.Size()) << endl << endl;
+      for (auto j : Range(convIR.Size()))
+        for (auto m : Range(SIMD<IntegrationPoint>::Size()))
+          mat.Row(row+j*SIMD<IntegrationPoint>::Size()+m) *= convMIR[j].GetWeight()[m];
+      //cout << mat.Rows(row, row+SIMD<IntegrationPoint>::Size()*convIR.Size()) << endl << endl;
+    }
+  }
 
-        // values.AddSize(Dimension(), ir.Size()) += vals1 * mat.Rows(row, row+SIMD<IntegrationPoint>::Size()*convIR.Size());
-        //cout << values.AddSize(Dimension(), ir.Size()) << endl << endl;
+  void ConvolutionCoefficientFunction :: Evaluate (const SIMD_BaseMappedIntegrationRule & ir, BareSliceMatrix<SIMD<double>> values) const
+  {
+    // TODO: test test test
+    //cout << "                SIMD !!!!!!!!!!!!!!!" << endl << endl;
+    auto lh = LocalHeap(100000, "convolutioncf lh", true);
+    values.AddSize(Dimension(), ir.Size()) = 0;
 
-        row += SIMD<IntegrationPoint>::Size()*convIR.Size();
-      }
+    shared_lock<shared_timed_mutex> cfLock;
+    if (!cfLUT.empty() || gridValues.Height())
+      cfLock = tracker.Check([this] { FillCFCache(false); });
 
-    } else {
-      int row = 0;
-      for (auto i : Range(ma->GetNE()))
+    if (gridValues.Height())
+    {
+      auto points = ir.GetPoints();
+      for (auto k : Range(ir.Size()))
       {
-        HeapReset hr(lh);
-        ElementId ei(VOL, i);
-        auto & trafo = ma->GetTrafo (ei, lh);
-        SIMD_IntegrationRule convIR(trafo.GetElementType(), order);
-        const FlatMatrix<SIMD<double>> *vals1;
-        if (! cfLUT.empty()) vals1 = &cfLUT[i];
-        else {
-          auto & convMIR = trafo(convIR, lh);
-          vals1 = new (lh) FlatMatrix<SIMD<double>>(1, convIR.Size(), lh);
-
-          cf->Evaluate(convMIR, *vals1);
-        }
+        Matrix<> lanes(SIMD<double>::Size(), stencil.Rows());
+        for (auto m : Range(SIMD<double>::Size()))
+          SeparableConvolution(points(k, 0)[m], points(k, 1)[m], lanes.Row(m));
+        for (auto d : Range(stencil.Rows()))
+          values(d, k) = SIMD<double>([&] (int m) { return lanes(m, d); });
+      }
+      return;
+    }
 
-        for (auto j : Range(convIR.Size()))
+    auto &lutElEntry = SIMD_kernelLUT[ir.GetTransformation().GetElementNr()];
+    auto &irSizeMap = lutElEntry.first;
+    shared_lock<shared_timed_mutex> readLock(lutElEntry.second);
+    auto it = irSizeMap.find(ir.Size());
+    if (it != irSizeMap.end())
+      budget.Hit(kernelLUT.size()+ir.GetTransformation().GetElementNr());
+    // the entry might be evicted by another thread before the read lock is taken again
+    while (it == irSizeMap.end())
+    //if (1)
+    {
+      readLock.unlock();
+      BuildMissingLUTEntry(ir, lutElEntry, kernelLUT.size()+ir.GetTransformation().GetElementNr(), lh);
+      readLock.lock();
+      it = irSizeMap.find(ir.Size());
+    }
+
+    const auto &entry = it->second;
+    for (auto idx : Range(entry.els))
+    {
+      HeapReset hr(lh);
+      auto i = entry.els[idx];
+      int row = entry.offsets[idx];
+      ElementId ei(VOL, i);
+      auto & trafo = ma->GetTrafo (ei, lh);
+      SIMD_IntegrationRule convIR(trafo.GetElementType(), order);
+      const FlatMatrix<SIMD<double>> *vals1;
+      if (! cfLUT.empty()) vals1 = &cfLUT[i];
+      else {
+        auto & convMIR = trafo(convIR, lh);
+        vals1 = new (lh) FlatMatrix<SIMD<double>>(1, convIR.Size(), lh);
+
+        cf->Evaluate(convMIR, *vals1);
+      }
+
+      for (auto j : Range(convIR.Size()))
+      {
+        for (auto m : Range(SIMD<IntegrationPoint>::Size()))
         {
-          for (auto m : Range(SIMD<IntegrationPoint>::Size()))
-          {
-            for (auto k : Range(ir.Size()))
-              values(0, k) += (*vals1)(j)[m] * it->second(row+j*SIMD<IntegrationPoint>::Size()+m, k);
-          }
+          // the columns of one point are the value and the gradient
+          for (auto k : Range(ir.Size()))
+            for (auto d : Range(stencil.Rows()))
+              values(d, k) += (*vals1)(j)[m] * entry.Get(row+j*SIMD<IntegrationPoint>::Size()+m, k*stencil.Rows()+d);
         }
-        row += SIMD<IntegrationPoint>::Size()*convIR.Size();
       }
     }
   }
 
+  void ConvolutionCoefficientFunction::Prebuild (int aorder, VorB vb, bool simd)
+  {
+    if (vb != VOL)
+      throw Exception("ConvolutionCoefficientFunction::Prebuild: lookup tables are only stored for volume elements");
+    // the entries of one element are independent of all others, so no nested tasks are needed
+    ParallelForRange
+      (Range(ma->GetNE()), [&] (IntRange r)
+       {
+         LocalHeap lh(10000000, "convolutioncf prebuild lh");
+         for (auto i : r)
+         {
+           HeapReset hr(lh);
+           ElementId ei(VOL, i);
+           auto & trafo = ma->GetTrafo(ei, lh);
+           if (simd)
+           {
+             SIMD_IntegrationRule ir(trafo.GetElementType(), aorder);
+             BuildMissingLUTEntry(trafo(ir, lh), SIMD_kernelLUT[i], kernelLUT.size()+i, lh);
+           }
+           else
+           {
+             IntegrationRule ir(trafo.GetElementType(), aorder);
+             BuildMissingLUTEntry(trafo(ir, lh), kernelLUT[i], i, lh);
+           }
+         }
+       });
+  }
+
 }
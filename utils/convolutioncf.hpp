@@ -6,32 +6,175 @@
 
 #include <shared_mutex>
 
+#include "gftracker.hpp"
+#include "lutcache.hpp"
+#include "separablekernel.hpp"
+#include "spatialindex.hpp"
+#include "utils.hpp"
+
 namespace ngfem
 {
+  // kernel lookup table of one element for one IntegrationRule size
+  template <typename SCAL>
+  struct ConvolutionLUTEntry
+  {
+    // elements of the convolution integral taken into account
+    // and the first column (row for SIMD) of their integration points in mat
+    // views of the own arrays or of a memory mapped lookup table file
+    FlatArray<int> els;
+    FlatArray<int> offsets;
+    size_t height = 0, width = 0;
+    FlatMatrix<SCAL> mat;
+    // single precision values instead of mat
+    bool single = false;
+    FlatArray<float> mat32;
+    Array<int> ownEls;
+    Array<int> ownOffsets;
+    Array<SCAL> ownMat;
+    Array<float> ownMat32;
+
+    static constexpr size_t Lanes () { return sizeof(SCAL)/sizeof(double); }
+    SCAL Get (size_t i, size_t j) const
+    {
+      if (!single) return mat(i, j);
+      SCAL val;
+      FloatsToScalar(&mat32[(i*width+j)*Lanes()], val);
+      return val;
+    }
+
+    void SetElements ()
+    {
+      els.Assign(ownEls);
+      offsets.Assign(ownOffsets);
+    }
+
+    void SetSize (size_t aheight, size_t awidth)
+    {
+      height = aheight;
+      width = awidth;
+      ownMat.SetSize(height*width);
+      mat.AssignMemory(height, width, ownMat.Addr(0));
+    }
+
+    // convert the values to single precision and free the double ones
+    void ToSingle ()
+    {
+      ScalarsToFloats(FlatArray<SCAL>(height*width, mat.Data()), ownMat32);
+      mat32.Assign(ownMat32);
+      ownMat.DeleteAll();
+      mat.AssignMemory(0, 0, ownMat.Addr(0));
+      single = true;
+    }
+
+    // memory owned by the entry, not counting memory mapped files
+    size_t MemoryUsage () const
+    {
+      return (ownEls.Size()+ownOffsets.Size())*sizeof(int) + ownMat.Size()*sizeof(SCAL)
+        + ownMat32.Size()*sizeof(float);
+    }
 
-  class ConvolutionCoefficientFunction : public CoefficientFunction
+    void Save (LUTWriter & out) const
+    {
+      out.Write(els.Size());
+      out.Write(height);
+      out.Write(width);
+      out.Write(single);
+      out.WriteArray(els);
+      out.WriteArray(offsets);
+      if (single)
+        out.WriteArray(mat32);
+      else
+        out.WriteArray(FlatArray<SCAL>(height*width, mat.Data()));
+    }
+
+    // the entry keeps pointing into the file
+    void Load (LUTReader & in)
+    {
+      size_t numEls = in.Read();
+      height = in.Read();
+      width = in.Read();
+      single = in.Read();
+      els.Assign(in.ReadArray<int>(numEls));
+      offsets.Assign(in.ReadArray<int>(numEls+1));
+      if (single)
+        mat32.Assign(in.ReadArray<float>(height*width*Lanes()));
+      else
+        mat.AssignMemory(height, width, in.ReadArray<SCAL>(height*width).Addr(0));
+    }
+  };
+
+  class ConvolutionCoefficientFunction : public CoefficientFunction, public ElementRuleCache
   {
     shared_ptr<CoefficientFunction> cf;
     shared_ptr<CoefficientFunction> kernel;
     shared_ptr<ngcomp::MeshAccess> ma;
     int order;
 
-    // IntegrationRule sizes for the given order, summed over all elements
-    int totalConvIRSize;
-    int SIMD_totalConvIRSize;
+    // elements farther away than cutoff are skipped
+    double cutoff;
+    unique_ptr<ElementBoxIndex> elIndex;
+
+    // store the kernel lookup tables in single precision
+    bool singlePrecision;
+    // central differences for the gradient with respect to the evaluation point,
+    // stored in the same kernel lookup tables as the value
+    GradientStencil stencil;
 
     // lookup table for kernel values
     // ASSUMPTION: IntegrationRules given as input of Evaluate() during the lifetime
     // of this ConvolutionCF can be uniquely identified by their Size() and the
     // corresponding element
-    mutable vector<pair<map<int, typename ngbla::Matrix<>>, shared_timed_mutex>> kernelLUT;
+    mutable vector<pair<map<int, ConvolutionLUTEntry<double>>, shared_timed_mutex>> kernelLUT;
     // TODO: do we really need two different LUTs?
-    mutable vector<pair<map<int, typename ngbla::Matrix<SIMD<double>>>, shared_timed_mutex>> SIMD_kernelLUT;
-    vector<typename ngbla::Matrix<SIMD<double>>> cfLUT;
+    mutable vector<pair<map<int, ConvolutionLUTEntry<SIMD<double>>>, shared_timed_mutex>> SIMD_kernelLUT;
+    // entries 0..NE-1 are the elements of kernelLUT, NE..2*NE-1 the ones of SIMD_kernelLUT
+    mutable LUTBudget budget;
+    // values of cf, only set while cf is cached
+    mutable vector<typename ngbla::Matrix<SIMD<double>>> cfLUT;
+    // the cached values of cf are recomputed when its GridFunctions change
+    mutable GridFunctionTracker tracker;
+    // evaluate cf into cfLUT and gridValues, whichever is allocated
+    void FillCFCache (bool parallel) const;
+
+    // persistent kernel lookup tables, identified by a hash of the mesh, order, cutoff and kernel
+    string cacheFile;
+    uint64_t lutKey;
+    shared_ptr<MappedFile> lutFile;
+    void LoadLUT ();
+
+    // two pass convolution for separable kernels if the integration points of all elements
+    // form a tensor product grid gridX x gridY (2D, scalar cf and no cutoff only)
+    shared_ptr<SeparableKernelCoefficientFunction> separableKernel;
+    Array<double> gridX, gridY;
+    // grid position ix*gridY.Size()+iy of the integration points of the elements, starting at gridOffsets[el]
+    Array<int> gridPos;
+    Array<int> gridOffsets;
+    // weighted values of cf in the grid points, only set while cf is cached
+    mutable Matrix<> gridValues;
+    // kx at the offsets to gridX resp. the first pass sum_iy ky(y-gridY[iy])*gridValues(ix, iy)
+    // for the coordinates of the evaluation points seen so far
+    mutable map<double, Vector<>> passX, passY;
+    mutable shared_timed_mutex passXMutex, passYMutex;
+    void FindTensorGrid ();
+    double SeparableConvolution (double x, double y) const;
+    // value and gradient
+    void SeparableConvolution (double x, double y, FlatVector<> vals) const;
+
+    // compute the kernel lookup table entry for the points of ir
+    void BuildLUTEntry (const BaseMappedIntegrationRule & ir, ConvolutionLUTEntry<double> & entry, LocalHeap & lh) const;
+    void BuildLUTEntry (const SIMD_BaseMappedIntegrationRule & ir, ConvolutionLUTEntry<SIMD<double>> & entry, LocalHeap & lh) const;
+    // build the entry for ir under the write lock of lutElEntry if it is missing, nr numbers the entry in budget
+    template <typename TIR, typename TLUTEntry>
+    void BuildMissingLUTEntry (const TIR & ir, TLUTEntry & lutElEntry, size_t nr, LocalHeap & lh) const;
+    bool EvictLUTEntries (size_t nr) const;
+    // elements closer than cutoff to the box [pmin, pmax]
+    void GetConvElements (const Vec<3> & pmin, const Vec<3> & pmax, Array<int> & els) const;
   public:
     ConvolutionCoefficientFunction (shared_ptr<CoefficientFunction> acf,
                                     shared_ptr<CoefficientFunction> akernel,
-                                    shared_ptr<ngcomp::MeshAccess> ama, int aorder);
+                                    shared_ptr<ngcomp::MeshAccess> ama, int aorder,
+                                    double acutoff=0, string cachedir="", bool asinglePrecision=false,
+                                    bool agradient=false);
     virtual ~ConvolutionCoefficientFunction ();
     ///
     virtual double Evaluate (const BaseMappedIntegrationPoint & ip) const;
@@ -41,7 +184,13 @@ namespace ngfem
     virtual void TraverseTree (const function<void(CoefficientFunction&)> & func);
     virtual void PrintReport (ostream & ost) const;
     void CacheCF();
-    void ClearCFCache() { cfLUT.clear(); }
+    void ClearCFCache();
+    // build the kernel lookup tables for IntegrationRules of the given order on all elements in parallel
+    void Prebuild (int aorder, VorB vb=VOL, bool simd=false);
+    // write the kernel lookup tables built so far to the cache directory
+    void SaveLUT () const;
+    const LUTBudget & GetBudget () const { return budget; }
+    void SetMaxLUTBytes (size_t maxBytes) { budget.SetMaxBytes(maxBytes); }
   };
 
 }
@@ -47,6 +47,44 @@ void solveEikonal1D(shared_ptr<CoefficientFunction> rhs, shared_ptr<GridFunction
   SetValues(ipcf, *res, VOL, nullptr, lh);
 }
 
+// rhs averaged over the elements at each vertex
+static vector<double> vertexAverages(const MeshAccess &ma, shared_ptr<CoefficientFunction> rhs, ELEMENT_TYPE et)
+{
+  LocalHeap glh(100000, "eikonal lh");
+  vector<double> rhsvals(ma.GetNV());
+  const auto &et_verts = ElementTopology::GetVertices(et);
+  int nverts = ElementTopology::GetNVertices(et);
+  IntegrationRule ir(nverts, glh);
+  for (auto i : Range(nverts)) ir[i] = IntegrationPoint(et_verts[i], 0);
+  // ma->IterateElements(VOL, glh, [&] (Ngs_Element el, LocalHeap &lh)
+  for (auto &&el : ma.Elements())
+    {
+      HeapReset hr(glh);
+      const auto &verts = el.Vertices();
+      const auto &trafo = ma.GetTrafo(el, glh);
+      const auto &mir = trafo(ir, glh);
+      FlatVector<> vals(nverts, glh);
+      rhs->Evaluate(mir, vals.AsMatrix(ir.Size(), 1));
+      for (auto i : Range(nverts)) rhsvals[verts[i]] += vals[i];
+    }
+    // });
+
+  for (auto i : Range(rhsvals.size()))
+  {
+    rhsvals[i] /= ma.GetVertexElements(i).Size();
+    // cout << rhsvals[i] << endl;
+  }
+  return rhsvals;
+}
+
+static vector<int> boundaryVertices(const MeshAccess &ma)
+{
+  vector<int> bnd_verts;
+  for (auto &&el : ma.Elements(BND))
+    for (auto v : el.Vertices()) bnd_verts.push_back(v);
+  return bnd_verts;
+}
+
 EikonalSolver2D::EikonalSolver2D(shared_ptr<FESpace> fes, const vector<Vec<2>> &refs)
   : ma(fes->GetMeshAccess()), distByPntByRef(refs.size()), anglesByEl(ma->GetNE())
 {
@@ -71,52 +109,133 @@ EikonalSolver2D::EikonalSolver2D(shared_ptr<FESpace> fes, const vector<Vec<2>> &
       }
   // }
     });
-  for (auto i : Range(refs.size()))
-  {
-    for (auto j : Range(ma->GetNV()))
-      distByPntByRef[i].emplace_back(make_pair(j, L2Norm(refs[i]-ma->GetPoint<2>(j))));
-    sort(distByPntByRef[i].begin(), distByPntByRef[i].end(), [] (auto &a, auto &b) { return a.second < b.second; });
-    // for (auto j : Range(ma->GetNV()))
-    //   cout << distByPntByRef[i][j].first << " " << distByPntByRef[i][j].second << endl;
-  }
+  // only the orderings are stored, the distances are temporary per reference
+  ParallelFor(refs.size(), [&] (size_t i)
+    {
+      vector<double> dists(ma->GetNV());
+      for (auto j : Range(ma->GetNV()))
+        dists[j] = L2Norm(refs[i]-ma->GetPoint<2>(j));
+      auto &order = distByPntByRef[i];
+      order.resize(ma->GetNV());
+      iota(order.begin(), order.end(), 0);
+      sort(order.begin(), order.end(), [&] (int32_t a, int32_t b) { return dists[a] < dists[b]; });
+    });
 
   nodal_fes = CreateFESpace("nodal", ma, Flags().SetFlag("order", 1));
   nodal_gf = CreateGridFunction(nodal_fes, "Eikonal", Flags().SetFlag("novisual"));
   nodal_gf->Update();
 }
 
-void EikonalSolver2D::solve(shared_ptr<CoefficientFunction> rhs)
+double EikonalSolver2D::vertexRhsAt(shared_ptr<CoefficientFunction> rhs, int vert, LocalHeap &lh) const
 {
-  LocalHeap glh(100000, "eikonal 2d lh");
-  FlatVector<double> res(ma->GetNV(), glh);
-  res = numeric_limits<double>::max(); //                            ok?
-  ma->IterateElements(BND, glh, [&] (Ngs_Element el, LocalHeap &lh)
+  // same average as in vertexAverages, from the elements of vert only
+  const auto &et_verts = ElementTopology::GetVertices(ET_TRIG);
+  auto els = ma->GetVertexElements(vert);
+  double sum = 0;
+  for (auto elnr : els)
+  {
+    HeapReset hr(lh);
+    ElementId ei(VOL, elnr);
+    auto verts = ma->GetElement(ei).Vertices();
+    for (auto i : Range(3))
+      if (verts[i] == vert)
+      {
+        const auto &trafo = ma->GetTrafo(ei, lh);
+        sum += rhs->Evaluate(trafo(IntegrationPoint(et_verts[i], 0), lh));
+      }
+  }
+  return sum / els.Size();
+}
+
+double EikonalSolver2D::updateFromElement(int this_vert, int elnr, FlatVector<double> res, const vector<double> &rhsvals) const
+{
+  auto el = ma->GetElement(ElementId(VOL, elnr));
+  auto verts = el.Vertices();
+  Vec<2> vert_cs[3];
+  for (int i : Range(3)) vert_cs[i] = ma->GetPoint<2>(verts[i]);
+  double lengths[3];
+  for (int i : Range(3))
+  {
+    Vec<2> e1 = vert_cs[(i+1)%3]-vert_cs[i];
+    lengths[i] = L2Norm(e1);
+  }
+  int C_idx = 0;
+  for (auto i : Range(3))
+  {
+    if (verts[i] == this_vert)
     {
-      for (auto v : el.Vertices()) res[v] = 0;
-    });
+      C_idx = i;
+      break;
+    }
+  }
+  int sort_idxs[2] = {(C_idx+1)%3, (C_idx+2)%3};
+  if (sort_idxs[0] > sort_idxs[1])
+    swap(sort_idxs[0], sort_idxs[1]);
+  if (res[verts[sort_idxs[0]]] > res[verts[sort_idxs[1]]])
+    swap(sort_idxs[0], sort_idxs[1]);
 
-  vector<double> rhsvals(ma->GetNV());
-  const auto &et_verts = ElementTopology::GetVertices(ET_TRIG);
-  IntegrationRule ir(3, glh);
-  for (auto i : Range(3)) ir[i] = IntegrationPoint(et_verts[i], 0);
-  // ma->IterateElements(VOL, glh, [&] (Ngs_Element el, LocalHeap &lh)
-  for (auto &&el : ma->Elements())
+  const auto &a = lengths[(sort_idxs[0]+1)%3];
+  const auto &b = lengths[(sort_idxs[1]+1)%3];
+  const auto &c = lengths[(C_idx+1)%3];
+  const auto &alpha = anglesByEl[elnr][sort_idxs[0]];
+  const auto &beta = anglesByEl[elnr][sort_idxs[1]];
+  const auto &T_A = res[verts[sort_idxs[0]]];
+  const auto &T_B = res[verts[sort_idxs[1]]];
+  const auto &f_C = rhsvals[this_vert];
+
+  auto sintheta = (T_B-T_A) / (c*f_C);
+  if (sintheta <= 1)
+  {
+    auto theta = asin(sintheta);
+    if (max(0.0, alpha-M_PI/2) <= theta && theta <= M_PI/2 - beta)
     {
-      HeapReset hr(glh);
-      const auto &verts = el.Vertices();
-      const auto &trafo = ma->GetTrafo(el, glh);
-      const auto &mir = trafo(ir, glh);
-      FlatVector<> vals(3, glh);
-      rhs->Evaluate(mir, vals.AsMatrix(ir.Size(), 1));
-      for (auto i : Range(3)) rhsvals[verts[i]] += vals[i];
+      auto h = a*sin(alpha-theta);
+      return h*f_C + T_B;
     }
-    // });
+  }
+  return min(T_A+b*f_C, T_B+a*f_C);
+}
 
-  for (auto i : Range(rhsvals.size()))
+bool EikonalSolver2D::sweep(const DistByPnt &distByPnt, int step, FlatVector<double> res, const vector<double> &rhsvals) const
+{
+  bool again = false;
+  int start, end;
+  if (step == 1)
   {
-    rhsvals[i] /= ma->GetVertexElements(i).Size();
-    // cout << rhsvals[i] << endl;
+    start = 0;
+    end = distByPnt.size();
+  } else {
+    start = distByPnt.size()-1;
+    end = -1;
   }
+  for (auto l=start; l != end; l += step)
+  {
+    const auto this_vert = distByPnt[l];
+    auto els = ma->GetVertexElements(this_vert);
+    for (const auto &elnr : els)
+    {
+      auto T_C_old = res[this_vert];
+      auto &T_C = res[this_vert];
+      T_C = min(T_C, updateFromElement(this_vert, elnr, res, rhsvals));
+      if (abs(T_C-T_C_old)>1e-5) again = true;
+
+      // nodal_gf->SetElementVector(Array<int>({this_vert}), Vector<double>({T_C}));
+      // Ng_Redraw();
+      // cout << "done " << this_vert << endl;
+      // cin.ignore();
+
+    } // for element
+  } // for vertex
+  return again;
+}
+
+void EikonalSolver2D::solve(shared_ptr<CoefficientFunction> rhs)
+{
+  Vector<double> res(ma->GetNV());
+  res = numeric_limits<double>::max(); //                            ok?
+  for (auto v : boundaryVertices(*ma)) res[v] = 0;
+
+  auto rhsvals = vertexAverages(*ma, rhs, ET_TRIG);
 
   bool again;
   do
@@ -125,87 +244,347 @@ void EikonalSolver2D::solve(shared_ptr<CoefficientFunction> rhs)
     {
       for (auto step : {1, -1})
       {
-        again = false;
-        int start, end;
-        if (step == 1)
-        {
-          start = 0;
-          end = distByPnt.size();
-        } else {
-          start = distByPnt.size()-1;
-          end = -1;
-        }
-        for (auto l=start; l != end; l += step)
-        {
-          HeapReset hr(glh);
-          const auto &this_vert = distByPnt[l].first;
-          auto els = ma->GetVertexElements(this_vert);
-          for (const auto &elnr : els)
-          {
-            auto el = ma->GetElement(ElementId(VOL, elnr));
-            auto verts = el.Vertices();
-            Vec<2> vert_cs[3];
-            for (int i : Range(3)) vert_cs[i] = ma->GetPoint<2>(verts[i]);
-            double lengths[3];
-            for (int i : Range(3))
-            {
-              Vec<2> e1 = vert_cs[(i+1)%3]-vert_cs[i];
-              Vec<2> e2 = vert_cs[(i+2)%3]-vert_cs[i];
-              lengths[i] = L2Norm(e1);
-            }
-            Array<int> sort_idxs(3, glh);
-            int C_idx;
-            for (auto i : Range(3))
-            {
-              if (verts[i] == this_vert)
-              {
-                C_idx = i;
-                break;
-              }
-            }
-            sort_idxs = Range(3);
-            sort_idxs.RemoveElement(C_idx);
-            if (res[verts[sort_idxs[0]]] > res[verts[sort_idxs[1]]])
-              swap(sort_idxs[0], sort_idxs[1]);
-
-            const auto &a = lengths[(sort_idxs[0]+1)%3];
-            const auto &b = lengths[(sort_idxs[1]+1)%3];
-            const auto &c = lengths[(C_idx+1)%3];
-            const auto &alpha = anglesByEl[el.Nr()][sort_idxs[0]];
-            const auto &beta = anglesByEl[el.Nr()][sort_idxs[1]];
-            const auto &T_A = res[verts[sort_idxs[0]]];
-            const auto &T_B = res[verts[sort_idxs[1]]];
-            const auto &f_C = rhsvals[this_vert];
-            auto T_C_old = res[this_vert];
-            auto &T_C = res[this_vert];
-
-            auto sintheta = (T_B-T_A) / (c*f_C);
-            if (sintheta <= 1)
-            {
-              auto theta = asin(sintheta);
-              if (max(0.0, alpha-M_PI/2) <= theta && theta <= M_PI/2 - beta)
-              {
-                auto h = a*sin(alpha-theta);
-                T_C = min(T_C, h*f_C + T_B);
-              } else {
-                T_C = min({T_C, T_A+b*f_C, T_B+a*f_C});
-              }
-            } else {
-              T_C = min({T_C, T_A+b*f_C, T_B+a*f_C});
-            }
-            if (abs(T_C-T_C_old)>1e-5) again = true;
-
-            // nodal_gf->SetElementVector(Array<int>({this_vert}), Vector<double>({T_C}));
-            // Ng_Redraw();
-            // cout << "done " << this_vert << endl;
-            // cin.ignore();
-
-          } // for element
-        } // for vertex
+        again = sweep(distByPnt, step, res, rhsvals);
         if (!again) break;
       } // for orientation
       if (!again) break;
     } // for reference point
   } while (again);
   nodal_gf->SetElementVector(Array<int>(Range(ma->GetNV())), res);
+  lastRhs = rhsvals;
+}
+
+void EikonalSolver2D::solveParallel(shared_ptr<CoefficientFunction> rhs)
+{
+  size_t nv = ma->GetNV();
+  Vector<double> res(nv);
+  res = numeric_limits<double>::max();
+  for (auto v : boundaryVertices(*ma)) res[v] = 0;
+
+  auto rhsvals = vertexAverages(*ma, rhs, ET_TRIG);
+
+  // both orientations of all reference points sweep private copies of res at the same time,
+  // which are combined by the pointwise minimum
+  size_t numOrderings = 2*distByPntByRef.size();
+  vector<Vector<double>> copies(numOrderings, Vector<double>(nv));
+  bool again;
+  do
+  {
+    ParallelFor
+      (Range(numOrderings), [&] (size_t k)
+       {
+         copies[k] = res;
+         sweep(distByPntByRef[k/2], k%2 ? -1 : 1, copies[k], rhsvals);
+       });
+
+    atomic<bool> changed(false);
+    ParallelForRange
+      (Range(nv), [&] (IntRange r)
+       {
+         for (auto v : r)
+         {
+           double val = res[v];
+           for (auto &copy : copies)
+             val = min(val, copy[v]);
+           if (abs(val-res[v])>1e-5) changed = true;
+           res[v] = val;
+         }
+       });
+    again = changed;
+  } while (again);
+  nodal_gf->SetElementVector(Array<int>(Range(nv)), res);
+  lastRhs = rhsvals;
+}
+
+void EikonalSolver2D::solveFastMarching(shared_ptr<CoefficientFunction> rhs)
+{
+  // accepted values, the others are infinite for the triangle update
+  Vector<double> res(ma->GetNV());
+  res = numeric_limits<double>::max();
+  vector<double> tentative(ma->GetNV(), numeric_limits<double>::max());
+  vector<bool> accepted(ma->GetNV(), false);
+  auto rhsvals = vertexAverages(*ma, rhs, ET_TRIG);
+
+  // narrow band as a binary heap with lazy deletion of outdated entries
+  typedef pair<double, int> BandEntry;
+  priority_queue<BandEntry, vector<BandEntry>, greater<BandEntry>> band;
+  auto accept = [&] (int vert, double val)
+    {
+      accepted[vert] = true;
+      res[vert] = val;
+      for (auto elnr : ma->GetVertexElements(vert))
+        for (auto v : ma->GetElement(ElementId(VOL, elnr)).Vertices())
+        {
+          if (accepted[v]) continue;
+          auto val = updateFromElement(v, elnr, res, rhsvals);
+          if (val < tentative[v])
+          {
+            tentative[v] = val;
+            band.push(make_pair(val, v));
+          }
+        }
+    };
+
+  for (auto v : boundaryVertices(*ma))
+    if (!accepted[v]) accept(v, 0);
+  while (!band.empty())
+  {
+    auto entry = band.top();
+    band.pop();
+    if (accepted[entry.second] || entry.first > tentative[entry.second]) continue;
+    accept(entry.second, entry.first);
+  }
+  nodal_gf->SetElementVector(Array<int>(Range(ma->GetNV())), res);
+  lastRhs = rhsvals;
+}
+
+void EikonalSolver2D::update(shared_ptr<CoefficientFunction> rhs, const vector<int> &changed)
+{
+  if (lastRhs.size() != ma->GetNV())
+  {
+    solveFastMarching(rhs);
+    return;
+  }
+  LocalHeap glh(100000, "eikonal 2d lh");
+  for (auto v : changed)
+    lastRhs[v] = vertexRhsAt(rhs, v, glh);
+  repropagate(changed);
+}
+
+void EikonalSolver2D::update(shared_ptr<CoefficientFunction> rhs)
+{
+  if (lastRhs.size() != ma->GetNV())
+  {
+    solveFastMarching(rhs);
+    return;
+  }
+  auto rhsvals = vertexAverages(*ma, rhs, ET_TRIG);
+  vector<int> changed;
+  for (auto v : Range(rhsvals.size()))
+    if (rhsvals[v] != lastRhs[v]) changed.push_back(v);
+  lastRhs = rhsvals;
+  repropagate(changed);
+}
+
+void EikonalSolver2D::repropagate(const vector<int> &changed)
+{
+  size_t nv = ma->GetNV();
+  const double tol = 1e-10;
+  const double inf = numeric_limits<double>::max();
+  auto res = nodal_gf->GetVector().FVDouble();
+  vector<bool> bnd(nv, false);
+  for (auto v : boundaryVertices(*ma)) bnd[v] = true;
+  auto minFromElements = [&] (int vert)
+    {
+      double val = inf;
+      for (auto elnr : ma->GetVertexElements(vert))
+        val = min(val, updateFromElement(vert, elnr, res, lastRhs));
+      return val;
+    };
+  auto forNeighbours = [&] (int vert, const function<void(int)> &func)
+    {
+      for (auto elnr : ma->GetVertexElements(vert))
+        for (auto v : ma->GetElement(ElementId(VOL, elnr)).Vertices())
+          if (v != vert) func(v);
+    };
+  typedef pair<double, int> HeapEntry;
+
+  // raise: the changed vertices and all vertices whose value can't be reproduced without them
+  // are reset, in the order of the old values, such that the vertices a value was computed from
+  // (which have smaller values) are decided first
+  vector<bool> invalid(nv, false);
+  vector<double> old(nv);
+  priority_queue<HeapEntry, vector<HeapEntry>, greater<HeapEntry>> raise;
+  auto invalidate = [&] (int vert)
+    {
+      invalid[vert] = true;
+      old[vert] = res[vert];
+      res[vert] = inf;
+      raise.push(make_pair(old[vert], vert));
+    };
+  for (auto v : changed)
+    if (!bnd[v] && !invalid[v]) invalidate(v);
+  while (!raise.empty())
+  {
+    auto entry = raise.top();
+    raise.pop();
+    forNeighbours(entry.second, [&] (int w)
+      {
+        if (bnd[w] || invalid[w] || res[w] < entry.first) return;
+        if (minFromElements(w) > res[w] + tol*(1+res[w])) invalidate(w);
+      });
+  }
+
+  // lower: the reset vertices are recomputed like in fast marching, vertices whose value
+  // decreases are accepted again and passed on to their neighbours
+  vector<double> tentative(nv, inf);
+  priority_queue<HeapEntry, vector<HeapEntry>, greater<HeapEntry>> band;
+  auto relax = [&] (int w)
+    {
+      if (bnd[w]) return;
+      auto val = minFromElements(w);
+      if (val < res[w] - tol*(1+val) && val < tentative[w])
+      {
+        tentative[w] = val;
+        band.push(make_pair(val, w));
+      }
+    };
+  for (auto v : Range(nv))
+    if (invalid[v]) relax(v);
+  for (auto v : changed)
+    relax(v);
+  while (!band.empty())
+  {
+    auto entry = band.top();
+    band.pop();
+    auto v = entry.second;
+    if (entry.first > tentative[v]) continue;
+    tentative[v] = inf;
+    if (entry.first >= res[v]) continue;
+    res[v] = entry.first;
+    forNeighbours(v, relax);
+  }
+}
+
+// value at the origin of the plane wave with slowness f through the points e[i] with values T[i],
+// infinite if its characteristic doesn't pass through the simplex spanned by the points
+static double simplexUpdate(int n, const Vec<3> *e, const double *T, double f)
+{
+  double Q_mem[9], Qinv_mem[9];
+  FlatMatrix<> Q(n, n, Q_mem), Qinv(n, n, Qinv_mem);
+  for (int i : Range(n))
+    for (int j : Range(n))
+      Q(i, j) = InnerProduct(e[i], e[j]);
+  CalcInverse(Q, Qinv);
+  // quadratic equation for T from |gradient| = f, where the gradient g solves e[i]*g = T[i]-T
+  double a = 0, b = 0, c = -f*f;
+  for (int i : Range(n))
+    for (int j : Range(n))
+    {
+      a += Qinv(i, j);
+      b += Qinv(i, j) * T[j];
+      c += T[i] * Qinv(i, j) * T[j];
+    }
+  double disc = b*b - a*c;
+  if (disc < 0) return numeric_limits<double>::max();
+  double val = (b + sqrt(disc)) / a;
+  // g = sum_i mu_i e[i] has to point away from the simplex
+  for (int i : Range(n))
+  {
+    double mu = 0;
+    for (int j : Range(n))
+      mu += Qinv(i, j) * (T[j]-val);
+    if (mu > 1e-12) return numeric_limits<double>::max();
+  }
+  return val;
+}
+
+EikonalSolver3D::EikonalSolver3D(shared_ptr<FESpace> fes)
+  : ma(fes->GetMeshAccess())
+{
+  for (auto &&el : ma->Elements())
+    if (el.GetType() != ET_TET)
+      throw Exception("EikonalSolver3D cannot handle non-tet elements.");
+
+  nodal_fes = CreateFESpace("nodal", ma, Flags().SetFlag("order", 1));
+  nodal_gf = CreateGridFunction(nodal_fes, "Eikonal", Flags().SetFlag("novisual"));
+  nodal_gf->Update();
+}
+
+double EikonalSolver3D::updateFromElement(int this_vert, int elnr, FlatVector<double> res, const vector<double> &rhsvals) const
+{
+  auto verts = ma->GetElement(ElementId(VOL, elnr)).Vertices();
+  Vec<3> x = ma->GetPoint<3>(this_vert);
+  Vec<3> e[3];
+  double T[3];
+  int k = 0;
+  for (auto v : verts)
+  {
+    if (v == this_vert) continue;
+    e[k] = ma->GetPoint<3>(v) - x;
+    T[k] = res[v];
+    k++;
+  }
+
+  // the opposite face, its edges and its vertices, as far as their values are known
+  double best = numeric_limits<double>::max();
+  for (int subset = 1; subset < 8; subset++)
+  {
+    Vec<3> sub_e[3];
+    double sub_T[3];
+    int n = 0;
+    bool known = true;
+    for (int i : Range(3))
+    {
+      if (!(subset & (1 << i))) continue;
+      if (T[i] == numeric_limits<double>::max()) known = false;
+      sub_e[n] = e[i];
+      sub_T[n] = T[i];
+      n++;
+    }
+    if (known)
+      best = min(best, simplexUpdate(n, sub_e, sub_T, rhsvals[this_vert]));
+  }
+  return best;
+}
+
+void EikonalSolver3D::solve(shared_ptr<CoefficientFunction> rhs)
+{
+  size_t nv = ma->GetNV();
+  const double tol = 1e-10;
+  Vector<double> res(nv);
+  res = numeric_limits<double>::max();
+  vector<bool> bnd(nv, false);
+  for (auto v : boundaryVertices(*ma))
+  {
+    res[v] = 0;
+    bnd[v] = true;
+  }
+
+  auto rhsvals = vertexAverages(*ma, rhs, ET_TET);
+
+  // the vertices next to changed ones form the band of the next round
+  vector<int> band, next_band;
+  vector<size_t> in_band(nv, 0);
+  size_t round = 1;
+  auto addNeighbours = [&] (int vert)
+    {
+      for (auto elnr : ma->GetVertexElements(vert))
+        for (auto v : ma->GetElement(ElementId(VOL, elnr)).Vertices())
+          if (!bnd[v] && in_band[v] != round)
+          {
+            in_band[v] = round;
+            next_band.push_back(v);
+          }
+    };
+  for (auto v : Range(nv))
+    if (bnd[v]) addNeighbours(v);
+  swap(band, next_band);
+
+  vector<double> vals;
+  while (!band.empty())
+  {
+    // Jacobi update of the band, the new values are written after all of them are computed
+    vals.resize(band.size());
+    ParallelFor
+      (Range(band.size()), [&] (size_t k)
+       {
+         auto v = band[k];
+         double val = res[v];
+         for (auto elnr : ma->GetVertexElements(v))
+           val = min(val, updateFromElement(v, elnr, res, rhsvals));
+         vals[k] = val;
+       });
+
+    round++;
+    next_band.clear();
+    for (auto k : Range(band.size()))
+      if (vals[k] < res[band[k]] - tol*(1+vals[k]))
+      {
+        res[band[k]] = vals[k];
+        addNeighbours(band[k]);
+      }
+    swap(band, next_band);
+  }
+  nodal_gf->SetElementVector(Array<int>(Range(nv)), res);
 }
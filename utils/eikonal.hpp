@@ -1,18 +1,60 @@
 #include <comp.hpp>
 
+#include <numeric>
+#include <queue>
+
 void solveEikonal1D(shared_ptr<ngfem::CoefficientFunction> rhs, shared_ptr<ngcomp::GridFunction> res);
 
 class EikonalSolver2D
 {
-  typedef vector<pair<int, double>> DistByPnt;
+  // vertex numbers sorted by their distance to a reference point
+  typedef vector<int32_t> DistByPnt;
   shared_ptr<ngcomp::MeshAccess> ma;
   vector<DistByPnt> distByPntByRef;
   vector<array<double, 3>> anglesByEl;
   shared_ptr<ngcomp::FESpace> nodal_fes;
   shared_ptr<ngcomp::GridFunction> nodal_gf;
+  // vertex rhs of the last solution, for warm-started updates
+  vector<double> lastRhs;
+
+  // rhs averaged over the elements at vertex vert
+  double vertexRhsAt(shared_ptr<ngfem::CoefficientFunction>, int vert, LocalHeap &lh) const;
+  // value at vertex this_vert from the values res of the other two vertices of element elnr
+  double updateFromElement(int this_vert, int elnr, FlatVector<double> res, const vector<double> &rhsvals) const;
+  // recompute the solution after the rhs changed at the vertices changed
+  void repropagate(const vector<int> &changed);
+  // one Gauss-Seidel sweep over distByPnt in direction step, true if a value changed by more than 1e-5
+  bool sweep(const DistByPnt &distByPnt, int step, FlatVector<double> res, const vector<double> &rhsvals) const;
 
 public:
   EikonalSolver2D(shared_ptr<ngcomp::FESpace>, const vector<Vec<2>> &);
+  // Gauss-Seidel sweeps over the vertices ordered by their distance to the reference points
+  void solve(shared_ptr<ngfem::CoefficientFunction>);
+  // all sweeps of one iteration of solve at the same time on private copies, combined by their minimum
+  void solveParallel(shared_ptr<ngfem::CoefficientFunction>);
+  // single pass over the vertices in the order of their values (fast marching)
+  void solveFastMarching(shared_ptr<ngfem::CoefficientFunction>);
+  // warm start from the current solution: the vertices whose rhs changed and all vertices depending
+  // on them are recomputed, the cost is proportional to the size of this region
+  void update(shared_ptr<ngfem::CoefficientFunction>, const vector<int> &changed);
+  // compare the rhs at all vertices to find the changed ones
+  void update(shared_ptr<ngfem::CoefficientFunction>);
+  size_t getNV() const { return ma->GetNV(); }
+  shared_ptr<ngcomp::GridFunction> getSolutionGF() const { return nodal_gf; }
+};
+
+class EikonalSolver3D
+{
+  shared_ptr<ngcomp::MeshAccess> ma;
+  shared_ptr<ngcomp::FESpace> nodal_fes;
+  shared_ptr<ngcomp::GridFunction> nodal_gf;
+
+  // value at vertex this_vert from the values res of the other three vertices of tetrahedron elnr
+  double updateFromElement(int this_vert, int elnr, FlatVector<double> res, const vector<double> &rhsvals) const;
+
+public:
+  EikonalSolver3D(shared_ptr<ngcomp::FESpace>);
+  // the vertices of the band are updated in parallel until no value changes (fast iterative method)
   void solve(shared_ptr<ngfem::CoefficientFunction>);
   shared_ptr<ngcomp::GridFunction> getSolutionGF() const { return nodal_gf; }
 };
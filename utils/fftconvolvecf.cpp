@@ -0,0 +1,341 @@
+#include "fftconvolvecf.hpp"
+
+#include "utils.hpp"
+
+namespace ngfem
+{
+  // unnormalized FFT for sizes that are powers of two
+  static void FFTRadix2 (vector<complex<double>> & a, bool inverse)
+  {
+    size_t n = a.size();
+    for (size_t i = 1, j = 0; i < n; i++)
+    {
+      size_t bit = n >> 1;
+      for (; j & bit; bit >>= 1) j ^= bit;
+      j ^= bit;
+      if (i < j) swap(a[i], a[j]);
+    }
+    double sign = inverse ? 1 : -1;
+    for (size_t len = 2; len <= n; len <<= 1)
+    {
+      for (size_t j = 0; j < len/2; j++)
+      {
+        auto w = polar(1.0, sign*2*M_PI*j/len);
+        for (size_t i = 0; i < n; i += len)
+        {
+          auto u = a[i+j];
+          auto v = a[i+j+len/2]*w;
+          a[i+j] = u+v;
+          a[i+j+len/2] = u-v;
+        }
+      }
+    }
+  }
+
+  // unnormalized FFT for arbitrary sizes, uses Bluestein's algorithm for sizes
+  // which are not powers of two
+  static void FFTAnySize (vector<complex<double>> & a, bool inverse)
+  {
+    size_t n = a.size();
+    if (n <= 1) return;
+    if ((n & (n-1)) == 0)
+    {
+      FFTRadix2(a, inverse);
+      return;
+    }
+
+    size_t m = 1;
+    while (m < 2*n-1) m <<= 1;
+    double sign = inverse ? 1 : -1;
+    vector<complex<double>> chirp(n), A(m, 0.0), B(m, 0.0);
+    for (size_t k = 0; k < n; k++)
+      chirp[k] = polar(1.0, sign*M_PI*double((k*k) % (2*n))/n);
+    for (size_t k = 0; k < n; k++)
+      A[k] = a[k]*chirp[k];
+    B[0] = conj(chirp[0]);
+    for (size_t k = 1; k < n; k++)
+      B[k] = B[m-k] = conj(chirp[k]);
+
+    FFTRadix2(A, false);
+    FFTRadix2(B, false);
+    for (size_t i = 0; i < m; i++)
+      A[i] *= B[i];
+    FFTRadix2(A, true);
+
+    for (size_t k = 0; k < n; k++)
+      a[k] = chirp[k]*A[k]/double(m);
+  }
+
+  FFTConvolutionCoefficientFunction::FFTConvolutionCoefficientFunction (shared_ptr<CoefficientFunction> akernel,
+                                                                        shared_ptr<ngcomp::GridFunction> agf,
+                                                                        vector<int> agridShape, bool aperiodic)
+    : CoefficientFunction(1, false), kernel(akernel), gf(agf),
+      gfcf(make_shared<GridFunctionCoefficientFunction>(agf)),
+      ma(agf->GetFESpace()->GetMeshAccess()), periodic(aperiodic), dim(ma->GetDimension())
+  {
+    tracker.Track(*gf);
+    if (kernel->Dimension() != 1 || gf->GetFESpace()->GetDimension() != 1)
+      throw Exception("FFTConvolve needs scalar kernel and GridFunction");
+    if (dim > 3 || agridShape.size() != dim)
+      throw Exception("FFTConvolve: grid_shape needs one entry per space dimension");
+
+    // bounding box of the mesh
+    Vec<3> pmax;
+    pmin = numeric_limits<double>::max();
+    pmax = -numeric_limits<double>::max();
+    for (auto v : Range(ma->GetNV()))
+    {
+      Vec<3> p(0.0);
+      switch (dim)
+      {
+      case 1:
+        p(0) = ma->GetPoint<1>(v)(0);
+        break;
+      case 2:
+      {
+        auto q = ma->GetPoint<2>(v);
+        p(0) = q(0);
+        p(1) = q(1);
+        break;
+      }
+      case 3:
+        p = ma->GetPoint<3>(v);
+        break;
+      }
+      for (int d = 0; d < dim; d++)
+      {
+        pmin(d) = min(pmin(d), p(d));
+        pmax(d) = max(pmax(d), p(d));
+      }
+    }
+
+    for (int d = 0; d < 3; d++)
+    {
+      if (d >= dim)
+      {
+        gridShape(d) = fftShape(d) = 1;
+        pmin(d) = 0;
+        h(d) = 1;
+        continue;
+      }
+      gridShape(d) = agridShape[d];
+      if (gridShape(d) < 1)
+        throw Exception("FFTConvolve: grid_shape has to be positive");
+      h(d) = (pmax(d)-pmin(d))/gridShape(d);
+      if (periodic)
+        fftShape(d) = gridShape(d);
+      else
+      {
+        // zero-padding avoids wrap-around
+        fftShape(d) = 1;
+        while (fftShape(d) < 2*gridShape(d)-1) fftShape(d) *= 2;
+      }
+    }
+
+    size_t numSamples = gridShape(0)*gridShape(1)*gridShape(2);
+    size_t fftSize = fftShape(0)*fftShape(1)*fftShape(2);
+
+    // locate the cell centers once, the mesh doesn't change
+    // force mesh to build search tree, see ComposeCoefficientFunction
+    IntegrationPoint dummy;
+    ma->FindElementOfPoint(Vector<>({0, 0, 0}), dummy, true);
+    sampleEls.resize(numSamples);
+    sampleIPs.resize(numSamples);
+    Vector<> point(dim);
+    for (auto i : Range(numSamples))
+    {
+      Vec<3, int> idx(i % gridShape(0), (i / gridShape(0)) % gridShape(1), i / (gridShape(0)*gridShape(1)));
+      for (int d = 0; d < dim; d++)
+        point(d) = pmin(d) + (idx(d)+0.5)*h(d);
+      sampleEls[i] = ma->FindElementOfPoint(point, sampleIPs[i], false);
+    }
+
+    // kernel sampled at the offsets between the cell centers
+    LocalHeap lh(100000, "fftconvolve lh");
+    kernelHat.assign(fftSize, 0.0);
+    double cellVolume = 1;
+    for (int d = 0; d < dim; d++) cellVolume *= h(d);
+    FlatVector<> offset(dim, lh);
+    for (auto i : Range(fftSize))
+    {
+      HeapReset hr(lh);
+      Vec<3, int> idx(i % fftShape(0), (i / fftShape(0)) % fftShape(1), i / (fftShape(0)*fftShape(1)));
+      bool inRange = true;
+      for (int d = 0; d < dim; d++)
+      {
+        int k = idx(d);
+        if (periodic)
+        {
+          // minimum image
+          if (k > fftShape(d)/2) k -= fftShape(d);
+        }
+        else
+        {
+          if (k >= gridShape(d))
+          {
+            k -= fftShape(d);
+            if (k <= -gridShape(d)) inRange = false;
+          }
+        }
+        offset(d) = k*h(d);
+      }
+      if (inRange)
+        kernelHat[i] = cellVolume/fftSize * kernel->Evaluate(DummyMIPFromPoint(offset, lh));
+    }
+    FFT(kernelHat, false);
+
+    Update();
+  }
+
+  void FFTConvolutionCoefficientFunction::PrintReport (ostream & ost) const
+  {
+    ost << "FFTConvolve(";
+    kernel->PrintReport(ost);
+    ost << ", ";
+    gf->PrintReport(ost);
+    ost << ")";
+  }
+
+  void FFTConvolutionCoefficientFunction::TraverseTree (const function<void(CoefficientFunction&)> & func)
+  {
+    kernel->TraverseTree (func);
+    // such that trackers of enclosing coefficient functions find gf
+    gfcf->TraverseTree (func);
+    func(*this);
+  }
+
+  void FFTConvolutionCoefficientFunction::FFT (vector<complex<double>> & data, bool inverse) const
+  {
+    // one dimensional transforms along all axes
+    for (int axis = 0; axis < dim; axis++)
+    {
+      size_t n = fftShape(axis);
+      size_t stride = 1;
+      for (int d = 0; d < axis; d++) stride *= fftShape(d);
+      vector<complex<double>> line(n);
+      for (size_t base = 0; base < data.size(); base++)
+      {
+        if ((base / stride) % n != 0) continue;
+        for (size_t k = 0; k < n; k++)
+          line[k] = data[base + k*stride];
+        FFTAnySize(line, inverse);
+        for (size_t k = 0; k < n; k++)
+          data[base + k*stride] = line[k];
+      }
+    }
+  }
+
+  void FFTConvolutionCoefficientFunction::Update()
+  {
+    Convolve(true);
+    tracker.Changed();
+  }
+
+  void FFTConvolutionCoefficientFunction::Convolve (bool parallel) const
+  {
+    size_t numSamples = sampleEls.size();
+    vector<complex<double>> data(kernelHat.size(), 0.0);
+
+    // no tasks if called from Evaluate, TaskManager gets stuck on nested tasks
+    auto sample = [&] (IntRange r)
+      {
+        LocalHeap lh(100000, "fftconvolve update lh");
+        for (auto i : r)
+        {
+          if (sampleEls[i] == -1) continue;
+          HeapReset hr(lh);
+          Vec<3, int> idx(i % gridShape(0), (i / gridShape(0)) % gridShape(1), i / (gridShape(0)*gridShape(1)));
+          auto & trafo = ma->GetTrafo(ElementId(VOL, sampleEls[i]), lh);
+          data[GridIndex(idx, fftShape)] = gfcf->Evaluate(trafo(sampleIPs[i], lh));
+        }
+      };
+    if (parallel)
+      ParallelForRange (Range(numSamples), sample);
+    else
+      sample(Range(numSamples));
+
+    FFT(data, false);
+    for (size_t i = 0; i < data.size(); i++)
+      data[i] *= kernelHat[i];
+    FFT(data, true);
+
+    convVals.resize(numSamples);
+    for (auto i : Range(numSamples))
+    {
+      Vec<3, int> idx(i % gridShape(0), (i / gridShape(0)) % gridShape(1), i / (gridShape(0)*gridShape(1)));
+      convVals[i] = data[GridIndex(idx, fftShape)].real();
+    }
+  }
+
+  double FFTConvolutionCoefficientFunction::Interpolate (const Vec<3> & point) const
+  {
+    // multilinear interpolation between the cell centers
+    Vec<3, int> first(0);
+    Vec<3> w(0.0);
+    for (int d = 0; d < dim; d++)
+    {
+      double t = (point(d)-pmin(d))/h(d) - 0.5;
+      double fl = floor(t);
+      first(d) = int(fl);
+      w(d) = t - fl;
+    }
+
+    double res = 0;
+    for (int corner = 0; corner < (1 << dim); corner++)
+    {
+      Vec<3, int> idx(0);
+      double weight = 1;
+      for (int d = 0; d < dim; d++)
+      {
+        int bit = (corner >> d) & 1;
+        idx(d) = first(d) + bit;
+        weight *= bit ? w(d) : 1-w(d);
+        if (periodic)
+          idx(d) = ((idx(d) % gridShape(d)) + gridShape(d)) % gridShape(d);
+        else
+          idx(d) = min(max(idx(d), 0), gridShape(d)-1);
+      }
+      res += weight * convVals[GridIndex(idx, gridShape)];
+    }
+    return res;
+  }
+
+  double FFTConvolutionCoefficientFunction::Evaluate (const BaseMappedIntegrationPoint & ip) const
+  {
+    Vec<3> point(0.0);
+    for (int d = 0; d < dim; d++)
+      point(d) = ip.GetPoint()(d);
+    return Interpolate(point);
+  }
+
+  void FFTConvolutionCoefficientFunction::Evaluate (const BaseMappedIntegrationRule & ir,
+                                                     FlatMatrix<double> values) const
+  {
+    auto lock = tracker.Check([this] { Convolve(false); });
+    auto points = ir.GetPoints();
+    Vec<3> point(0.0);
+    for (auto i : Range(ir.Size()))
+    {
+      for (int d = 0; d < dim; d++)
+        point(d) = points(i, d);
+      values(i, 0) = Interpolate(point);
+    }
+  }
+
+  void FFTConvolutionCoefficientFunction::Evaluate (const SIMD_BaseMappedIntegrationRule & ir, BareSliceMatrix<SIMD<double>> values) const
+  {
+    auto lock = tracker.Check([this] { Convolve(false); });
+    auto points = ir.GetPoints();
+    for (auto i : Range(ir.Size()))
+    {
+      values(0, i) = SIMD<double>([&] (int m)
+                                  {
+                                    Vec<3> point(0.0);
+                                    for (int d = 0; d < dim; d++)
+                                      point(d) = points(i, d)[m];
+                                    return Interpolate(point);
+                                  });
+    }
+  }
+
+}
@@ -0,0 +1,68 @@
+#pragma once
+
+#include <comp.hpp>
+#include <python_ngstd.hpp>
+
+#include <complex>
+
+#include "gftracker.hpp"
+#include "utils.hpp"
+
+namespace ngfem
+{
+  // convolution of a GridFunction with a translation invariant kernel on a uniform grid
+  // the GridFunction is sampled in the cell centers of a grid covering the bounding box of the mesh,
+  // convolved using the FFT (periodic or zero-padded) and interpolated back multilinearly
+  // the kernel is evaluated at the offset x-y, like the kernel of ConvolveCF
+  class FFTConvolutionCoefficientFunction : public CoefficientFunction, public ElementRuleCache
+  {
+    shared_ptr<CoefficientFunction> kernel;
+    shared_ptr<ngcomp::GridFunction> gf;
+    shared_ptr<CoefficientFunction> gfcf;
+    shared_ptr<ngcomp::MeshAccess> ma;
+    bool periodic;
+    int dim;
+
+    // grid of sample points
+    Vec<3, int> gridShape;
+    Vec<3> pmin, h;
+    // size of the FFT, larger than gridShape if zero-padded
+    Vec<3, int> fftShape;
+
+    // element and local coordinates of the sample points, -1 if outside of the mesh
+    vector<int> sampleEls;
+    vector<IntegrationPoint> sampleIPs;
+
+    // fourier transform of the kernel, including the cell volume
+    vector<complex<double>> kernelHat;
+    // convolution in the sample points
+    mutable vector<double> convVals;
+    // the convolution is recomputed when gf changes
+    mutable GridFunctionTracker tracker;
+
+    size_t GridIndex (const Vec<3, int> & idx, const Vec<3, int> & shape) const
+    { return idx(0) + shape(0)*(idx(1) + shape(1)*idx(2)); }
+
+    void FFT (vector<complex<double>> & data, bool inverse) const;
+    double Interpolate (const Vec<3> & point) const;
+    // resample gf and recompute convVals
+    void Convolve (bool parallel) const;
+
+  public:
+    FFTConvolutionCoefficientFunction (shared_ptr<CoefficientFunction> akernel,
+                                       shared_ptr<ngcomp::GridFunction> agf,
+                                       vector<int> agridShape, bool aperiodic=false);
+    virtual ~FFTConvolutionCoefficientFunction () {}
+    ///
+    virtual double Evaluate (const BaseMappedIntegrationPoint & ip) const;
+    virtual void Evaluate (const BaseMappedIntegrationRule & ir,
+                           FlatMatrix<double> values) const;
+    virtual void Evaluate (const SIMD_BaseMappedIntegrationRule & ir, BareSliceMatrix<SIMD<double>> values) const;
+    virtual void TraverseTree (const function<void(CoefficientFunction&)> & func);
+    virtual void PrintReport (ostream & ost) const;
+    // resample gf and recompute the convolution, otherwise a change of gf is taken into account
+    // on the next use
+    void Update();
+  };
+
+}
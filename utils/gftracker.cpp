@@ -0,0 +1,119 @@
+#include "gftracker.hpp"
+
+#include <cstring>
+#include <set>
+
+namespace ngfem
+{
+  // all living trackers, for GridFunctionModified
+  static mutex trackersMutex;
+  static set<GridFunctionTracker*> trackers;
+
+  void GridFunctionModified (const ngcomp::GridFunction & gf)
+  {
+    lock_guard<mutex> guard(trackersMutex);
+    for (auto tracker : trackers)
+      tracker->Announce(gf);
+  }
+
+  GridFunctionTracker::GridFunctionTracker ()
+    : modified(false)
+  {
+    lock_guard<mutex> guard(trackersMutex);
+    trackers.insert(this);
+  }
+
+  GridFunctionTracker::~GridFunctionTracker ()
+  {
+    lock_guard<mutex> guard(trackersMutex);
+    trackers.erase(this);
+  }
+
+  void GridFunctionTracker::Track (CoefficientFunction & cf)
+  {
+    cf.TraverseTree
+      ([&] (CoefficientFunction & nodecf)
+       {
+         auto gfcf = dynamic_cast<ngcomp::GridFunctionCoefficientFunction*> (&nodecf);
+         if (gfcf)
+           Track(gfcf->GetGridFunction());
+       });
+  }
+
+  void GridFunctionTracker::Track (const ngcomp::GridFunction & gf)
+  {
+    unique_lock<shared_timed_mutex> writeLock(dataMutex);
+    for (const auto &tracked : gfs)
+      if (tracked.gf == &gf) return;
+    auto vec = gf.GetVector().FVDouble();
+    gfs.push_back(Tracked { &gf, vector<double>(&vec(0), &vec(0)+vec.Size()), false });
+  }
+
+  void GridFunctionTracker::Announce (const ngcomp::GridFunction & gf)
+  {
+    unique_lock<shared_timed_mutex> writeLock(dataMutex);
+    for (auto &tracked : gfs)
+      if (tracked.gf == &gf)
+      {
+        tracked.announced = true;
+        tracked.copy.clear();
+        modified = true;
+      }
+  }
+
+  bool GridFunctionTracker::Outdated () const
+  {
+    if (modified) return true;
+    for (const auto &tracked : gfs)
+    {
+      if (tracked.announced) continue;
+      auto vec = tracked.gf->GetVector().FVDouble();
+      if (vec.Size() != tracked.copy.size()
+          || memcmp(&vec(0), tracked.copy.data(), vec.Size()*sizeof(double)) != 0)
+        return true;
+    }
+    return false;
+  }
+
+  void GridFunctionTracker::Accept ()
+  {
+    for (auto &tracked : gfs)
+      if (!tracked.announced)
+      {
+        auto vec = tracked.gf->GetVector().FVDouble();
+        tracked.copy.assign(&vec(0), &vec(0)+vec.Size());
+      }
+    modified = false;
+  }
+
+  bool GridFunctionTracker::Changed ()
+  {
+    unique_lock<shared_timed_mutex> writeLock(dataMutex);
+    if (!Outdated()) return false;
+    Accept();
+    return true;
+  }
+
+  shared_lock<shared_timed_mutex> GridFunctionTracker::Check (const function<void()> & update)
+  {
+    if (Empty())
+      return shared_lock<shared_timed_mutex>();
+
+    shared_lock<shared_timed_mutex> readLock(dataMutex);
+    if (!Outdated())
+      return readLock;
+
+    readLock.unlock();
+    {
+      unique_lock<shared_timed_mutex> writeLock(dataMutex);
+      // another thread might have updated in the meantime
+      if (Outdated())
+      {
+        update();
+        Accept();
+      }
+    }
+    readLock.lock();
+    return readLock;
+  }
+}
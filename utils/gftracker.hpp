@@ -0,0 +1,50 @@
+#pragma once
+
+#include <comp.hpp>
+
+#include <atomic>
+#include <shared_mutex>
+
+namespace ngfem
+{
+  // optional fast path: announces that the coefficients of gf were changed, the trackers of gf
+  // update on their next check and stop comparing the coefficients of gf from then on
+  void GridFunctionModified (const ngcomp::GridFunction & gf);
+
+  // detects changes of the GridFunctions a coefficient function depends on, such that cached values
+  // are recomputed only if needed
+  // GridFunctions have no version counter, so each check compares the coefficient vectors with a
+  // copy taken at the last update (a memcmp of the vectors), unless changes of a GridFunction are
+  // announced by GridFunctionModified
+  class GridFunctionTracker
+  {
+    struct Tracked
+    {
+      const ngcomp::GridFunction * gf;
+      vector<double> copy;
+      // changes are announced by GridFunctionModified, the copy isn't used
+      bool announced;
+    };
+    vector<Tracked> gfs;
+    atomic<bool> modified;
+    shared_timed_mutex dataMutex;
+
+    bool Outdated () const;
+    void Accept ();
+
+  public:
+    GridFunctionTracker ();
+    ~GridFunctionTracker ();
+    // all GridFunctions in the tree of cf
+    void Track (CoefficientFunction & cf);
+    void Track (const ngcomp::GridFunction & gf);
+    bool Empty () const { return gfs.empty(); }
+    // called by GridFunctionModified
+    void Announce (const ngcomp::GridFunction & gf);
+    // true if the GridFunctions changed since the last check
+    bool Changed ();
+    // has to be called before cached values are used, update is called if the GridFunctions changed;
+    // the returned lock has to be held while the cached values are used
+    shared_lock<shared_timed_mutex> Check (const function<void()> & update);
+  };
+}
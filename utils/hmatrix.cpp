@@ -0,0 +1,281 @@
+#include "hmatrix.hpp"
+
+namespace ngfem
+{
+  ClusterTree::ClusterTree (const vector<pair<Vec<3>, Vec<3>>> & boxes, int aleafSize)
+    : leafSize(max(aleafSize, 1)), perm(boxes.size()), position(boxes.size())
+  {
+    for (auto i : Range(perm)) perm[i] = i;
+    Build(boxes, 0, boxes.size());
+    for (auto i : Range(perm)) position[perm[i]] = i;
+  }
+
+  int ClusterTree::Build (const vector<pair<Vec<3>, Vec<3>>> & boxes, int first, int last)
+  {
+    int nr = nodes.size();
+    nodes.emplace_back();
+    Vec<3> pmin(numeric_limits<double>::max()), pmax(-numeric_limits<double>::max());
+    Vec<3> cmin(numeric_limits<double>::max()), cmax(-numeric_limits<double>::max());
+    for (int i = first; i < last; i++)
+    {
+      const auto &box = boxes[perm[i]];
+      for (int j = 0; j < 3; j++)
+      {
+        pmin(j) = min(pmin(j), box.first(j));
+        pmax(j) = max(pmax(j), box.second(j));
+        double c = 0.5*(box.first(j)+box.second(j));
+        cmin(j) = min(cmin(j), c);
+        cmax(j) = max(cmax(j), c);
+      }
+    }
+    nodes[nr].first = first;
+    nodes[nr].last = last;
+    nodes[nr].pmin = pmin;
+    nodes[nr].pmax = pmax;
+    if (last-first <= leafSize) return nr;
+
+    int axis = 0;
+    for (int j = 1; j < 3; j++)
+      if (cmax(j)-cmin(j) > cmax(axis)-cmin(axis)) axis = j;
+    int mid = (first+last)/2;
+    nth_element(&perm[first], &perm[mid], &perm[0]+last, [&] (int a, int b)
+                {
+                  return boxes[a].first(axis)+boxes[a].second(axis) < boxes[b].first(axis)+boxes[b].second(axis);
+                });
+    // nodes might be reallocated by the recursive calls
+    int child0 = Build(boxes, first, mid);
+    int child1 = Build(boxes, mid, last);
+    nodes[nr].children[0] = child0;
+    nodes[nr].children[1] = child1;
+    return nr;
+  }
+
+  static double BoxDistance (const ClusterTree::Node & t, const ClusterTree::Node & s, const Vec<3> & offset)
+  {
+    double dist2 = 0;
+    for (int j = 0; j < 3; j++)
+    {
+      double d = max(max(t.pmin(j) - (s.pmax(j)+offset(j)), (s.pmin(j)+offset(j)) - t.pmax(j)), 0.0);
+      dist2 += d*d;
+    }
+    return sqrt(dist2);
+  }
+
+  HMatrix::HMatrix (shared_ptr<ClusterTree> atree, const HMatrixEntries & entries,
+                    double eps, double eta, const vector<Vec<3>> & offsets)
+    : tree(atree), rowOffsets(tree->perm.Size()+1), colOffsets(tree->perm.Size()+1)
+  {
+    rowOffsets[0] = colOffsets[0] = 0;
+    for (auto i : Range(tree->perm))
+    {
+      rowOffsets[i+1] = rowOffsets[i] + entries.NumRows(tree->perm[i]);
+      colOffsets[i+1] = colOffsets[i] + entries.NumCols(tree->perm[i]);
+    }
+
+    CollectBlocks(0, 0, eta, offsets);
+
+    ParallelForRange
+      (Range(blocks.size()), [&] (IntRange r)
+       {
+         LocalHeap lh(10000000, "hmatrix lh");
+         for (auto i : r)
+         {
+           HeapReset hr(lh);
+           if (blocks[i]->lowrank)
+             CalcACA(*blocks[i], entries, eps, lh);
+           else
+             CalcDense(*blocks[i], entries, lh);
+         }
+       });
+  }
+
+  void HMatrix::CollectBlocks (int t, int s, double eta, const vector<Vec<3>> & offsets)
+  {
+    const auto &tnode = tree->nodes[t];
+    const auto &snode = tree->nodes[s];
+    double dist = numeric_limits<double>::max();
+    for (const auto &offset : offsets)
+      dist = min(dist, BoxDistance(tnode, snode, offset));
+
+    bool admissible = dist > 0 && min(tnode.Diameter(), snode.Diameter()) <= eta*dist;
+    if (admissible || tnode.IsLeaf() || snode.IsLeaf())
+    {
+      auto block = make_unique<Block>();
+      block->t = t;
+      block->s = s;
+      block->lowrank = admissible;
+      blocks.push_back(move(block));
+      return;
+    }
+    for (auto tchild : tnode.children)
+      for (auto schild : snode.children)
+        CollectBlocks(tchild, schild, eta, offsets);
+  }
+
+  void HMatrix::GetBlockRow (const Block & block, const HMatrixEntries & entries, int row,
+                             FlatVector<double> vals, LocalHeap & lh) const
+  {
+    const auto &tnode = tree->nodes[block.t];
+    const auto &snode = tree->nodes[block.s];
+    size_t globalRow = rowOffsets[tnode.first] + row;
+    auto pos = upper_bound(&rowOffsets[0], &rowOffsets[0]+rowOffsets.Size(), globalRow) - &rowOffsets[0] - 1;
+    entries.GetRow(tree->perm[pos], globalRow - rowOffsets[pos],
+                   tree->perm.Range(snode.first, snode.last), vals, lh);
+  }
+
+  void HMatrix::CalcDense (Block & block, const HMatrixEntries & entries, LocalHeap & lh) const
+  {
+    const auto &tnode = tree->nodes[block.t];
+    const auto &snode = tree->nodes[block.s];
+    auto rowItems = tree->perm.Range(tnode.first, tnode.last);
+    size_t firstCol = colOffsets[snode.first];
+    block.dense.SetSize(rowOffsets[tnode.last]-rowOffsets[tnode.first], colOffsets[snode.last]-firstCol);
+    for (int pos = snode.first; pos < snode.last; pos++)
+    {
+      HeapReset hr(lh);
+      IntRange cols(colOffsets[pos]-firstCol, colOffsets[pos+1]-firstCol);
+      FlatMatrix<> vals(block.dense.Height(), cols.Size(), lh);
+      entries.GetCols(rowItems, tree->perm[pos], vals, lh);
+      block.dense.Cols(cols) = vals;
+    }
+  }
+
+  void HMatrix::CalcACA (Block & block, const HMatrixEntries & entries, double eps, LocalHeap & lh) const
+  {
+    const auto &tnode = tree->nodes[block.t];
+    const auto &snode = tree->nodes[block.s];
+    auto rowItems = tree->perm.Range(tnode.first, tnode.last);
+    size_t firstCol = colOffsets[snode.first];
+    size_t m = rowOffsets[tnode.last]-rowOffsets[tnode.first];
+    size_t n = colOffsets[snode.last]-firstCol;
+
+    vector<Vector<>> us, vs;
+    Array<bool> usedRow(m);
+    usedRow = false;
+    Vector<> row(n), col(m);
+    // columns are computed for all local columns of an item at once
+    int cachedPos = -1;
+    Matrix<> cachedCols;
+    double norm2 = 0;
+    size_t i = 0;
+
+    for (size_t k = 0; k < min(m, n); k++)
+    {
+      {
+        HeapReset hr(lh);
+        GetBlockRow(block, entries, i, row, lh);
+      }
+      for (auto l : Range(us.size()))
+        row -= us[l](i) * vs[l];
+      usedRow[i] = true;
+
+      size_t j = 0;
+      for (size_t c = 1; c < n; c++)
+        if (fabs(row(c)) > fabs(row(j))) j = c;
+      if (row(j) == 0)
+      {
+        // zero row, try the next unused one
+        while (i < m && usedRow[i]) i++;
+        if (i == m) break;
+        continue;
+      }
+      row /= row(j);
+
+      size_t globalCol = firstCol + j;
+      int pos = upper_bound(&colOffsets[0], &colOffsets[0]+colOffsets.Size(), globalCol) - &colOffsets[0] - 1;
+      if (pos != cachedPos)
+      {
+        HeapReset hr(lh);
+        cachedCols.SetSize(m, colOffsets[pos+1]-colOffsets[pos]);
+        FlatMatrix<> vals(m, cachedCols.Width(), lh);
+        entries.GetCols(rowItems, tree->perm[pos], vals, lh);
+        cachedCols = vals;
+        cachedPos = pos;
+      }
+      col = cachedCols.Col(globalCol - colOffsets[pos]);
+      for (auto l : Range(us.size()))
+        col -= vs[l](j) * us[l];
+
+      // update the estimate of the Frobenius norm of the approximation
+      double cross = 0;
+      for (auto l : Range(us.size()))
+        cross += InnerProduct(us[l], col) * InnerProduct(vs[l], row);
+      double normuv2 = L2Norm2(col) * L2Norm2(row);
+      norm2 += normuv2 + 2*cross;
+      us.push_back(col);
+      vs.push_back(row);
+      if (normuv2 <= eps*eps*norm2) break;
+
+      // next pivot row: largest entry of the new column
+      bool found = false;
+      for (size_t r = 0; r < m; r++)
+        if (!usedRow[r] && (!found || fabs(col(r)) > fabs(col(i))))
+        {
+          i = r;
+          found = true;
+        }
+      if (!found) break;
+    }
+
+    size_t rank = us.size();
+    if (rank*(m+n) >= m*n)
+    {
+      // low-rank form doesn't pay off
+      block.lowrank = false;
+      CalcDense(block, entries, lh);
+      return;
+    }
+
+    block.U.SetSize(m, rank);
+    block.V.SetSize(n, rank);
+    for (auto l : Range(rank))
+    {
+      block.U.Col(l) = us[l];
+      block.V.Col(l) = vs[l];
+    }
+  }
+
+  void HMatrix::Mult (FlatVector<double> x, FlatVector<double> y) const
+  {
+    y = 0;
+    Vector<> tmp;
+    for (const auto &block : blocks)
+    {
+      const auto &tnode = tree->nodes[block->t];
+      const auto &snode = tree->nodes[block->s];
+      IntRange rows(rowOffsets[tnode.first], rowOffsets[tnode.last]);
+      IntRange cols(colOffsets[snode.first], colOffsets[snode.last]);
+      if (block->lowrank)
+      {
+        if (block->U.Width() == 0) continue;
+        tmp.SetSize(block->V.Width());
+        tmp = Trans(block->V) * x.Range(cols);
+        y.Range(rows) += block->U * tmp;
+      }
+      else
+        y.Range(rows) += block->dense * x.Range(cols);
+    }
+  }
+
+  size_t HMatrix::NumLowRankBlocks () const
+  {
+    size_t cnt = 0;
+    for (const auto &block : blocks)
+      if (block->lowrank) cnt++;
+    return cnt;
+  }
+
+  size_t HMatrix::MemoryUsage () const
+  {
+    size_t entries = 0;
+    for (const auto &block : blocks)
+    {
+      if (block->lowrank)
+        entries += block->U.Height()*block->U.Width() + block->V.Height()*block->V.Width();
+      else
+        entries += block->dense.Height()*block->dense.Width();
+    }
+    return entries*sizeof(double);
+  }
+
+}
@@ -0,0 +1,93 @@
+#pragma once
+
+#include <bla.hpp>
+#include <comp.hpp>
+
+namespace ngfem
+{
+  // binary tree of clusters of items (elements), built by bisecting the bounding box of the
+  // item centroids along its longest axis
+  class ClusterTree
+  {
+  public:
+    struct Node
+    {
+      int first, last; // items perm[first, last)
+      Vec<3> pmin, pmax; // bounding box of the items' bounding boxes
+      int children[2] = {-1, -1};
+
+      bool IsLeaf() const { return children[0] == -1; }
+      int Size() const { return last-first; }
+      double Diameter() const { return L2Norm(pmax-pmin); }
+    };
+
+  private:
+    int leafSize;
+    int Build (const vector<pair<Vec<3>, Vec<3>>> & boxes, int first, int last);
+
+  public:
+    Array<int> perm; // tree position -> item
+    Array<int> position; // item -> tree position
+    vector<Node> nodes; // nodes[0] is the root
+
+    ClusterTree (const vector<pair<Vec<3>, Vec<3>>> & boxes, int aleafSize);
+  };
+
+  // entries of a matrix whose rows and columns are grouped by items
+  class HMatrixEntries
+  {
+  public:
+    virtual ~HMatrixEntries () {}
+    virtual int NumRows (int item) const = 0;
+    virtual int NumCols (int item) const = 0;
+    // local row 'row' of the item rowItem, columns of the items colItems
+    virtual void GetRow (int rowItem, int row, FlatArray<int> colItems,
+                         FlatVector<double> vals, LocalHeap & lh) const = 0;
+    // rows of the items rowItems, all columns of the item colItem
+    virtual void GetCols (FlatArray<int> rowItems, int colItem,
+                          FlatMatrix<double> vals, LocalHeap & lh) const = 0;
+  };
+
+  // hierarchical matrix, blocks of admissible cluster pairs are stored in low-rank form
+  // computed by adaptive cross approximation (ACA) with partial pivoting
+  // rows and columns are numbered in cluster tree order
+  class HMatrix
+  {
+    struct Block
+    {
+      int t, s; // row and column cluster
+      bool lowrank;
+      Matrix<> dense;
+      Matrix<> U, V; // block = U * Trans(V)
+    };
+
+    shared_ptr<ClusterTree> tree;
+    Array<size_t> rowOffsets, colOffsets;
+    vector<unique_ptr<Block>> blocks;
+
+    void CollectBlocks (int t, int s, double eta, const vector<Vec<3>> & offsets);
+    void GetBlockRow (const Block & block, const HMatrixEntries & entries, int row,
+                      FlatVector<double> vals, LocalHeap & lh) const;
+    void CalcDense (Block & block, const HMatrixEntries & entries, LocalHeap & lh) const;
+    void CalcACA (Block & block, const HMatrixEntries & entries, double eps, LocalHeap & lh) const;
+
+  public:
+    // offsets: translations of the column items which are also coupled to the row items (periodic copies)
+    HMatrix (shared_ptr<ClusterTree> atree, const HMatrixEntries & entries,
+             double eps, double eta, const vector<Vec<3>> & offsets = {Vec<3>(0.0)});
+
+    size_t Height () const { return rowOffsets.Last(); }
+    size_t Width () const { return colOffsets.Last(); }
+    IntRange RowRange (int item) const
+    { auto pos = tree->position[item]; return IntRange(rowOffsets[pos], rowOffsets[pos+1]); }
+    IntRange ColRange (int item) const
+    { auto pos = tree->position[item]; return IntRange(colOffsets[pos], colOffsets[pos+1]); }
+
+    void Mult (FlatVector<double> x, FlatVector<double> y) const;
+
+    size_t NumBlocks () const { return blocks.size(); }
+    size_t NumLowRankBlocks () const;
+    size_t MemoryUsage () const;
+  };
+
+}
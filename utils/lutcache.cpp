@@ -0,0 +1,168 @@
+#include "lutcache.hpp"
+
+#include <cstdio>
+#include <sys/stat.h>
+#ifndef WIN32
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <unistd.h>
+#else
+#include <process.h>
+#endif
+
+namespace ngfem
+{
+  void LUTHash::AddMesh (const ngcomp::MeshAccess & ma)
+  {
+    int dim = ma.GetDimension();
+    Add(dim);
+    Add(ma.GetNV());
+    Add(ma.GetNE());
+    for (auto v : Range(ma.GetNV()))
+      switch (dim)
+      {
+      case 1:
+        Add(ma.GetPoint<1>(v));
+        break;
+      case 2:
+        Add(ma.GetPoint<2>(v));
+        break;
+      case 3:
+        Add(ma.GetPoint<3>(v));
+        break;
+      }
+    for (auto i : Range(ma.GetNE()))
+    {
+      ElementId ei(VOL, i);
+      Add(ma.GetElType(ei));
+      for (auto v : ma.GetElement(ei).Vertices())
+        Add(v);
+    }
+  }
+
+  string LUTHash::Hex () const
+  {
+    char buf[17];
+    snprintf(buf, sizeof(buf), "%016llx", (unsigned long long)h);
+    return buf;
+  }
+
+  bool FileExists (const string & filename)
+  {
+    struct stat st;
+    return stat(filename.c_str(), &st) == 0;
+  }
+
+  MappedFile::MappedFile (const string & filename)
+    : data(nullptr), size(0), mapped(false)
+  {
+#ifndef WIN32
+    int fd = open(filename.c_str(), O_RDONLY);
+    if (fd < 0)
+      throw Exception("MappedFile: cannot open " + filename);
+    struct stat st;
+    fstat(fd, &st);
+    size = st.st_size;
+    if (size > 0)
+    {
+      // private mapping, pages are only read from the file when touched
+      void * ptr = mmap(nullptr, size, PROT_READ | PROT_WRITE, MAP_PRIVATE, fd, 0);
+      if (ptr != MAP_FAILED)
+      {
+        data = static_cast<char*>(ptr);
+        mapped = true;
+      }
+    }
+    close(fd);
+    if (mapped || size == 0) return;
+#endif
+    ifstream in(filename, ios::binary);
+    if (!in)
+      throw Exception("MappedFile: cannot open " + filename);
+    in.seekg(0, ios::end);
+    size = in.tellg();
+    in.seekg(0, ios::beg);
+    // aligned for SIMD types
+    data = static_cast<char*>(aligned_alloc(64, (size+63)/64*64));
+    in.read(data, size);
+  }
+
+  MappedFile::~MappedFile ()
+  {
+#ifndef WIN32
+    if (mapped)
+    {
+      munmap(data, size);
+      return;
+    }
+#endif
+    free(data);
+  }
+
+  LUTBudget::LUTBudget (size_t numEntries)
+    : maxBytes(0), hits(0), misses(0), evictions(0), residentBytes(0), clock(0),
+      lastUse(numEntries), bytes(numEntries)
+  {
+    for (auto i : Range(numEntries))
+    {
+      lastUse[i] = 0;
+      bytes[i] = 0;
+    }
+  }
+
+  void LUTBudget::Shrink (size_t keep, const function<bool(size_t)> & evict)
+  {
+    if (maxBytes == 0 || residentBytes <= maxBytes) return;
+    lock_guard<mutex> guard(evictMutex);
+    // another thread might have shrunk in the meantime
+    if (residentBytes <= maxBytes) return;
+    Array<pair<size_t, size_t>> candidates; // (last use, entry)
+    for (auto i : Range(bytes.size()))
+      if (bytes[i] > 0 && i != keep)
+        candidates.Append(make_pair(size_t(lastUse[i]), size_t(i)));
+    QuickSort(candidates);
+    // evict down to the low-water mark, such that the scan is only repeated after
+    // a tenth of the budget has been filled again
+    size_t lowWater = maxBytes - maxBytes/10;
+    for (const auto &candidate : candidates)
+    {
+      if (residentBytes <= lowWater) break;
+      // entries which are in use are skipped
+      evict(candidate.second);
+    }
+  }
+
+  static int ProcessId ()
+  {
+#ifndef WIN32
+    return getpid();
+#else
+    return _getpid();
+#endif
+  }
+
+  LUTWriter::LUTWriter (const string & afilename)
+    : filename(afilename), tmpname(afilename + "." + to_string(ProcessId()) + ".tmp"),
+      out(tmpname, ios::binary)
+  {
+    if (!out)
+      throw Exception("LUTWriter: cannot write " + tmpname);
+  }
+
+  void LUTWriter::Close ()
+  {
+    out.close();
+    if (!out)
+    {
+      remove(tmpname.c_str());
+      throw Exception("LUTWriter: writing " + filename + " failed");
+    }
+    // other processes only ever see complete files
+    if (rename(tmpname.c_str(), filename.c_str()) != 0)
+    {
+      remove(tmpname.c_str());
+      throw Exception("LUTWriter: cannot rename " + tmpname);
+    }
+  }
+
+}
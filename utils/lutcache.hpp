@@ -0,0 +1,180 @@
+#pragma once
+
+#include <comp.hpp>
+
+#include <cstring>
+#include <fstream>
+
+namespace ngfem
+{
+  // 64 bit FNV-1a hash identifying lookup tables on disk
+  class LUTHash
+  {
+    uint64_t h = 14695981039346656037ULL;
+
+  public:
+    void Add (const void * data, size_t size)
+    {
+      auto bytes = static_cast<const unsigned char*>(data);
+      for (size_t i = 0; i < size; i++)
+      {
+        h ^= bytes[i];
+        h *= 1099511628211ULL;
+      }
+    }
+    template <typename T>
+    void Add (const T & val) { Add(&val, sizeof(T)); }
+    void Add (const string & str) { Add(str.data(), str.size()); }
+    void AddMesh (const ngcomp::MeshAccess & ma);
+    uint64_t Value () const { return h; }
+    string Hex () const;
+  };
+
+  // read-only view of a file, memory mapped where available
+  class MappedFile
+  {
+    char * data;
+    size_t size;
+    bool mapped;
+
+  public:
+    MappedFile (const string & filename);
+    ~MappedFile ();
+    char * Data () const { return data; }
+    size_t Size () const { return size; }
+  };
+
+  // arrays are aligned to 64 bytes, such that SIMD types can be used directly from the mapped file
+  class LUTWriter
+  {
+    string filename;
+    // unique per process, such that processes building the same table don't write into the same file
+    string tmpname;
+    ofstream out;
+    size_t pos = 0;
+
+    void Align ()
+    {
+      while (pos % 64) { out.put(0); pos++; }
+    }
+
+  public:
+    LUTWriter (const string & afilename);
+    // the file is written to a temporary name and renamed when closed
+    void Close ();
+
+    void Write (uint64_t val)
+    {
+      out.write(reinterpret_cast<const char*>(&val), sizeof(val));
+      pos += sizeof(val);
+    }
+    template <typename T>
+    void WriteArray (FlatArray<T> a)
+    {
+      Align();
+      out.write(reinterpret_cast<const char*>(a.Addr(0)), a.Size()*sizeof(T));
+      pos += a.Size()*sizeof(T);
+    }
+  };
+
+  class LUTReader
+  {
+    shared_ptr<MappedFile> file;
+    size_t pos = 0;
+
+    void Check (size_t size) const
+    {
+      if (pos + size > file->Size())
+        throw Exception("LUTReader: lookup table file is truncated");
+    }
+
+  public:
+    LUTReader (shared_ptr<MappedFile> afile) : file(afile) {}
+
+    uint64_t Read ()
+    {
+      Check(sizeof(uint64_t));
+      uint64_t val;
+      memcpy(&val, file->Data()+pos, sizeof(val));
+      pos += sizeof(val);
+      return val;
+    }
+    // no copy, the returned array points into the file
+    template <typename T>
+    FlatArray<T> ReadArray (size_t n)
+    {
+      pos = (pos+63)/64*64;
+      Check(n*sizeof(T));
+      FlatArray<T> a(n, reinterpret_cast<T*>(file->Data()+pos));
+      pos += n*sizeof(T);
+      return a;
+    }
+  };
+
+  // single precision storage of lookup table values, a SCAL consists of sizeof(SCAL)/sizeof(double) floats
+  inline void FloatsToScalar (const float * p, double & val) { val = *p; }
+  inline void FloatsToScalar (const float * p, SIMD<double> & val)
+  {
+    val = SIMD<double>([p] (int i) { return double(p[i]); });
+  }
+
+  template <typename SCAL>
+  void ScalarsToFloats (FlatArray<SCAL> vals, Array<float> & floats)
+  {
+    auto src = reinterpret_cast<const double*>(vals.Addr(0));
+    floats.SetSize(vals.Size()*sizeof(SCAL)/sizeof(double));
+    for (size_t i = 0; i < floats.Size(); i++)
+      floats[i] = src[i];
+  }
+
+  // byte budget with least recently used eviction for lookup tables, the entries are numbered
+  // by the owner, e.g. one per element; memory mapped tables don't count as they can be paged out
+  class LUTBudget
+  {
+    size_t maxBytes; // 0: unlimited
+    atomic<size_t> hits, misses, evictions, residentBytes;
+    atomic<size_t> clock;
+    vector<atomic<size_t>> lastUse, bytes;
+    mutex evictMutex;
+
+  public:
+    LUTBudget (size_t numEntries);
+
+    void SetMaxBytes (size_t amaxBytes) { maxBytes = amaxBytes; }
+    size_t GetMaxBytes () const { return maxBytes; }
+
+    void Hit (size_t nr)
+    {
+      hits++;
+      lastUse[nr] = ++clock;
+    }
+    // has to be called while the entry is locked
+    void Added (size_t nr, size_t nbytes)
+    {
+      misses++;
+      bytes[nr] += nbytes;
+      residentBytes += nbytes;
+      lastUse[nr] = ++clock;
+    }
+    // has to be called while the entry is locked
+    void Removed (size_t nr)
+    {
+      residentBytes -= bytes[nr].exchange(0);
+      evictions++;
+    }
+    // if the budget is exceeded, evict the least recently used entries except keep until 90% of it are used
+    // evict(nr) has to free the entry and call Removed(nr), or return false if the entry is in use
+    void Shrink (size_t keep, const function<bool(size_t)> & evict);
+
+    size_t Hits () const { return hits; }
+    size_t Misses () const { return misses; }
+    size_t Evictions () const { return evictions; }
+    size_t ResidentBytes () const { return residentBytes; }
+  };
+
+  // the magic number at the beginning of each lookup table file
+  constexpr uint64_t LUT_FILE_MAGIC = 0x3130544c5553474eULL; // "NGSLUT01"
+
+  bool FileExists (const string & filename);
+
+}
@@ -2,6 +2,8 @@
 
 #include "utils.hpp"
 
+#include <iomanip>
+
 namespace ngfem
 {
 
@@ -35,15 +37,29 @@ namespace ngfem
 
 
   ParameterLinearFormCF::ParameterLinearFormCF (shared_ptr<CoefficientFunction> aintegrand,
-                                                shared_ptr<ngcomp::GridFunction> agf,
-                                                int aorder, int arepeat, vector<double> apatchSize)
-  : CoefficientFunction(aintegrand->Dimension(), aintegrand->IsComplex()),
-    integrand(aintegrand), gf(agf), order(aorder), repeat(arepeat), patchSize(apatchSize),
-    fes(gf->GetFESpace()), numPatches(1),
-    LUT(agf->GetFESpace()->GetMeshAccess()->GetNE()), SIMD_LUT(agf->GetFESpace()->GetMeshAccess()->GetNE())
+                                                vector<shared_ptr<ngcomp::GridFunction>> agfs,
+                                                int aorder, int arepeat, vector<double> apatchSize,
+                                                bool asparse, string cachedir, bool asinglePrecision, bool aminimumImage,
+                                                bool agradient, double asupportRadius)
+  : CoefficientFunction(agfs.size()*(agradient ? agfs.at(0)->GetFESpace()->GetSpacialDimension()+1 : 1),
+                        aintegrand->IsComplex()),
+    integrand(aintegrand), gfs(agfs), order(aorder), repeat(arepeat), patchSize(apatchSize), minimumImage(aminimumImage),
+    fes(agfs.at(0)->GetFESpace()), numPatches(1), sparse(asparse), supportRadius(asupportRadius), singlePrecision(asinglePrecision), hmatrixOrder(-1), hmatrixValuesValid(false),
+    incrementalTol(-1), generation(0),
+    LUT(fes->GetMeshAccess()->GetNE()), SIMD_LUT(fes->GetMeshAccess()->GetNE()),
+    budget(2*fes->GetMeshAccess()->GetNE())
   {
     if (integrand->Dimension() != 1)
       throw Exception ("ParameterLinearFormCF needs scalar-valued CoefficientFunction");
+    for (const auto &gf : gfs)
+    {
+      if (gf->GetFESpace() != fes)
+        throw Exception ("ParameterLinearFormCF: all GridFunctions have to belong to the same FESpace");
+      gfcfs.push_back(make_shared<ngcomp::GridFunctionCoefficientFunction>(gf));
+      tracker.Track(*gf);
+    }
+    // the tracker starts from the current coefficients
+    if (gfs.size() > 1) FillGFBlock();
     integrand->TraverseTree
       ([&] (CoefficientFunction & nodecf)
        {
@@ -53,8 +69,132 @@ namespace ngfem
        });
     if (proxies.Size() != 1)
       throw Exception ("ParameterLinearFormCF: the integrand has to contain exactly one proxy: the test function of gf's FESpace");
+    if (supportRadius < 0)
+      throw Exception ("ParameterLinearFormCF: the support radius has to be nonnegative");
+    if (supportRadius > 0 && !sparse)
+      throw Exception ("ParameterLinearFormCF: elements outside of the support are only skipped in sparse lookup tables");
+
+    int dim = fes->GetSpacialDimension();
+    if ((repeat > 0 || minimumImage) && patchSize.size() < dim)
+      throw Exception ("ParameterLinearFormCF: patchSize needs one entry per space dimension");
+    for (int j = 0; j < dim && (repeat > 0 || minimumImage); j++)
+    {
+      // with the minimum image convention, 0 marks an axis which is not periodic
+      if (patchSize[j] < 0 || (patchSize[j] == 0 && !minimumImage))
+        throw Exception ("ParameterLinearFormCF: patchSize has to be positive");
+    }
+    if (repeat > 0 && minimumImage)
+      throw Exception ("ParameterLinearFormCF: use either repeat or the minimum image convention");
+    // the minimum image of a point lies in the patch or one of its neighbours,
+    // these offsets are needed for the support and the admissibility of hmatrix blocks
+    int offsetRepeat = minimumImage ? 1 : repeat;
+    int numOffsets = 1;
+    for (int i = 0; i < dim; i++) numOffsets *= 2*offsetRepeat + 1;
+    if (!minimumImage) numPatches = numOffsets;
+
+    // same ordering of the patches as in T_MakePeriodicMIR
+    Vec<3, int> curPatchIdx(-offsetRepeat);
+    for (int patch = 0; patch < numOffsets; patch++)
+    {
+      Vec<3> offset(0.0);
+      for (int j = 0; j < dim; j++)
+        offset(j) = curPatchIdx(j)*patchSize[j];
+      patchOffsets.push_back(offset);
+      int i = 0;
+      for (; i < dim; i++)
+        if (curPatchIdx(i) != offsetRepeat) break;
+      if (i == dim) break;
+      curPatchIdx(i)++;
+      for (; i > 0; i--) curPatchIdx(i-1) = -offsetRepeat;
+    }
+
+    elBoxes = ElementBoundingBoxes(*fes->GetMeshAccess());
+    if (agradient)
+      stencil = GradientStencil(dim, 1e-5*BoxesDiameter(elBoxes));
+
+    if (!cachedir.empty())
+    {
+      LUTHash hash;
+      hash.Add(string("ParameterLF"));
+      hash.AddMesh(*fes->GetMeshAccess());
+      hash.Add(order);
+      hash.Add(repeat);
+      for (auto size : patchSize) hash.Add(size);
+      hash.Add(minimumImage);
+      hash.Add(stencil.Size());
+      hash.Add(sparse);
+      hash.Add(supportRadius);
+      hash.Add(singlePrecision);
+      hash.Add(SIMD<double>::Size());
+      // the constants of the kernel have to be distinguished to full precision
+      stringstream report;
+      report << setprecision(17);
+      integrand->PrintReport(report);
+      hash.Add(report.str());
+      hash.Add(fes->GetClassName());
+      hash.Add(fes->GetOrder());
+      hash.Add(fes->GetDimension());
+      hash.Add(fes->GetNDof());
+      lutKey = hash.Value();
+      cacheFile = cachedir + "/parameterlf_" + hash.Hex() + ".lut";
+      if (FileExists(cacheFile))
+        LoadLUT();
+    }
+  }
 
-    for (int i = 0; i < fes->GetSpacialDimension(); i++) numPatches *= 2*repeat + 1;
+  void ParameterLinearFormCF::SaveLUT () const
+  {
+    if (cacheFile.empty())
+      throw Exception("ParameterLinearFormCF::SaveLUT: no cachedir given");
+    LUTWriter out(cacheFile);
+    out.Write(LUT_FILE_MAGIC);
+    out.Write(lutKey);
+    out.Write(LUT.size());
+    for (auto &lutElEntry : LUT)
+    {
+      shared_lock<shared_timed_mutex> readLock(lutElEntry.second);
+      out.Write(lutElEntry.first.size());
+      for (const auto &table : lutElEntry.first)
+      {
+        out.Write(table.first);
+        table.second.Save(out);
+      }
+    }
+    for (auto &lutElEntry : SIMD_LUT)
+    {
+      shared_lock<shared_timed_mutex> readLock(lutElEntry.second);
+      out.Write(lutElEntry.first.size());
+      for (const auto &table : lutElEntry.first)
+      {
+        out.Write(table.first);
+        table.second.Save(out);
+      }
+    }
+    out.Close();
+  }
+
+  void ParameterLinearFormCF::LoadLUT ()
+  {
+    lutFile = make_shared<MappedFile>(cacheFile);
+    LUTReader in(lutFile);
+    if (in.Read() != LUT_FILE_MAGIC || in.Read() != lutKey || in.Read() != LUT.size())
+    {
+      cout << "ParameterLF: ignoring incompatible lookup table file " << cacheFile << endl;
+      lutFile = nullptr;
+      return;
+    }
+    for (auto &lutElEntry : LUT)
+    {
+      auto numTables = in.Read();
+      for (auto k : Range(numTables))
+        lutElEntry.first[in.Read()].Load(in);
+    }
+    for (auto &lutElEntry : SIMD_LUT)
+    {
+      auto numTables = in.Read();
+      for (auto k : Range(numTables))
+        lutElEntry.first[in.Read()].Load(in);
+    }
   }
 
   ParameterLinearFormCF::~ParameterLinearFormCF ()
@@ -64,209 +204,689 @@ namespace ngfem
   {
     ost << "ParameterLF(";
     integrand->PrintReport(ost);
-    ost << ", ";
-    gf->PrintReport(ost);
+    for (const auto &gf : gfs)
+    {
+      ost << ", ";
+      gf->PrintReport(ost);
+    }
     ost << ")";
   }
 
   void ParameterLinearFormCF::TraverseTree (const function<void(CoefficientFunction&)> & func)
   {
     integrand->TraverseTree (func);
+    for (const auto &gfcf : gfcfs)
+      gfcf->TraverseTree (func);
     func(*this);
   }
 
-  double ParameterLinearFormCF::Evaluate (const BaseMappedIntegrationPoint & ip) const
+  bool ParameterLinearFormCF::InSupport (size_t elnr, const Vec<3> & point) const
   {
-    throw Exception("ParameterLinearFormCF::Evaluate IP");
+    if (!sparse || supportRadius <= 0) return true;
+    const auto &box = elBoxes[elnr];
+    // CompactlySupportedKernel measures distances in the x-y plane
+    int dim = min(fes->GetSpacialDimension(), 2);
+    for (const auto &offset : patchOffsets)
+    {
+      // the integrand is evaluated at the shifted points x+offset
+      double dist2 = 0;
+      for (int l = 0; l < dim; l++)
+      {
+        double p = point(l) - offset(l);
+        double d = max(max(box.first(l) - p, p - box.second(l)), 0.0);
+        dist2 += d*d;
+      }
+      if (dist2 < supportRadius*supportRadius) return true;
+    }
+    return false;
   }
 
-  void ParameterLinearFormCF :: Evaluate (const BaseMappedIntegrationRule & ir,
-                                                FlatMatrix<double> values) const
+  void ParameterLinearFormCF::CalcElementRows (ElementId ei, FlatArray<Vec<3>> paramPoints,
+                                               FlatMatrix<double> elvecs, LocalHeap & lh) const
   {
-    // TODO: test test test
+    HeapReset hr(lh);
+    auto & trafo = fes->GetMeshAccess()->GetTrafo(ei, lh);
+    ParameterLFUserData ud;
+    ud.paramCoords.AssignMemory(fes->GetSpacialDimension(), lh);
+    const_cast<ElementTransformation&>(trafo).userdata = &ud;
+    IntegrationRule myIR(trafo.GetElementType(), order);
+    // IntegrationRule myIR(el.GetType(), 2*el.GetFE().Order());
+    //cout << "myIR " << myIR << endl << endl;
+    auto & myMIR = trafo(myIR, lh);
+    auto &periodicMIR = MakePeriodicMIR<BaseMappedIntegrationRule>(myMIR, lh);
 
-    auto &lutElEntry = LUT[ir.GetTransformation().GetElementNr()];
-    auto &irSizeMap = lutElEntry.first;
-    shared_lock<shared_timed_mutex> readLock(lutElEntry.second);
-    auto it = irSizeMap.find(ir.Size());
-    if (it == irSizeMap.end())
-    //if (1)
+    auto & fel = fes->GetFE(ei, lh);
+    FlatVector<double> elvec1(elvecs.Width(), lh);
+    for (auto j : Range(paramPoints))
     {
-      readLock.unlock();
-      unique_lock<shared_timed_mutex> writeLock(lutElEntry.second);
-      // check again?
-      auto lh = LocalHeap(100000, "parameterlf lh");
-      //cout << "~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~" << endl << endl << endl;
-      //cout << "ir " << ir.IR() << endl << endl;
-      // //cout << "cache miss " << ir.GetTransformation().GetElementNr() << " " << ir.Size() << endl;
-      it = irSizeMap.emplace(ir.Size(), Matrix<double>(ir.Size(), fes->GetNDof())).first;
-      it->second = 0;
-      auto points = ir.GetPoints();
-      //cout << "points " << points << endl << endl;
-      ParameterLFUserData ud;
-      ud.paramCoords.AssignMemory(fes->GetSpacialDimension(), lh);
-      // fes->IterateElements doesn't work if Evaluate was called inside a TaskManager task
-      // because TaskManager gets stuck on nested tasks
-      for (const auto &el : fes->Elements(VOL, lh))
+      HeapReset hr(lh);
+      elvecs.Row(j) = 0;
+      for (auto l : Range(fes->GetSpacialDimension()))
+        ud.paramCoords(l) = paramPoints[j](l);
+      //cout << "ud " << ud.paramCoords << endl << endl;
+      if (minimumImage)
+        ShiftToMinimumImage<BaseMappedIntegrationRule>(periodicMIR, myMIR, ud.paramCoords);
+
+      for (auto proxy : proxies)
       {
-        //cout << "element " << el << endl << endl;
-        auto & trafo = el.GetTrafo();
-        const_cast<ElementTransformation&>(trafo).userdata = &ud;
-        IntegrationRule myIR(el.GetType(), order);
-        // IntegrationRule myIR(el.GetType(), 2*el.GetFE().Order());
-        //cout << "fel order" << el.GetFE().Order() << endl << endl;
-        //cout << "myIR " << myIR << endl << endl;
-        auto & myMIR = trafo(myIR, lh);
-        const auto &periodicMIR = MakePeriodicMIR<BaseMappedIntegrationRule>(myMIR, lh);
-
-        auto & fel = el.GetFE();
-        int elvec_size = fel.GetNDof()*fes->GetDimension();
-        //cout << "elvec_size " << elvec_size << endl << endl;
-        FlatVector<double> elvec(elvec_size, lh);
-        FlatVector<double> elvec1(elvec_size, lh);
-        auto dnums = el.GetDofs();
-        //cout << "dnums " << dnums << endl << endl;
+        FlatMatrix<double> proxyvalues(myIR.Size(), proxy->Dimension(), lh);
+        proxyvalues = 0;
+        for (int k = 0; k < proxy->Dimension(); k++)
+        {
+          //cout << "k " << k << endl;
+          ud.testfunction = proxy;
+          ud.test_comp = k;
+
+          FlatMatrix<double> intVals(periodicMIR.Size(), 1, lh);
+
+          integrand->Evaluate(periodicMIR, intVals);
+          //cout << "intvals " << intVals << endl << endl;
+          for (int patch = 0; patch < numPatches; patch++)
+          {
+            for (size_t i = 0; i < myMIR.Size(); i++)
+            {
+              proxyvalues(i, k) += myMIR[i].GetWeight() * intVals(patch*myMIR.Size() + i, 0);
+              //cout << "i " << i << " weight " << myMIR[i].GetWeight() << " " << intVals(i, 0) << endl << endl;
+            }
+          }
+        }
+        //cout << "proxvals " << proxyvalues << endl << endl;
+
+        proxy->Evaluator()->ApplyTrans(fel, myMIR, proxyvalues, elvec1, lh);
+        //cout << "elv1 " << elvec1 << endl << endl;
+        elvecs.Row(j) += elvec1;
+      }
+      // fes->TransformVec(el, elvec, ngcomp::TRANSFORM_RHS);
+    }
+  }
+
+  class ParameterLFHMatrixEntries : public HMatrixEntries
+  {
+    const ParameterLinearFormCF & cf;
+    Array<size_t> firstPoint;
+    Array<Vec<3>> points;
+    Array<int> ndofs;
+
+  public:
+    ParameterLFHMatrixEntries (const ParameterLinearFormCF & acf, int order, LocalHeap & lh)
+      : cf(acf)
+    {
+      auto ma = cf.fes->GetMeshAccess();
+      firstPoint.SetSize(ma->GetNE()+1);
+      firstPoint[0] = 0;
+      ndofs.SetSize(ma->GetNE());
+      for (auto i : Range(ma->GetNE()))
+      {
+        HeapReset hr(lh);
+        ElementId ei(VOL, i);
+        auto & trafo = ma->GetTrafo(ei, lh);
+        IntegrationRule ir(trafo.GetElementType(), order);
+        auto & mir = trafo(ir, lh);
         for (auto j : Range(ir.Size()))
         {
+          Vec<3> p(0.0);
+          for (auto l : Range(cf.fes->GetSpacialDimension()))
+            p(l) = mir[j].GetPoint()(l);
+          points.Append(p);
+        }
+        firstPoint[i+1] = points.Size();
+        ndofs[i] = cf.fes->GetFE(ei, lh).GetNDof()*cf.fes->GetDimension();
+      }
+    }
+
+    virtual int NumRows (int item) const { return firstPoint[item+1]-firstPoint[item]; }
+    virtual int NumCols (int item) const { return ndofs[item]; }
+
+    virtual void GetRow (int rowItem, int row, FlatArray<int> colItems,
+                         FlatVector<double> vals, LocalHeap & lh) const
+    {
+      FlatArray<Vec<3>> paramPoints(1, lh);
+      paramPoints[0] = points[firstPoint[rowItem]+row];
+      size_t offset = 0;
+      for (auto item : colItems)
+      {
+        HeapReset hr(lh);
+        FlatMatrix<double> elvecs(1, ndofs[item], lh);
+        cf.CalcElementRows(ElementId(VOL, item), paramPoints, elvecs, lh);
+        vals.Range(offset, offset+ndofs[item]) = elvecs.Row(0);
+        offset += ndofs[item];
+      }
+    }
+
+    virtual void GetCols (FlatArray<int> rowItems, int colItem,
+                          FlatMatrix<double> vals, LocalHeap & lh) const
+    {
+      FlatArray<Vec<3>> paramPoints(vals.Height(), lh);
+      size_t cnt = 0;
+      for (auto item : rowItems)
+        for (auto j : Range(firstPoint[item], firstPoint[item+1]))
+          paramPoints[cnt++] = points[j];
+      cf.CalcElementRows(ElementId(VOL, colItem), paramPoints, vals, lh);
+    }
+  };
+
+  void ParameterLinearFormCF::Compress (int aorder, double eps, double eta, int leafSize)
+  {
+    if (stencil.Rows() > 1)
+      throw Exception("ParameterLinearFormCF::Compress: the gradient is only available with lookup tables");
+    LocalHeap lh(10000000, "parameterlf compress lh");
+    ParameterLFHMatrixEntries entries(*this, aorder, lh);
+    auto tree = make_shared<ClusterTree>(elBoxes, leafSize);
+    hmatrix = make_shared<HMatrix>(tree, entries, eps, eta, patchOffsets);
+    hmatrixOrder = aorder;
+    hmatrixValues.SetSize(hmatrix->Height(), gfs.size());
+    hmatrixValuesValid = false;
+  }
+
+  void ParameterLinearFormCF::Update ()
+  {
+    UpdateValues();
+    tracker.Changed();
+  }
+
+  void ParameterLinearFormCF::UpdateValues () const
+  {
+    if (gfs.size() > 1) FillGFBlock();
+    if (hmatrix) UpdateHMatrixValues();
+    if (incrementalTol >= 0) UpdateIncremental();
+  }
+
+  void ParameterLinearFormCF::SetIncremental (double tol)
+  {
+    incrementalTol = tol;
+    if (tol < 0) return;
+    if (gfs.size() > 1) FillGFBlock();
+    auto input = GFValues();
+    lastInput.SetSize(input.Height(), input.Width());
+    lastInput = input;
+    changedDofs.SetSize(0);
+    changedRows.SetSize(input.Height());
+    changedRows = -1;
+    changes.SetSize(0, input.Width());
+    // all results have to be recomputed
+    generation += 2;
+    tracker.Changed();
+  }
+
+  void ParameterLinearFormCF::UpdateIncremental () const
+  {
+    auto input = GFValues();
+    for (auto dof : changedDofs)
+      changedRows[dof] = -1;
+    changedDofs.SetSize(0);
+    for (auto i : Range(input.Height()))
+      for (auto c : Range(input.Width()))
+        if (fabs(input(i, c) - lastInput(i, c)) > incrementalTol)
+        {
+          changedRows[i] = changedDofs.Size();
+          changedDofs.Append(i);
+          break;
+        }
+    // smaller changes are not lost, they are taken into account once they add up to more than tol
+    changes.SetSize(changedDofs.Size(), input.Width());
+    for (auto k : Range(changedDofs))
+    {
+      changes.Row(k) = input.Row(changedDofs[k]) - lastInput.Row(changedDofs[k]);
+      lastInput.Row(changedDofs[k]) = input.Row(changedDofs[k]);
+    }
+    generation++;
+  }
+
+  template <typename SCAL, typename TY>
+  void ParameterLinearFormCF::IncrementalMult (const ParameterLFTable<SCAL> & table, TY && y) const
+  {
+    lock_guard<mutex> guard(table.resultMutex);
+    if (table.resultGeneration != generation)
+    {
+      // the sparse update only pays off if few dofs have changed
+      if (table.resultGeneration > 0 && table.resultGeneration+1 == generation
+          && 2*changedDofs.Size() < lastInput.Height())
+        table.MultAddColumns(changedDofs, changedRows, changes, table.result);
+      else
+      {
+        table.result.SetSize(table.height, lastInput.Width());
+        table.Mult(lastInput, table.result);
+      }
+      table.resultGeneration = generation;
+    }
+    y = table.result;
+  }
+
+  void ParameterLinearFormCF::UpdateHMatrixValues () const
+  {
+    Vector<> x(hmatrix->Width()), y(hmatrix->Height());
+    Array<int> dnums;
+    for (auto c : Range(gfs.size()))
+    {
+      auto gfvec = gfs[c]->GetVector().FVDouble();
+      for (auto i : Range(fes->GetMeshAccess()->GetNE()))
+      {
+        fes->GetDofNrs(ElementId(VOL, i), dnums);
+        auto cols = hmatrix->ColRange(i);
+        for (auto k : Range(dnums))
+          x(cols.First()+k) = dnums[k] != -1 ? gfvec(dnums[k]) : 0;
+      }
+      hmatrix->Mult(x, y);
+      hmatrixValues.Col(c) = y;
+    }
+    hmatrixValuesValid = true;
+  }
+
+  void ParameterLinearFormCF::FillGFBlock () const
+  {
+    // one row per dof, such that the lookup tables are applied to all GridFunctions at once
+    gfBlock.SetSize(fes->GetNDof(), gfs.size());
+    for (auto c : Range(gfs.size()))
+      gfBlock.Col(c) = gfs[c]->GetVector().FVDouble();
+  }
+
+  FlatMatrix<double> ParameterLinearFormCF::GFValues () const
+  {
+    if (gfs.size() == 1)
+    {
+      auto gfvec = gfs[0]->GetVector().FVDouble();
+      return FlatMatrix<double>(gfvec.Size(), 1, &gfvec(0));
+    }
+    return gfBlock;
+  }
+
+  void ParameterLinearFormCF::BuildTable (const BaseMappedIntegrationRule & ir,
+                                          ParameterLFTable<double> & table, LocalHeap & lh) const
+  {
+    vector<tuple<int, int, double>> triplets;
+    // one row per integration point and component of the value and gradient
+    size_t height = ir.Size()*stencil.Rows();
+    if (!sparse)
+      table.SetDense(height, fes->GetNDof());
+    auto dense = table.Dense();
+    auto points = ir.GetPoints();
+    //cout << "points " << points << endl << endl;
+    FlatArray<Vec<3>> paramPoints(ir.Size()*stencil.Size(), lh);
+    for (auto j : Range(ir.Size()))
+      for (auto s : Range(stencil.Size()))
+      {
+        auto &p = paramPoints[j*stencil.Size()+s];
+        p = 0;
+        for (auto l : Range(fes->GetSpacialDimension()))
+          p(l) = points(j, l) + stencil.Shift(s, l);
+      }
+    // fes->IterateElements doesn't work if Evaluate was called inside a TaskManager task
+    // because TaskManager gets stuck on nested tasks
+    for (const auto &el : fes->Elements(VOL, lh))
+    {
+      //cout << "element " << el << endl << endl;
+      HeapReset hr(lh);
+      FlatArray<int> rows(paramPoints.Size(), lh);
+      int cnt = 0;
+      for (auto j : Range(paramPoints))
+        if (InSupport(el.Nr(), paramPoints[j]))
+          rows[cnt++] = j;
+      if (cnt == 0) continue;
+
+      FlatArray<Vec<3>> elParamPoints(cnt, lh);
+      for (auto j : Range(cnt))
+        elParamPoints[j] = paramPoints[rows[j]];
+      FlatMatrix<double> elvecs(cnt, el.GetFE().GetNDof()*fes->GetDimension(), lh);
+      CalcElementRows(ElementId(VOL, el.Nr()), elParamPoints, elvecs, lh);
+
+      auto dnums = el.GetDofs();
+      //cout << "dnums " << dnums << endl << endl;
+      for (auto j : Range(cnt))
+      {
+        //cout << "elvec " << elvecs.Row(j) << endl << endl;
+        int s = rows[j] % stencil.Size();
+        int row = rows[j] / stencil.Size() * stencil.Rows() + stencil.Row(s);
+        for (int k = 0; k < dnums.Size(); k++)
+          if (dnums[k] != -1)
+          {
+            double val = stencil.Weight(s) * elvecs(j, k);
+            if (sparse)
+              triplets.emplace_back(row, dnums[k], val);
+            else
+              dense(row, dnums[k]) += val;
+          }
+      }
+    }
+    if (sparse)
+      table.SetFromTriplets(height, fes->GetNDof(), triplets);
+    //cout << "mat " << dense << endl << endl;
+  }
+
+  void ParameterLinearFormCF::BuildTable (const SIMD_BaseMappedIntegrationRule & ir,
+                                          ParameterLFTable<SIMD<double>> & table, LocalHeap & lh) const
+  {
+    vector<tuple<int, int, SIMD<double>>> triplets;
+    // one row per integration point and component of the value and gradient
+    size_t height = ir.Size()*stencil.Rows();
+    if (!sparse)
+      table.SetDense(height, fes->GetNDof());
+    auto dense = table.Dense();
+    auto points = ir.GetPoints();
+    constexpr auto simdSize = SIMD<IntegrationPoint>::Size();
+    FlatArray<Vec<3>> paramPoints(ir.Size()*simdSize*stencil.Size(), lh);
+    for (auto j : Range(ir.Size()))
+      for (auto m : Range(simdSize))
+        for (auto s : Range(stencil.Size()))
+        {
+          auto &p = paramPoints[(j*simdSize+m)*stencil.Size()+s];
+          p = 0;
+          for (auto l : Range(fes->GetSpacialDimension()))
+            p(l) = points(j, l)[m] + stencil.Shift(s, l);
+        }
+    ParameterLFUserData ud;
+    ud.paramCoords.AssignMemory(fes->GetSpacialDimension(), lh);
+    // fes->IterateElements doesn't work if Evaluate was called inside a TaskManager task
+    // because TaskManager gets stuck on nested tasks
+    for (const auto &el : fes->Elements(VOL, lh))
+    {
+      //cout << "element " << i << endl << endl;
+      HeapReset hr(lh);
+      FlatArray<bool> inSupport(paramPoints.Size(), lh);
+      bool anyInSupport = false;
+      for (auto j : Range(inSupport))
+      {
+        inSupport[j] = InSupport(el.Nr(), paramPoints[j]);
+        anyInSupport = anyInSupport || inSupport[j];
+      }
+      if (!anyInSupport) continue;
+
+      auto & trafo = el.GetTrafo();
+      const_cast<ElementTransformation&>(trafo).userdata = &ud;
+      SIMD_IntegrationRule myIR(el.GetType(), order);
+      //cout << "myIR " << myIR << endl << endl;
+      auto & myMIR = trafo(myIR, lh);
+      auto &periodicMIR = MakePeriodicMIR<SIMD_BaseMappedIntegrationRule>(myMIR, lh);
+
+      auto & fel = el.GetFE();
+      int elvec_size = fel.GetNDof()*fes->GetDimension();
+      FlatVector<double> elvec(elvec_size, lh);
+      auto dnums = el.GetDofs();
+      for (auto j : Range(ir.Size()))
+      {
+        for (auto m : Range(simdSize)) // not good
+        for (auto s : Range(stencil.Size()))
+        {
+          auto idx = (j*simdSize+m)*stencil.Size()+s;
+          if (!inSupport[idx]) continue;
           elvec = 0;
           for (auto l : Range(fes->GetSpacialDimension()))
-            ud.paramCoords(l) = points(j, l);
-          //cout << "ud " << ud.paramCoords << endl << endl;
+            ud.paramCoords(l) = paramPoints[idx](l);
+          if (minimumImage)
+            ShiftToMinimumImage<SIMD_BaseMappedIntegrationRule>(periodicMIR, myMIR, ud.paramCoords);
 
           for (auto proxy : proxies)
           {
-            FlatMatrix<double> proxyvalues(myIR.Size(), proxy->Dimension(), lh);
+            FlatMatrix<SIMD<double>> proxyvalues(proxy->Dimension(), myIR.Size(), lh);
             proxyvalues = 0;
             for (int k = 0; k < proxy->Dimension(); k++)
             {
-              //cout << "k " << k << endl;
               ud.testfunction = proxy;
               ud.test_comp = k;
 
-              FlatMatrix<double> intVals(periodicMIR.Size(), 1, lh);
+              FlatMatrix<SIMD<double>> intVals(1, periodicMIR.Size(), lh);
 
+              // integrand->Evaluate(periodicMIR, proxyvalues.Rows(k,k+1));
               integrand->Evaluate(periodicMIR, intVals);
-              //cout << "intvals " << intVals << endl << endl;
               for (int patch = 0; patch < numPatches; patch++)
               {
                 for (size_t i = 0; i < myMIR.Size(); i++)
                 {
-                  proxyvalues(i, k) += myMIR[i].GetWeight() * intVals(patch*myMIR.Size() + i, 0);
+                  proxyvalues(k, i) += myMIR[i].GetWeight() * intVals(0, patch*myMIR.Size() + i);
                   //cout << "i " << i << " weight " << myMIR[i].GetWeight() << " " << intVals(i, 0) << endl << endl;
                 }
               }
             }
-            //cout << "proxvals " << proxyvalues << endl << endl;
 
-            proxy->Evaluator()->ApplyTrans(fel, myMIR, proxyvalues, elvec1, lh);
-            //cout << "elv1 " << elvec1 << endl << endl;
-            elvec += elvec1;
+            proxy->Evaluator()->AddTrans(fel, myMIR, proxyvalues, elvec);
           }
 
-          //cout << "elvec " << elvec << endl << endl;
-          // fes->TransformVec(el, elvec, ngcomp::TRANSFORM_RHS);
+          fes->TransformVec(el, elvec, ngcomp::TRANSFORM_RHS);
+          int row = j*stencil.Rows() + stencil.Row(s);
+          double weight = stencil.Weight(s);
           for (int k = 0; k < dnums.Size(); k++)
             if (dnums[k] != -1)
-              it->second(j, dnums[k]) += elvec(k);
+            {
+              SIMD<double> val([k, m, weight, &elvec](int i) { return i==m ? weight*elvec(k) : 0; }); // yikes
+              if (sparse)
+                triplets.emplace_back(row, dnums[k], val);
+              else
+                dense(row, dnums[k]) += val;
+            }
         }
       }
-      //cout << "mat " << it->second << endl << endl;
-      //cout << "gf vec " << gf->GetVector().FVDouble() << endl << endl;
-      values = it->second * gf->GetVector().FVDouble();
-      //cout << "res " << values << endl << endl;
-    } else {
-      // cout << "mat " << it->second << endl << endl;
-      // cout << "gf vec " << gf->GetVector().FVDouble() << endl << endl;
-      values = it->second * gf->GetVector().FVDouble();
     }
+    if (sparse)
+      table.SetFromTriplets(height, fes->GetNDof(), triplets);
   }
 
-  void ParameterLinearFormCF :: Evaluate (const SIMD_BaseMappedIntegrationRule & ir, BareSliceMatrix<SIMD<double>> values) const
+  template <typename TIR, typename TLUTEntry>
+  void ParameterLinearFormCF::BuildMissingTable (const TIR & ir, TLUTEntry & lutElEntry, size_t nr, LocalHeap & lh) const
   {
-    // TODO: test test test
-    //cout << "                SIMD !!!!!!!!!!!!!!!" << endl << endl;
+    {
+      unique_lock<shared_timed_mutex> writeLock(lutElEntry.second);
+      // another thread might have built the table in the meantime
+      if (lutElEntry.first.find(ir.Size()) != lutElEntry.first.end()) return;
+      auto &table = lutElEntry.first[ir.Size()];
+      BuildTable(ir, table, lh);
+      if (singlePrecision) table.ToSingle();
+      budget.Added(nr, table.MemoryUsage());
+    }
+    budget.Shrink(nr, [this] (size_t i) { return EvictTables(i); });
+  }
 
-    auto &lutElEntry = SIMD_LUT[ir.GetTransformation().GetElementNr()];
+  template <typename TIR, typename TLUTEntry>
+  const typename TLUTEntry::first_type::mapped_type &
+  ParameterLinearFormCF::FindTable (const TIR & ir, TLUTEntry & lutElEntry, size_t nr,
+                                    shared_lock<shared_timed_mutex> & readLock) const
+  {
     auto &irSizeMap = lutElEntry.first;
-    shared_lock<shared_timed_mutex> readLock(lutElEntry.second);
+    readLock.lock();
     auto it = irSizeMap.find(ir.Size());
-    if (it == irSizeMap.end())
+    if (it != irSizeMap.end())
+      budget.Hit(nr);
+    // the table might be evicted by another thread before the read lock is taken again
+    while (it == irSizeMap.end())
     //if (1)
     {
       readLock.unlock();
-      unique_lock<shared_timed_mutex> writeLock(lutElEntry.second);
-      // check again?
       auto lh = LocalHeap(100000, "parameterlf lh");
-      //cout << ir.IR() << endl << endl;
-      //cout << ir << endl << endl;
-      // cout << "cache miss " << ir.GetTransformation().GetElementNr() << " " << ir.Size() << endl;
-      it = irSizeMap.emplace(ir.Size(), Matrix<SIMD<double>>(ir.Size(), fes->GetNDof())).first;
-      it->second = SIMD<double>(0);
-      auto points = ir.GetPoints();
-      ParameterLFUserData ud;
-      ud.paramCoords.AssignMemory(fes->GetSpacialDimension(), lh);
-      // fes->IterateElements doesn't work if Evaluate was called inside a TaskManager task
-      // because TaskManager gets stuck on nested tasks
-      for (const auto &el : fes->Elements(VOL, lh))
-      {
-        //cout << "element " << i << endl << endl;
-        auto & trafo = el.GetTrafo();
-        const_cast<ElementTransformation&>(trafo).userdata = &ud;
-        SIMD_IntegrationRule myIR(el.GetType(), order);
-        //cout << "myIR " << myIR << endl << endl;
-        auto & myMIR = trafo(myIR, lh);
-        const auto &periodicMIR = MakePeriodicMIR<SIMD_BaseMappedIntegrationRule>(myMIR, lh);
-
-        auto & fel = el.GetFE();
-        int elvec_size = fel.GetNDof()*fes->GetDimension();
-        FlatVector<double> elvec(elvec_size, lh);
-        auto dnums = el.GetDofs();
-        for (auto j : Range(ir.Size()))
-        {
-          for (auto m : Range(SIMD<IntegrationPoint>::Size())) // not good
-          {
-            elvec = 0;
-            for (auto l : Range(fes->GetSpacialDimension()))
-              ud.paramCoords(l) = points(j, l)[m];
+      BuildMissingTable(ir, lutElEntry, nr, lh);
+      readLock.lock();
+      it = irSizeMap.find(ir.Size());
+    }
+    return it->second;
+  }
 
-            for (auto proxy : proxies)
-            {
-              FlatMatrix<SIMD<double>> proxyvalues(proxy->Dimension(), myIR.Size(), lh);
-              proxyvalues = 0;
-              for (int k = 0; k < proxy->Dimension(); k++)
-              {
-                ud.testfunction = proxy;
-                ud.test_comp = k;
+  bool ParameterLinearFormCF::EvictTables (size_t nr) const
+  {
+    // the scalar tables are numbered first, then the SIMD tables
+    if (nr < LUT.size())
+    {
+      unique_lock<shared_timed_mutex> writeLock(LUT[nr].second, try_to_lock);
+      if (!writeLock.owns_lock()) return false;
+      LUT[nr].first.clear();
+      budget.Removed(nr);
+    }
+    else
+    {
+      unique_lock<shared_timed_mutex> writeLock(SIMD_LUT[nr-LUT.size()].second, try_to_lock);
+      if (!writeLock.owns_lock()) return false;
+      SIMD_LUT[nr-LUT.size()].first.clear();
+      budget.Removed(nr);
+    }
+    return true;
+  }
 
-                FlatMatrix<SIMD<double>> intVals(1, periodicMIR.Size(), lh);
+  void ParameterLinearFormCF::Prebuild (int aorder, VorB vb, bool simd)
+  {
+    if (vb != VOL)
+      throw Exception("ParameterLinearFormCF::Prebuild: lookup tables are only stored for volume elements");
+    auto ma = fes->GetMeshAccess();
+    // the tables of one element are independent of all others, so no nested tasks are needed
+    ParallelForRange
+      (Range(ma->GetNE()), [&] (IntRange r)
+       {
+         LocalHeap lh(10000000, "parameterlf prebuild lh");
+         for (auto i : r)
+         {
+           HeapReset hr(lh);
+           ElementId ei(VOL, i);
+           auto & trafo = ma->GetTrafo(ei, lh);
+           if (simd)
+           {
+             SIMD_IntegrationRule ir(trafo.GetElementType(), aorder);
+             BuildMissingTable(trafo(ir, lh), SIMD_LUT[i], LUT.size()+i, lh);
+           }
+           else
+           {
+             IntegrationRule ir(trafo.GetElementType(), aorder);
+             BuildMissingTable(trafo(ir, lh), LUT[i], i, lh);
+           }
+         }
+       });
+  }
 
-                // integrand->Evaluate(periodicMIR, proxyvalues.Rows(k,k+1));
-                integrand->Evaluate(periodicMIR, intVals);
-                for (int patch = 0; patch < numPatches; patch++)
-                {
-                  for (size_t i = 0; i < myMIR.Size(); i++)
-                  {
-                    proxyvalues(k, i) += myMIR[i].GetWeight() * intVals(0, patch*myMIR.Size() + i);
-                    //cout << "i " << i << " weight " << myMIR[i].GetWeight() << " " << intVals(i, 0) << endl << endl;
-                  }
-                }
-              }
+  double ParameterLinearFormCF::Evaluate (const BaseMappedIntegrationPoint & ip) const
+  {
+    throw Exception("ParameterLinearFormCF::Evaluate IP");
+  }
 
-              proxy->Evaluator()->AddTrans(fel, myMIR, proxyvalues, elvec);
-            }
+  void ParameterLinearFormCF :: Evaluate (const BaseMappedIntegrationRule & ir,
+                                                FlatMatrix<double> values) const
+  {
+    // TODO: test test test
 
-            fes->TransformVec(el, elvec, ngcomp::TRANSFORM_RHS);
-            for (int k = 0; k < dnums.Size(); k++)
-              if (dnums[k] != -1)
-                it->second(j, dnums[k]) += SIMD<double>([k, m, &elvec](int i) { return i==m ? elvec(k) : 0; }); // yikes
-          }
-        }
+    int elnr = ir.GetTransformation().GetElementNr();
+    shared_lock<shared_timed_mutex> valuesLock;
+    if (hmatrix || incrementalTol >= 0 || gfs.size() > 1)
+      valuesLock = tracker.Check([this] { UpdateValues(); });
+    if (hmatrix && hmatrix->RowRange(elnr).Size() == ir.Size())
+    {
+      if (!hmatrixValuesValid)
+      {
+        lock_guard<mutex> guard(hmatrixMutex);
+        if (!hmatrixValuesValid) UpdateHMatrixValues();
       }
-      values.AddSize(Dimension(), ir.Size()) = Trans(it->second * gf->GetVector().FVDouble());
+      values = hmatrixValues.Rows(hmatrix->RowRange(elnr));
+      return;
+    }
 
-    } else {
-      values.AddSize(Dimension(), ir.Size()) = Trans(it->second * gf->GetVector().FVDouble());
+    shared_lock<shared_timed_mutex> readLock(LUT[elnr].second, defer_lock);
+    const auto &table = FindTable(ir, LUT[elnr], elnr, readLock);
+    // cout << "gf vec " << gf->GetVector().FVDouble() << endl << endl;
+    if (stencil.Rows() == 1)
+    {
+      if (incrementalTol >= 0)
+        IncrementalMult(table, values);
+      else
+        table.Mult(GFValues(), values);
+      return;
     }
+    // the rows of one point are the value and the gradient
+    Matrix<> result(table.height, gfs.size());
+    if (incrementalTol >= 0)
+      IncrementalMult(table, result);
+    else
+      table.Mult(GFValues(), result);
+    for (auto j : Range(ir.Size()))
+      for (auto c : Range(gfs.size()))
+        for (auto d : Range(stencil.Rows()))
+          values(j, c*stencil.Rows()+d) = result(j*stencil.Rows()+d, c);
+    //cout << "res " << values << endl << endl;
+  }
+
+  void ParameterLinearFormCF :: Evaluate (const SIMD_BaseMappedIntegrationRule & ir, BareSliceMatrix<SIMD<double>> values) const
+  {
+    // TODO: test test test
+    //cout << "                SIMD !!!!!!!!!!!!!!!" << endl << endl;
+    if (hmatrix)
+      throw ExceptionNOSIMD("ParameterLinearFormCF: compressed lookup tables only support scalar evaluation");
+
+    int elnr = ir.GetTransformation().GetElementNr();
+    shared_lock<shared_timed_mutex> valuesLock;
+    if (incrementalTol >= 0 || gfs.size() > 1)
+      valuesLock = tracker.Check([this] { UpdateValues(); });
+    shared_lock<shared_timed_mutex> readLock(SIMD_LUT[elnr].second, defer_lock);
+    const auto &table = FindTable(ir, SIMD_LUT[elnr], LUT.size()+elnr, readLock);
+    Matrix<SIMD<double>> result(table.height, gfs.size());
+    if (incrementalTol >= 0)
+      IncrementalMult(table, result);
+    else
+      table.Mult(GFValues(), result);
+    // the rows of one point are the value and the gradient
+    for (auto j : Range(ir.Size()))
+      for (auto c : Range(gfs.size()))
+        for (auto d : Range(stencil.Rows()))
+          values(c*stencil.Rows()+d, j) = result(j*stencil.Rows()+d, c);
+  }
+
+  ParameterLFOperator::ParameterLFOperator (shared_ptr<ParameterLinearFormCF> acf, int aorder)
+    : cf(acf), order(aorder)
+  {
+    if (cf->stencil.Rows() > 1)
+      throw Exception("ParameterLFOperator: the operator needs a ParameterLF without gradient");
+  }
+
+  void ParameterLFOperator::Mult (const BaseVector & x, BaseVector & y) const
+  {
+    y = 0.0;
+    MultAdd(1, x, y);
+  }
+
+  void ParameterLFOperator::MultAdd (double s, const BaseVector & x, BaseVector & y) const
+  {
+    auto fes = cf->fes;
+    auto ma = fes->GetMeshAccess();
+    auto fx = x.FVDouble();
+    auto fy = y.FVDouble();
+
+    // the compressed tables are applied to all elements at once
+    bool useHMatrix = cf->hmatrix && cf->hmatrixOrder == order;
+    Vector<> hvals;
+    if (useHMatrix)
+    {
+      Vector<> hx(cf->hmatrix->Width());
+      hvals.SetSize(cf->hmatrix->Height());
+      Array<int> dnums;
+      for (auto i : Range(ma->GetNE()))
+      {
+        fes->GetDofNrs(ElementId(VOL, i), dnums);
+        auto cols = cf->hmatrix->ColRange(i);
+        for (auto k : Range(dnums))
+          hx(cols.First()+k) = dnums[k] != -1 ? fx(dnums[k]) : 0;
+      }
+      cf->hmatrix->Mult(hx, hvals);
+    }
+
+    LocalHeap glh(10000000, "parameterlf operator lh");
+    // the tables are built serially inside of the tasks, so there are no nested tasks
+    IterateElements
+      (*fes, VOL, glh, [&] (ngcomp::FESpace::Element el, LocalHeap & lh)
+       {
+         auto & trafo = el.GetTrafo();
+         IntegrationRule ir(el.GetType(), order);
+         auto & mir = trafo(ir, lh);
+         FlatMatrix<double> vals(ir.Size(), 1, lh);
+         if (useHMatrix)
+           vals.Col(0) = hvals.Range(cf->hmatrix->RowRange(el.Nr()));
+         else
+         {
+           auto &lutElEntry = cf->LUT[el.Nr()];
+           shared_lock<shared_timed_mutex> readLock(lutElEntry.second, defer_lock);
+           cf->FindTable(mir, lutElEntry, el.Nr(), readLock).Mult(FlatMatrix<double>(fx.Size(), 1, &fx(0)), vals);
+         }
+         for (auto j : Range(ir.Size()))
+           vals(j, 0) *= s * mir[j].GetWeight();
+
+         auto & fel = el.GetFE();
+         FlatVector<double> elvec(fel.GetNDof()*fes->GetDimension(), lh);
+         cf->proxies[0]->Evaluator()->ApplyTrans(fel, mir, vals, elvec, lh);
+         fes->TransformVec(el, elvec, ngcomp::TRANSFORM_RHS);
+         auto dnums = el.GetDofs();
+         for (auto k : Range(dnums))
+           if (dnums[k] != -1)
+             fy(dnums[k]) += elvec(k);
+       });
   }
 
 }
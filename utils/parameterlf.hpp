@@ -6,6 +6,12 @@
 
 #include <shared_mutex>
 
+#include "gftracker.hpp"
+#include "hmatrix.hpp"
+#include "lutcache.hpp"
+#include "spatialindex.hpp"
+#include "utils.hpp"
+
 namespace ngfem
 {
   class ParameterLFUserData : public ProxyUserData
@@ -28,6 +34,7 @@ namespace ngfem
     {
       values.AddSize(1, ir.Size()) = static_cast<ParameterLFUserData*>(ir.GetTransformation().userdata)->paramCoords[dir];
     }
+    virtual void PrintReport (ostream & ost) const { ost << "ParameterLFProxy(" << dir << ")"; }
   };
 
   // too slow in python:
@@ -37,40 +44,330 @@ namespace ngfem
 
   public:
     CompactlySupportedKernel(double aradius, double ascale);
+    double GetRadius() const { return radius; }
     virtual double Evaluate (const BaseMappedIntegrationPoint & ip) const;
     virtual void Evaluate (const SIMD_BaseMappedIntegrationRule & ir, BareSliceMatrix<SIMD<double>> values) const;
+    virtual void PrintReport (ostream & ost) const
+    { ost << "CompactlySupportedKernel(" << radius << ", " << scale << ")"; }
   };
 
 
-  class ParameterLinearFormCF : public CoefficientFunction
+  inline bool IsZeroEntry (double val) { return val == 0; }
+  inline bool IsZeroEntry (SIMD<double> val)
+  {
+    for (int i = 0; i < SIMD<double>::Size(); i++)
+      if (val[i] != 0) return false;
+    return true;
+  }
+
+  // lookup table of one element for one IntegrationRule size
+  // rows correspond to the integration points, columns to the dofs of gf
+  // stored either dense or in CSR format (only the nonzero entries of each row)
+  template <typename SCAL>
+  struct ParameterLFTable
+  {
+    bool sparse = false;
+    // values stored in single precision in vals32 instead of vals
+    bool single = false;
+    size_t height = 0, width = 0;
+    // views of the own arrays or of a memory mapped lookup table file
+    FlatArray<SCAL> vals; // dense: row major height x width
+    FlatArray<float> vals32;
+    FlatArray<size_t> firstInRow;
+    FlatArray<int> cols;
+    Array<SCAL> ownVals;
+    Array<float> ownVals32;
+    Array<size_t> ownFirstInRow;
+    Array<int> ownCols;
+
+    // incremental mode: result of the last evaluation and the generation of the input it belongs to
+    mutable Matrix<SCAL> result;
+    mutable size_t resultGeneration = 0;
+    mutable mutex resultMutex;
+
+    static constexpr size_t Lanes () { return sizeof(SCAL)/sizeof(double); }
+    size_t NumValues () const { return single ? vals32.Size()/Lanes() : vals.Size(); }
+    // k-th stored value, row major for dense tables
+    SCAL Get (size_t k) const
+    {
+      if (!single) return vals[k];
+      SCAL val;
+      FloatsToScalar(&vals32[k*Lanes()], val);
+      return val;
+    }
+
+    FlatMatrix<SCAL> Dense () const { return FlatMatrix<SCAL>(height, width, vals.Addr(0)); }
+
+    void SetDense (size_t aheight, size_t awidth)
+    {
+      sparse = false;
+      height = aheight;
+      width = awidth;
+      ownVals.SetSize(height*width);
+      ownVals = SCAL(0);
+      vals.Assign(ownVals);
+    }
+
+    void SetFromTriplets (size_t aheight, size_t awidth, vector<tuple<int, int, SCAL>> & triplets)
+    {
+      sparse = true;
+      height = aheight;
+      width = awidth;
+      sort(triplets.begin(), triplets.end(), [] (const auto &a, const auto &b)
+           { return make_pair(get<0>(a), get<1>(a)) < make_pair(get<0>(b), get<1>(b)); });
+      ownFirstInRow.SetSize(height+1);
+      ownFirstInRow[0] = 0;
+      ownCols.SetSize(0);
+      ownVals.SetSize(0);
+      size_t row = 0;
+      for (size_t k = 0; k < triplets.size(); )
+      {
+        int r = get<0>(triplets[k]);
+        int c = get<1>(triplets[k]);
+        SCAL sum(0);
+        for (; k < triplets.size() && get<0>(triplets[k]) == r && get<1>(triplets[k]) == c; k++)
+          sum += get<2>(triplets[k]);
+        if (IsZeroEntry(sum)) continue;
+        while (row < r) ownFirstInRow[++row] = ownCols.Size();
+        ownCols.Append(c);
+        ownVals.Append(sum);
+      }
+      while (row < height) ownFirstInRow[++row] = ownCols.Size();
+      firstInRow.Assign(ownFirstInRow);
+      cols.Assign(ownCols);
+      vals.Assign(ownVals);
+    }
+
+    // convert the values to single precision and free the double ones
+    void ToSingle ()
+    {
+      ScalarsToFloats(vals, ownVals32);
+      vals32.Assign(ownVals32);
+      ownVals.DeleteAll();
+      vals.Assign(ownVals);
+      single = true;
+    }
+
+    // y = table * x for a block of vectors x (one column per GridFunction)
+    template <typename TY>
+    void Mult (FlatMatrix<double> x, TY && y) const
+    {
+      if (!sparse && !single)
+      {
+        y = Dense() * x;
+        return;
+      }
+      // single precision values are converted to double before accumulating
+      for (size_t i = 0; i < height; i++)
+      {
+        for (size_t c = 0; c < x.Width(); c++)
+          y(i, c) = SCAL(0);
+        if (sparse)
+          for (size_t k = firstInRow[i]; k < firstInRow[i+1]; k++)
+          {
+            SCAL val = Get(k);
+            for (size_t c = 0; c < x.Width(); c++)
+              y(i, c) += val * x(cols[k], c);
+          }
+        else
+          for (size_t j = 0; j < width; j++)
+          {
+            SCAL val = Get(i*width+j);
+            for (size_t c = 0; c < x.Width(); c++)
+              y(i, c) += val * x(j, c);
+          }
+      }
+    }
+
+    // y += table * x restricted to the columns dofs, the k-th row of x belongs to dofs[k]
+    // xrows is the inverse map, -1 for the dofs not in dofs
+    template <typename TY>
+    void MultAddColumns (FlatArray<int> dofs, FlatArray<int> xrows, FlatMatrix<double> x, TY && y) const
+    {
+      if (sparse)
+      {
+        for (size_t i = 0; i < height; i++)
+          for (size_t k = firstInRow[i]; k < firstInRow[i+1]; k++)
+          {
+            int row = xrows[cols[k]];
+            if (row == -1) continue;
+            SCAL val = Get(k);
+            for (size_t c = 0; c < x.Width(); c++)
+              y(i, c) += val * x(row, c);
+          }
+        return;
+      }
+      for (size_t i = 0; i < height; i++)
+        for (size_t k = 0; k < dofs.Size(); k++)
+        {
+          SCAL val = Get(i*width+dofs[k]);
+          for (size_t c = 0; c < x.Width(); c++)
+            y(i, c) += val * x(k, c);
+        }
+    }
+
+    // memory owned by the table, not counting memory mapped files
+    size_t MemoryUsage () const
+    {
+      return ownVals.Size()*sizeof(SCAL) + ownVals32.Size()*sizeof(float)
+        + ownFirstInRow.Size()*sizeof(size_t) + ownCols.Size()*sizeof(int);
+    }
+
+    void Save (LUTWriter & out) const
+    {
+      out.Write(sparse);
+      out.Write(single);
+      out.Write(height);
+      out.Write(width);
+      out.Write(NumValues());
+      if (single)
+        out.WriteArray(vals32);
+      else
+        out.WriteArray(vals);
+      if (sparse)
+      {
+        out.WriteArray(firstInRow);
+        out.WriteArray(cols);
+      }
+    }
+
+    // the table keeps pointing into the file
+    void Load (LUTReader & in)
+    {
+      sparse = in.Read();
+      single = in.Read();
+      height = in.Read();
+      width = in.Read();
+      size_t nvals = in.Read();
+      if (single)
+        vals32.Assign(in.ReadArray<float>(nvals*Lanes()));
+      else
+        vals.Assign(in.ReadArray<SCAL>(nvals));
+      if (sparse)
+      {
+        firstInRow.Assign(in.ReadArray<size_t>(height+1));
+        cols.Assign(in.ReadArray<int>(nvals));
+      }
+    }
+  };
+
+  class ParameterLinearFormCF : public CoefficientFunction, public ElementRuleCache
   {
     shared_ptr<CoefficientFunction> integrand;
-    shared_ptr<ngcomp::GridFunction> gf;
+    // all GridFunctions share one FESpace and thus the lookup tables
+    vector<shared_ptr<ngcomp::GridFunction>> gfs;
+    // visited by TraverseTree, such that trackers of enclosing coefficient functions find gfs
+    vector<shared_ptr<CoefficientFunction>> gfcfs;
     int order, repeat;
     vector<double> patchSize;
+    // instead of repeating the patches, the integrand is evaluated once at the periodic image
+    // of each point closest to the parameter point (kernel support at most half of patchSize)
+    bool minimumImage;
+    // central differences for the gradient with respect to the parameter point,
+    // computed from the same lookup tables as the value
+    GradientStencil stencil;
 
     Array<ProxyFunction*> proxies;
     shared_ptr<ngcomp::FESpace> fes;
     int numPatches;
+    vector<Vec<3>> patchOffsets;
+
+    // sparse LUTs only store the nonzero entries
+    // if supportRadius > 0, the integrand vanishes for distances beyond it (in the x-y plane, as for
+    // CompactlySupportedKernel) and elements outside of it are skipped; this can't be derived from
+    // the integrand, as a kernel in a sum like 1+K doesn't bound its support
+    bool sparse;
+    double supportRadius;
+    // store the lookup tables in single precision
+    bool singlePrecision;
+    vector<BoundingBox> elBoxes;
 
     // lookup tables
     // ASSUMPTION: IntegrationRules given as input of Evaluate() during the lifetime
     // of this coefficient function can be uniquely identified by their Size() and the
     // corresponding element
-    mutable vector<pair<map<int, typename ngbla::Matrix<double>>, shared_timed_mutex>> LUT;
-    mutable vector<pair<map<int, typename ngbla::Matrix<SIMD<double>>>, shared_timed_mutex>> SIMD_LUT;
+    mutable vector<pair<map<int, ParameterLFTable<double>>, shared_timed_mutex>> LUT;
+    mutable vector<pair<map<int, ParameterLFTable<SIMD<double>>>, shared_timed_mutex>> SIMD_LUT;
+    // entries 0..NE-1 are the elements of LUT, NE..2*NE-1 the ones of SIMD_LUT
+    mutable LUTBudget budget;
+
+    // hierarchical matrix replacing the lookup tables for one fixed integration order
+    shared_ptr<HMatrix> hmatrix;
+    int hmatrixOrder;
+    mutable Matrix<> hmatrixValues;
+    mutable atomic<bool> hmatrixValuesValid;
+    mutable mutex hmatrixMutex;
+
+    // incremental mode (tol >= 0): the tables are applied to lastInput, Update() adds the dofs
+    // which changed by more than tol to lastInput, and the results of the last evaluation
+    // are updated with the columns of these dofs only
+    double incrementalTol;
+    mutable size_t generation;
+    mutable Matrix<> lastInput;
+    mutable Array<int> changedDofs;
+    mutable Array<int> changedRows;
+    mutable Matrix<> changes;
+    void UpdateIncremental () const;
+
+    // the compressed convolution resp. the changes in incremental mode are updated when gfs change
+    mutable GridFunctionTracker tracker;
+    void UpdateValues () const;
+    // y = table * lastInput, updated from the result of the last generation if possible
+    template <typename SCAL, typename TY>
+    void IncrementalMult (const ParameterLFTable<SCAL> & table, TY && y) const;
+
+    // persistent lookup tables, identified by a hash of the mesh, order, integrand and FESpace
+    string cacheFile;
+    uint64_t lutKey;
+    shared_ptr<MappedFile> lutFile;
+    void LoadLUT ();
+
+    bool InSupport (size_t elnr, const Vec<3> & point) const;
+    // rows of the lookup table for the given points, restricted to the dofs of one element
+    void CalcElementRows (ElementId ei, FlatArray<Vec<3>> paramPoints,
+                          FlatMatrix<double> elvecs, LocalHeap & lh) const;
+    void UpdateHMatrixValues () const;
+    // compute the lookup table for the points of ir
+    void BuildTable (const BaseMappedIntegrationRule & ir, ParameterLFTable<double> & table, LocalHeap & lh) const;
+    void BuildTable (const SIMD_BaseMappedIntegrationRule & ir, ParameterLFTable<SIMD<double>> & table, LocalHeap & lh) const;
+    // build the table for ir under the write lock of lutElEntry if it is missing, nr numbers the entry in budget
+    template <typename TIR, typename TLUTEntry>
+    void BuildMissingTable (const TIR & ir, TLUTEntry & lutElEntry, size_t nr, LocalHeap & lh) const;
+    bool EvictTables (size_t nr) const;
+    // the table for ir, built if it is missing; readLock is an unlocked lock of lutElEntry,
+    // it is locked on return and has to be held while the table is used
+    template <typename TIR, typename TLUTEntry>
+    const typename TLUTEntry::first_type::mapped_type &
+    FindTable (const TIR & ir, TLUTEntry & lutElEntry, size_t nr, shared_lock<shared_timed_mutex> & readLock) const;
+    // for more than one GridFunction, their coefficient vectors as columns, such that the lookup
+    // tables are applied to all of them at once; refreshed by UpdateValues when gfs change
+    mutable Matrix<> gfBlock;
+    void FillGFBlock () const;
+    // coefficient vectors of the GridFunctions as columns
+    FlatMatrix<double> GFValues () const;
+
+    friend class ParameterLFHMatrixEntries;
+    friend class ParameterLFOperator;
 
 
     template <class TRAITS>
     typename TRAITS::BMIR &T_MakePeriodicMIR(const typename TRAITS::BMIR &bmir, LocalHeap &lh) const;
     template <class BMIR>
     BMIR &MakePeriodicMIR(BMIR &bmir, LocalHeap &lh) const;
+    template <class TRAITS>
+    void T_ShiftToMinimumImage(typename TRAITS::BMIR &periodicMIR, const typename TRAITS::BMIR &bmir,
+                               FlatVector<double> paramCoords) const;
+    // move the points of periodicMIR (a copy of bmir) to their images closest to paramCoords
+    template <class BMIR>
+    void ShiftToMinimumImage(BMIR &periodicMIR, const BMIR &bmir, FlatVector<double> paramCoords) const;
 
 
   public:
     ParameterLinearFormCF (shared_ptr<CoefficientFunction> aintegrand,
-                           shared_ptr<ngcomp::GridFunction> agf,
-                           int aorder, int arepeat=0, vector<double> apatchSize={});
+                           vector<shared_ptr<ngcomp::GridFunction>> agfs,
+                           int aorder, int arepeat=0, vector<double> apatchSize={},
+                           bool asparse=false, string cachedir="", bool asinglePrecision=false,
+                           bool aminimumImage=false, bool agradient=false, double asupportRadius=0);
     virtual ~ParameterLinearFormCF ();
     ///
     virtual double Evaluate (const BaseMappedIntegrationPoint & ip) const;
@@ -79,6 +376,41 @@ namespace ngfem
     virtual void Evaluate (const SIMD_BaseMappedIntegrationRule & ir, BareSliceMatrix<SIMD<double>> values) const;
     virtual void TraverseTree (const function<void(CoefficientFunction&)> & func);
     virtual void PrintReport (ostream & ost) const;
+    // compress the lookup tables for IntegrationRules of the given order into a hierarchical matrix
+    void Compress (int aorder, double eps, double eta, int leafSize);
+    shared_ptr<HMatrix> GetHMatrix () const { return hmatrix; }
+    // recompute the compressed convolution resp. the changes in incremental mode now,
+    // otherwise a change of gf is taken into account on the next use
+    void Update ();
+    // tol < 0 switches incremental mode off
+    void SetIncremental (double tol);
+    // build the lookup tables for IntegrationRules of the given order on all elements in parallel
+    void Prebuild (int aorder, VorB vb=VOL, bool simd=false);
+    // write the lookup tables built so far to the cache directory
+    void SaveLUT () const;
+    const LUTBudget & GetBudget () const { return budget; }
+    void SetMaxLUTBytes (size_t maxBytes) { budget.SetMaxBytes(maxBytes); }
+  };
+
+  // the convolution as a linear operator on coefficient vectors of the FESpace of gf:
+  // y_i = \int phi_i(xPar) I(xPar) dxPar, where gf is replaced by x in I and phi_i are the test functions,
+  // integrated with IntegrationRules of the given order, using the lookup tables of cf
+  // (or the compressed ones, if they were compressed for this order)
+  class ParameterLFOperator : public ngla::BaseMatrix
+  {
+    shared_ptr<ParameterLinearFormCF> cf;
+    int order;
+
+  public:
+    ParameterLFOperator (shared_ptr<ParameterLinearFormCF> acf, int aorder);
+    virtual bool IsComplex () const { return false; }
+    virtual int VHeight () const { return cf->fes->GetNDof(); }
+    virtual int VWidth () const { return cf->fes->GetNDof(); }
+    virtual AutoVector CreateVector () const { return make_shared<ngla::VVector<double>>(VWidth()); }
+    virtual AutoVector CreateRowVector () const { return CreateVector(); }
+    virtual AutoVector CreateColVector () const { return CreateVector(); }
+    virtual void Mult (const BaseVector & x, BaseVector & y) const;
+    virtual void MultAdd (double s, const BaseVector & x, BaseVector & y) const;
   };
 
   template <class BMIR, int DIM> struct IntegrationTraits;
@@ -151,7 +483,8 @@ namespace ngfem
   BMIR &ParameterLinearFormCF::MakePeriodicMIR(
     BMIR &bmir, LocalHeap &lh) const
   {
-    if (repeat == 0) return bmir;
+    // in minimum image mode, the points are moved for each parameter point, so a copy is needed
+    if (repeat == 0 && !minimumImage) return bmir;
 
     switch (bmir.GetTransformation().SpaceDim())
     {
@@ -166,5 +499,53 @@ namespace ngfem
     }
   }
 
+  // axes with period <= 0 are not periodic
+  inline double MinimumImage (double p, double par, double period)
+  {
+    if (period <= 0) return p;
+    return p - period*round((p-par)/period);
+  }
+
+  inline SIMD<double> MinimumImage (SIMD<double> p, double par, double period)
+  {
+    return SIMD<double>([&] (int i) { return MinimumImage(p[i], par, period); });
+  }
+
+  template <class TRAITS>
+  void ParameterLinearFormCF::T_ShiftToMinimumImage(
+    typename TRAITS::BMIR &periodicMIR, const typename TRAITS::BMIR &bmir,
+    FlatVector<double> paramCoords) const
+  {
+    auto &res = static_cast<typename TRAITS::MIR&>(periodicMIR);
+    Vec<TRAITS::dim, typename TRAITS::SCAL> newPoint;
+    for (int i = 0; i < bmir.Size(); i++)
+    {
+      newPoint = bmir[i].GetPoint();
+      for (int j = 0; j < TRAITS::dim; j++)
+        newPoint(j) = MinimumImage(newPoint(j), paramCoords(j), patchSize[j]);
+      res[i].Point() = newPoint;
+    }
+  }
+
+  template <class BMIR>
+  void ParameterLinearFormCF::ShiftToMinimumImage(
+    BMIR &periodicMIR, const BMIR &bmir, FlatVector<double> paramCoords) const
+  {
+    switch (bmir.GetTransformation().SpaceDim())
+    {
+    case 1:
+      T_ShiftToMinimumImage<IntegrationTraits<BMIR, 1>>(periodicMIR, bmir, paramCoords);
+      break;
+    case 2:
+      T_ShiftToMinimumImage<IntegrationTraits<BMIR, 2>>(periodicMIR, bmir, paramCoords);
+      break;
+    case 3:
+      T_ShiftToMinimumImage<IntegrationTraits<BMIR, 3>>(periodicMIR, bmir, paramCoords);
+      break;
+    default:
+      throw Exception("ParameterLinearFormCF::ShiftToMinimumImage invalid SpaceDim");
+    }
+  }
+
 
 }
@@ -0,0 +1,74 @@
+#include "separablekernel.hpp"
+
+#include "utils.hpp"
+
+namespace ngfem
+{
+  SeparableKernelCoefficientFunction::SeparableKernelCoefficientFunction (shared_ptr<CoefficientFunction> akx,
+                                                                          shared_ptr<CoefficientFunction> aky)
+    : CoefficientFunction(1, false), kx(akx), ky(aky)
+  {
+    if (kx->Dimension() != 1 || ky->Dimension() != 1)
+      throw Exception("SeparableKernel needs scalar factors");
+  }
+
+  double SeparableKernelCoefficientFunction::Evaluate (const BaseMappedIntegrationPoint & ip) const
+  {
+    return kx->Evaluate(ip) * ky->Evaluate(ip);
+  }
+
+  void SeparableKernelCoefficientFunction::Evaluate (const BaseMappedIntegrationRule & ir,
+                                                     FlatMatrix<double> values) const
+  {
+    Matrix<> yvals(ir.Size(), 1);
+    kx->Evaluate(ir, values);
+    ky->Evaluate(ir, yvals);
+    for (auto i : Range(ir.Size()))
+      values(i, 0) *= yvals(i, 0);
+  }
+
+  void SeparableKernelCoefficientFunction::Evaluate (const SIMD_BaseMappedIntegrationRule & ir,
+                                                     BareSliceMatrix<SIMD<double>> values) const
+  {
+    Matrix<SIMD<double>> yvals(1, ir.Size());
+    kx->Evaluate(ir, values);
+    ky->Evaluate(ir, yvals);
+    for (auto i : Range(ir.Size()))
+      values(0, i) *= yvals(0, i);
+  }
+
+  double SeparableKernelCoefficientFunction::EvaluateX (double d, int dim, LocalHeap & lh) const
+  {
+    HeapReset hr(lh);
+    FlatVector<> point(dim, lh);
+    point = 0.0;
+    point(0) = d;
+    return kx->Evaluate(DummyMIPFromPoint(point, lh));
+  }
+
+  double SeparableKernelCoefficientFunction::EvaluateY (double d, int dim, LocalHeap & lh) const
+  {
+    HeapReset hr(lh);
+    FlatVector<> point(dim, lh);
+    point = 0.0;
+    point(1) = d;
+    return ky->Evaluate(DummyMIPFromPoint(point, lh));
+  }
+
+  void SeparableKernelCoefficientFunction::TraverseTree (const function<void(CoefficientFunction&)> & func)
+  {
+    kx->TraverseTree (func);
+    ky->TraverseTree (func);
+    func(*this);
+  }
+
+  void SeparableKernelCoefficientFunction::PrintReport (ostream & ost) const
+  {
+    ost << "Separable(";
+    kx->PrintReport(ost);
+    ost << ", ";
+    ky->PrintReport(ost);
+    ost << ")";
+  }
+
+}
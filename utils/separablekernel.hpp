@@ -0,0 +1,31 @@
+#pragma once
+
+#include <comp.hpp>
+#include <python_ngstd.hpp>
+
+namespace ngfem
+{
+  // kernel kx*ky, where kx only depends on x and ky only on y, e.g. the factors of a Gaussian
+  // it evaluates like the product kx*ky, but ConvolveCF uses the factorization to compute
+  // the convolution with two 1D passes if the integration points form a tensor product grid
+  class SeparableKernelCoefficientFunction : public CoefficientFunction
+  {
+    shared_ptr<CoefficientFunction> kx;
+    shared_ptr<CoefficientFunction> ky;
+  public:
+    SeparableKernelCoefficientFunction (shared_ptr<CoefficientFunction> akx,
+                                        shared_ptr<CoefficientFunction> aky);
+    virtual ~SeparableKernelCoefficientFunction () {}
+    ///
+    virtual double Evaluate (const BaseMappedIntegrationPoint & ip) const;
+    virtual void Evaluate (const BaseMappedIntegrationRule & ir,
+                           FlatMatrix<double> values) const;
+    virtual void Evaluate (const SIMD_BaseMappedIntegrationRule & ir, BareSliceMatrix<SIMD<double>> values) const;
+    virtual void TraverseTree (const function<void(CoefficientFunction&)> & func);
+    virtual void PrintReport (ostream & ost) const;
+    // the factors at the offset (d, 0) resp. (0, d) in space dimension dim
+    double EvaluateX (double d, int dim, LocalHeap & lh) const;
+    double EvaluateY (double d, int dim, LocalHeap & lh) const;
+  };
+
+}
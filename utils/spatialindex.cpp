@@ -0,0 +1,127 @@
+#include "spatialindex.hpp"
+
+namespace ngfem
+{
+  vector<BoundingBox> ElementBoundingBoxes (const ngcomp::MeshAccess & ma)
+  {
+    int dim = ma.GetDimension();
+    vector<BoundingBox> boxes(ma.GetNE());
+    for (auto i : Range(ma.GetNE()))
+    {
+      auto &box = boxes[i];
+      box.first = numeric_limits<double>::max();
+      box.second = -numeric_limits<double>::max();
+      for (auto v : ma.GetElement(ElementId(VOL, i)).Vertices())
+      {
+        Vec<3> p(0.0);
+        switch (dim)
+        {
+        case 1:
+          p(0) = ma.GetPoint<1>(v)(0);
+          break;
+        case 2:
+        {
+          auto q = ma.GetPoint<2>(v);
+          p(0) = q(0);
+          p(1) = q(1);
+          break;
+        }
+        case 3:
+          p = ma.GetPoint<3>(v);
+          break;
+        }
+        for (int j = 0; j < 3; j++)
+        {
+          box.first(j) = min(box.first(j), p(j));
+          box.second(j) = max(box.second(j), p(j));
+        }
+      }
+    }
+    return boxes;
+  }
+
+  double BoxesDiameter (const vector<BoundingBox> & boxes)
+  {
+    Vec<3> pmin(numeric_limits<double>::max()), pmax(-numeric_limits<double>::max());
+    for (const auto &box : boxes)
+      for (int j = 0; j < 3; j++)
+      {
+        pmin(j) = min(pmin(j), box.first(j));
+        pmax(j) = max(pmax(j), box.second(j));
+      }
+    return boxes.empty() ? 0 : L2Norm(pmax-pmin);
+  }
+
+  ElementBoxIndex::ElementBoxIndex (const vector<BoundingBox> & aboxes, double acellSize)
+    : boxes(aboxes), cellSize(acellSize)
+  {
+    if (cellSize <= 0)
+      throw Exception("ElementBoxIndex: cell size has to be positive");
+    Vec<3> pmax;
+    pmin = numeric_limits<double>::max();
+    pmax = -numeric_limits<double>::max();
+    for (const auto &box : boxes)
+      for (int j = 0; j < 3; j++)
+      {
+        pmin(j) = min(pmin(j), box.first(j));
+        pmax(j) = max(pmax(j), box.second(j));
+      }
+
+    // don't use much more buckets than elements
+    size_t maxCells = 4*boxes.size()+1;
+    while (true)
+    {
+      double total = 1;
+      for (int j = 0; j < 3; j++)
+        total *= max(ceil((pmax(j)-pmin(j))/cellSize), 1.0);
+      if (total <= maxCells) break;
+      cellSize *= 2;
+    }
+    for (int j = 0; j < 3; j++)
+      numCells(j) = max(int(ceil((pmax(j)-pmin(j))/cellSize)), 1);
+
+    cells.resize(numCells(0)*numCells(1)*numCells(2));
+    for (auto i : Range(boxes.size()))
+    {
+      const auto &box = boxes[i];
+      for (int c2 = CellIndex(box.first(2), 2); c2 <= CellIndex(box.second(2), 2); c2++)
+        for (int c1 = CellIndex(box.first(1), 1); c1 <= CellIndex(box.second(1), 1); c1++)
+          for (int c0 = CellIndex(box.first(0), 0); c0 <= CellIndex(box.second(0), 0); c0++)
+            cells[c0 + numCells(0)*(c1 + numCells(1)*c2)].Append(i);
+    }
+  }
+
+  void ElementBoxIndex::GetElements (const Vec<3> & qmin, const Vec<3> & qmax, double radius, Array<int> & els) const
+  {
+    els.SetSize(0);
+    Vec<3, int> first, last;
+    for (int j = 0; j < 3; j++)
+    {
+      first(j) = CellIndex(qmin(j)-radius, j);
+      last(j) = CellIndex(qmax(j)+radius, j);
+    }
+    for (int c2 = first(2); c2 <= last(2); c2++)
+      for (int c1 = first(1); c1 <= last(1); c1++)
+        for (int c0 = first(0); c0 <= last(0); c0++)
+          for (auto el : cells[c0 + numCells(0)*(c1 + numCells(1)*c2)])
+          {
+            const auto &box = boxes[el];
+            double dist2 = 0;
+            for (int j = 0; j < 3; j++)
+            {
+              double d = max(max(box.first(j) - qmax(j), qmin(j) - box.second(j)), 0.0);
+              dist2 += d*d;
+            }
+            if (dist2 <= radius*radius)
+              els.Append(el);
+          }
+    // elements are registered in all buckets they intersect
+    QuickSort(els);
+    int cnt = 0;
+    for (auto i : Range(els))
+      if (i == 0 || els[i] != els[cnt-1])
+        els[cnt++] = els[i];
+    els.SetSize(cnt);
+  }
+
+}
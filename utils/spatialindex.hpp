@@ -0,0 +1,49 @@
+#pragma once
+
+#include <comp.hpp>
+
+namespace ngfem
+{
+  typedef pair<Vec<3>, Vec<3>> BoundingBox;
+
+  // bounding boxes of the vertices of all volume elements, unused coordinates are 0
+  vector<BoundingBox> ElementBoundingBoxes (const ngcomp::MeshAccess & ma);
+  // diameter of the union of the boxes
+  double BoxesDiameter (const vector<BoundingBox> & boxes);
+
+  // central differences for the gradient of a convolution with respect to the evaluation point:
+  // the values at the point itself (s = 0) and at the point shifted by +h resp. -h in direction l
+  // (s = 2*l+1, 2*l+2) are combined with Weight(s) into Row(s), i.e. the value and the derivatives
+  class GradientStencil
+  {
+    int dim; // 0: value only
+    double h;
+
+  public:
+    GradientStencil (int adim=0, double ah=0) : dim(adim), h(ah) {}
+    int Size () const { return 2*dim+1; }
+    int Rows () const { return dim+1; }
+    int Row (int s) const { return (s+1)/2; }
+    double Weight (int s) const { return s == 0 ? 1 : (s % 2 ? 1 : -1)/(2*h); }
+    double Shift (int s, int l) const { return s > 0 && (s-1)/2 == l ? (s % 2 ? h : -h) : 0; }
+  };
+
+  // uniform grid of buckets, each bucket holds the elements whose bounding box intersects it
+  class ElementBoxIndex
+  {
+    vector<BoundingBox> boxes;
+    Vec<3> pmin;
+    Vec<3, int> numCells;
+    double cellSize;
+    vector<Array<int>> cells;
+
+    int CellIndex (double x, int dir) const
+    { return int(min(max(floor((x-pmin(dir))/cellSize), 0.0), double(numCells(dir)-1))); }
+
+  public:
+    ElementBoxIndex (const vector<BoundingBox> & aboxes, double acellSize);
+    // all elements whose bounding box is closer than radius to the box [qmin, qmax]
+    void GetElements (const Vec<3> & qmin, const Vec<3> & qmax, double radius, Array<int> & els) const;
+  };
+
+}
@@ -4,6 +4,14 @@
 
 namespace ngfem
 {
+  // marks coefficient functions which keep values per element and IntegrationRule, they have
+  // to be evaluated on the rules of the element and not on rules of arbitrary points like
+  // the groups of located points in Compose
+  class ElementRuleCache
+  {
+  public:
+    virtual ~ElementRuleCache () { }
+  };
 
   class DummyElementTransformation : public ElementTransformation
   {
@@ -4,6 +4,7 @@ from ngsolve import *
 from netgen.meshing import Element0D, Element1D, Element2D, MeshPoint, \
                                        FaceDescriptor, Mesh as NetMesh
 from netgen.csg import Pnt
+import math
 
 xPar = ParameterLFProxy(0)
 yPar = ParameterLFProxy(1)
@@ -24,6 +25,13 @@ def posPart(x):
 def negPart(x):
     return IfPos(-x, -x, 0)
 
+def GaussianCutoff(a, tol=1e-12):
+    """
+    Radius beyond which the kernel exp(-a*r^2) drops below tol,
+    to be used as cutoff for ConvolveCF.
+    """
+    return math.sqrt(-math.log(tol)/a)
+
 def Lagrange(mesh, **args):
     """
     Create H1 finite element space with Lagrange basis.
@@ -108,6 +116,61 @@ def MakePeriodicRectangle(geo, p1, p2, bc=None, bcs=None, **args):
     geo.Append(["line", pnums[3], pnums[2]], leftdomain=0, rightdomain=1, bc=bcs[2], copy=lbot, **args)
     geo.Append(["line", pnums[0], pnums[3]], leftdomain=0, rightdomain=1, bc=bcs[3], copy=lright, **args)
 
+_eikonalSolvers = {}
+_eikonalMethods2D = ("fastmarching", "sweeping", "parallel", "update")
+
+def solve_eikonal(phi_gf, slowness_cf, method=None, refs=None):
+    """
+    Solve |grad phi| = slowness_cf with phi = 0 on the boundary by the native
+    solvers and project the nodal result onto the space of phi_gf (e.g. the L2
+    space of the Hughes models). Meshes of dimension 1 use SolveEikonal1D,
+    triangle meshes EikonalSolver2D and tetrahedral meshes EikonalSolver3D.
+    On triangle meshes method is 'fastmarching' (default), 'sweeping' or
+    'parallel' as in EikonalSolver2D.Solve, or 'update' to warm start from the
+    previous solution on the same space; the other meshes have a single method.
+    refs are the reference points ordering the sweeps, by default the corners
+    of the bounding box of the mesh. The 2D/3D solvers are kept per space and refs.
+    """
+    fes = phi_gf.space
+    mesh = fes.mesh
+    if mesh.dim == 2:
+        if method is None:
+            method = "fastmarching"
+        if method not in _eikonalMethods2D:
+            raise ValueError("unknown method '{}', use one of {}".format(method, ", ".join(_eikonalMethods2D)))
+    elif method is not None:
+        raise ValueError("method is only supported on triangle meshes")
+    elif refs is not None:
+        raise ValueError("refs are only supported on triangle meshes")
+
+    if mesh.dim == 1:
+        SolveEikonal1D(slowness_cf, phi_gf)
+        return phi_gf
+
+    key = (id(fes), None if refs is None else tuple(tuple(r) for r in refs))
+    if key not in _eikonalSolvers:
+        if mesh.dim == 2:
+            if refs is None:
+                pnts = [v.point for v in mesh.vertices]
+                xs = [p[0] for p in pnts]
+                ys = [p[1] for p in pnts]
+                refs = [(x, y) for x in (min(xs), max(xs)) for y in (min(ys), max(ys))]
+            solver = EikonalSolver2D(fes, refs)
+        else:
+            solver = EikonalSolver3D(fes)
+        # keep fes alive, such that its id is not reused
+        _eikonalSolvers[key] = (fes, solver)
+    solver = _eikonalSolvers[key][1]
+
+    if method == "update":
+        solver.Update(slowness_cf)
+    elif method is not None:
+        solver.Solve(slowness_cf, method=method)
+    else:
+        solver.Solve(slowness_cf)
+    phi_gf.Set(solver.GetSolutionGF())
+    return phi_gf
+
 class ConvolutionCache:
     def __init__(self, conv):
         self.conv = conv
@@ -5,6 +5,8 @@
 #include "randomcf.hpp"
 #include "composecf.hpp"
 #include "convolutioncf.hpp"
+#include "fftconvolvecf.hpp"
+#include "separablekernel.hpp"
 #include "parameterlf.hpp"
 #include "cachecf.hpp"
 #include "zlogzcf.hpp"
@@ -57,6 +59,24 @@ PyCF MakeCoefficient (py::object val)
   throw Exception ("cannot make coefficient");
 }
 
+bool IsSinglePrecision (const string & precision)
+{
+  if (precision == "float32") return true;
+  if (precision == "float64") return false;
+  throw Exception("precision has to be \"float32\" or \"float64\"");
+}
+
+py::dict LUTStatistics (const LUTBudget & budget)
+{
+  py::dict res;
+  res["hits"] = py::cast(budget.Hits());
+  res["misses"] = py::cast(budget.Misses());
+  res["evictions"] = py::cast(budget.Evictions());
+  res["resident_bytes"] = py::cast(budget.ResidentBytes());
+  res["max_bytes"] = py::cast(budget.GetMaxBytes());
+  return res;
+}
+
 void ExportNgsAppsUtils(py::module &m)
 {
   cout << "exporting ngsapps.utils"  << endl;
@@ -114,6 +134,28 @@ void ExportNgsAppsUtils(py::module &m)
           py::arg("innercf"), py::arg("outercf"), py::arg("mesh")
       );
 
+  typedef shared_ptr<ComposeOperator> PyComposeOperator;
+  py::class_<ComposeOperator, PyComposeOperator, ngla::BaseMatrix>
+    (m, "ComposeOperator",
+     "interpolation of the scalar FESpace fes in the points inner(x), where x are the points of the\n"
+     "IntegrationRules of the given order on all elements, as a sparse matrix from the dofs to the values\n"
+     "in these points (one row per point, ordered by element)\n"
+     "the points are located once, so inner must not change, e.g. a translation (x, y-yoffset)\n"
+     "op(gf) is the composition of gf after inner, evaluated by a sparse matrix-vector product on these rules")
+    .def ("__init__",
+          [] (ComposeOperator *instance, py::object inner, PyFES fes, int order)
+          {
+            new (instance) ComposeOperator(MakeCoefficient(inner), fes, order);
+          },
+          py::arg("inner"), py::arg("fes"), py::arg("order")
+      )
+    .def("__call__", [](PyComposeOperator & self, shared_ptr<ngcomp::GridFunction> gf) -> PyCF
+         {
+           return make_shared<ComposedGridFunctionCF>(self, gf);
+         },
+         py::arg("gf"))
+    ;
+
   typedef shared_ptr<ParameterLFProxy> PyParameterLFProxy;
   py::class_<ParameterLFProxy, PyParameterLFProxy, CoefficientFunction>
     (m, "ParameterLFProxy", "xPar, yPar, zPar coordinates for ParameterLF")
@@ -141,43 +183,235 @@ void ExportNgsAppsUtils(py::module &m)
       "Parameterized LinearForm\n"
       "This coefficient function calculates the value of the parameterized integral\n"
       "I(xPar, yPar, zPar) = \\int integrand(x, y, z, xPar, yPar, zPar) d(x, y, z)\n"
-      "gf is a GridFunction\n"
+      "gf is a GridFunction or a list of GridFunctions of the same FESpace\n"
       "integrand is a CoefficientFunction which linearly contains a TestFunction from the FESpace to which gf belongs.\n"
-      "When calculating the integral, the test function is then replaced by gf.")
+      "When calculating the integral, the test function is then replaced by gf.\n"
+      "For a list of GridFunctions, the result is vector-valued with one component per GridFunction,\n"
+      "all components are computed from the same lookup tables at once.\n"
+      "sparse=True stores only the nonzero entries of the lookup tables. With support > 0, elements farther than\n"
+      "support from the parameter point (in the x-y plane) are skipped, which is only correct if the integrand\n"
+      "vanishes there, e.g. for a product with CompactlySupportedKernel(support, ...) but not for 1+K.\n"
+      "If cachedir is given, lookup tables saved by SaveLUT() for the same mesh, order, integrand and FESpace\n"
+      "are memory mapped from there instead of being computed again.\n"
+      "precision=\"float32\" stores the lookup tables in single precision, the sums are still computed in double.\n"
+      "For periodic problems, repeat > 0 adds the integrand shifted by up to repeat times patchSize in each direction,\n"
+      "minimage=True instead evaluates it once at the periodic image (period patchSize, 0 for axes which are not periodic)\n"
+      "closest to the parameter point, which is exact if the support of the kernel is at most half of patchSize.\n"
+      "gradient=True returns the value and the gradient with respect to (xPar, yPar, zPar) for each GridFunction,\n"
+      "e.g. (I, dI/dxPar, dI/dyPar) in 2D, computed by central differences within the same lookup tables.")
     .def ("__init__",
-          [] (ParameterLinearFormCF *instance, py::object integrand, shared_ptr<ngcomp::GridFunction> gf, int order, int repeat, vector<double> patchSize)
+          [] (ParameterLinearFormCF *instance, py::object integrand, py::object gf, int order, int repeat, vector<double> patchSize, bool sparse, string cachedir, string precision, bool minimage, bool gradient, double support)
           {
-            new (instance) ParameterLinearFormCF(MakeCoefficient(integrand), gf, order, repeat, patchSize);
+            vector<shared_ptr<ngcomp::GridFunction>> gfs;
+            if (py::isinstance<py::list>(gf) || py::isinstance<py::tuple>(gf))
+              for (auto item : gf)
+                gfs.push_back(item.cast<shared_ptr<ngcomp::GridFunction>>());
+            else
+              gfs.push_back(gf.cast<shared_ptr<ngcomp::GridFunction>>());
+            new (instance) ParameterLinearFormCF(MakeCoefficient(integrand), gfs, order, repeat, patchSize, sparse, cachedir,
+                                                 IsSinglePrecision(precision), minimage, gradient, support);
           },
-          py::arg("integrand"), py::arg("gf"), py::arg("order")=5, py::arg("repeat")=0, py::arg("patchSize")=vector<int>()
+          py::arg("integrand"), py::arg("gf"), py::arg("order")=5, py::arg("repeat")=0, py::arg("patchSize")=vector<int>(),
+          py::arg("sparse")=false, py::arg("cachedir")="", py::arg("precision")="float64", py::arg("minimage")=false,
+          py::arg("gradient")=false, py::arg("support")=0.0
       )
+    .def("Compress", [](PyParameterLF & self, int order, double eps, double eta, int leafsize)
+         {
+           self->Compress(order, eps, eta, leafsize);
+           auto hmatrix = self->GetHMatrix();
+           py::dict res;
+           res["height"] = py::cast(hmatrix->Height());
+           res["width"] = py::cast(hmatrix->Width());
+           res["blocks"] = py::cast(hmatrix->NumBlocks());
+           res["lowrank_blocks"] = py::cast(hmatrix->NumLowRankBlocks());
+           res["bytes"] = py::cast(hmatrix->MemoryUsage());
+           return res;
+         },
+         "compress the lookup tables for IntegrationRules of the given order into a hierarchical matrix\n"
+         "returns a dict with the size, the number of (low-rank) blocks and the memory usage in bytes\n"
+         "(cluster tree over the elements, admissible blocks approximated by ACA up to the relative tolerance eps)\n"
+         "order has to match the rules used in Evaluate, e.g. 2*order of the FESpace for GridFunction.Set\n"
+         "a change of gf is applied on the next use, Update() applies it immediately",
+         py::arg("order"), py::arg("eps")=1e-6, py::arg("eta")=1.0, py::arg("leafsize")=32)
+    .def("Update", [](PyParameterLF & self)
+         {
+           self->Update();
+         },
+         "recompute the compressed convolution resp. the changes in incremental mode for the current gf")
+    .def("Operator", [](PyParameterLF & self, int order) -> shared_ptr<ngla::BaseMatrix>
+         {
+           return make_shared<ParameterLFOperator>(self, order);
+         },
+         "the convolution as a matrix acting on coefficient vectors of the FESpace of gf:\n"
+         "y_i = \\int phi_i I dx, where gf is replaced by x in I and phi_i are the test functions of the FESpace,\n"
+         "integrated with rules of the given order, e.g. to treat the convolution implicitly in Krylov solvers,\n"
+         "it uses the lookup tables (built on first use, see Prebuild) or the compressed ones for the same order",
+         py::arg("order"))
+    .def("SetIncremental", [](PyParameterLF & self, double tol)
+         {
+           self->SetIncremental(tol);
+         },
+         "incremental mode: the convolution is only updated with the dofs of gf which changed by more than tol\n"
+         "(smaller changes are accumulated until they exceed tol), the results of the last evaluation\n"
+         "of each element are kept and updated when gf changed (see Update)\n"
+         "tol < 0 switches incremental mode off",
+         py::arg("tol")=0.0)
+    .def("Prebuild", [](PyParameterLF & self, int order, VorB vb, bool simd)
+         {
+           self->Prebuild(order, vb, simd);
+         },
+         "build the lookup tables for IntegrationRules of the given order on all elements in parallel,\n"
+         "afterwards Evaluate only looks up the tables (building them in Evaluate is serial)\n"
+         "order has to match the rules used in Evaluate, e.g. 2*order of the FESpace for GridFunction.Set\n"
+         "simd=True builds the tables for SIMD evaluation (e.g. in SymbolicLFI) instead",
+         py::arg("order"), py::arg("vb")=VOL, py::arg("simd")=false)
+    .def("SetLUTBudget", [](PyParameterLF & self, size_t maxbytes)
+         {
+           self->SetMaxLUTBytes(maxbytes);
+         },
+         "limit the memory of the lookup tables to maxbytes (0: unlimited), the least recently used\n"
+         "tables of an element are freed when a new table exceeds the budget",
+         py::arg("maxbytes"))
+    .def("LUTStatistics", [](PyParameterLF & self)
+         {
+           return LUTStatistics(self->GetBudget());
+         },
+         "dict with the number of lookup table hits, misses (tables built), evictions and resident bytes")
+    .def("SaveLUT", [](PyParameterLF & self)
+         {
+           self->SaveLUT();
+         },
+         "write the lookup tables built so far to cachedir (compressed tables are not saved)")
     ;
 
   typedef shared_ptr<ConvolutionCoefficientFunction> PyConvolveCF;
   py::class_<ConvolutionCoefficientFunction, PyConvolveCF, CoefficientFunction>
     (m, "ConvolveCF",
       "convolution of a general coefficient function with a coefficient function representing a kernel\n"
-      "to calculate repeated convolutions of GridFunctions, use ParameterLF")
+      "to calculate repeated convolutions of GridFunctions, use ParameterLF\n"
+      "if cutoff > 0, only elements closer than cutoff to the evaluation point are taken into account\n"
+      "(the support radius of the kernel, or e.g. GaussianCutoff(a, tol) for exp(-a*r^2))\n"
+      "a SeparableKernel is convolved with two 1D passes instead of the kernel lookup tables only in the cases\n"
+      "listed in its docstring (no cutoff, cached cf on a tensor product grid); ParameterLF doesn't use this\n"
+      "if cachedir is given, kernel lookup tables saved by SaveLUT() for the same mesh, order, cutoff and kernel\n"
+      "are memory mapped from there instead of being computed again\n"
+      "precision=\"float32\" stores the kernel lookup tables in single precision, the sums are still computed in double\n"
+      "gradient=True returns the value and the gradient of the convolution, e.g. (u, du/dx, du/dy) in 2D,\n"
+      "computed by central differences within the same kernel lookup tables (scalar cf only)")
     .def ("__init__",
-          [] (ConvolutionCoefficientFunction *instance, py::object cf, py::object kernel, shared_ptr<ngcomp::MeshAccess> ma, int order)
+          [] (ConvolutionCoefficientFunction *instance, py::object cf, py::object kernel, shared_ptr<ngcomp::MeshAccess> ma, int order, double cutoff, string cachedir, string precision, bool gradient)
           {
-            new (instance) ConvolutionCoefficientFunction(MakeCoefficient(cf), MakeCoefficient(kernel), ma, order);
+            new (instance) ConvolutionCoefficientFunction(MakeCoefficient(cf), MakeCoefficient(kernel), ma, order, cutoff, cachedir,
+                                                          IsSinglePrecision(precision), gradient);
           },
-          py::arg("cf"), py::arg("kernel"), py::arg("mesh"), py::arg("order")=5
+          py::arg("cf"), py::arg("kernel"), py::arg("mesh"), py::arg("order")=5, py::arg("cutoff")=0,
+          py::arg("cachedir")="", py::arg("precision")="float64", py::arg("gradient")=false
       )
     .def("CacheCF", [](PyConvolveCF & self)
          {
            self->CacheCF();
-         })
+         },
+         "evaluate cf once on all elements and use these values until ClearCFCache(),\n"
+         "they are recomputed on the next use after a GridFunction in cf changed (see GridFunctionModified)")
     .def("ClearCFCache", [](PyConvolveCF & self)
          {
            self->ClearCFCache();
          })
+    .def("Prebuild", [](PyConvolveCF & self, int order, VorB vb, bool simd)
+         {
+           self->Prebuild(order, vb, simd);
+         },
+         "build the kernel lookup tables for IntegrationRules of the given order on all elements in parallel,\n"
+         "afterwards Evaluate only looks up the tables (building them in Evaluate is serial)\n"
+         "simd=True builds the tables for SIMD evaluation instead",
+         py::arg("order"), py::arg("vb")=VOL, py::arg("simd")=false)
+    .def("SetLUTBudget", [](PyConvolveCF & self, size_t maxbytes)
+         {
+           self->SetMaxLUTBytes(maxbytes);
+         },
+         "limit the memory of the lookup tables to maxbytes (0: unlimited), the least recently used\n"
+         "tables of an element are freed when a new table exceeds the budget",
+         py::arg("maxbytes"))
+    .def("LUTStatistics", [](PyConvolveCF & self)
+         {
+           return LUTStatistics(self->GetBudget());
+         },
+         "dict with the number of lookup table hits, misses (tables built), evictions and resident bytes")
+    .def("SaveLUT", [](PyConvolveCF & self)
+         {
+           self->SaveLUT();
+         },
+         "write the kernel lookup tables built so far to cachedir")
+    ;
+
+  typedef shared_ptr<SeparableKernelCoefficientFunction> PySeparableKernel;
+  py::class_<SeparableKernelCoefficientFunction, PySeparableKernel, CoefficientFunction>
+    (m, "SeparableKernel",
+      "kernel kx*ky, where kx only depends on x and ky only on y, e.g.\n"
+      "SeparableKernel(exp(-a*x*x), exp(-a*y*y)) for the Gaussian exp(-a*(x*x+y*y))\n"
+      "it evaluates like kx*ky, so it can be used with ParameterLF as well (with x-xPar and y-yPar),\n"
+      "but only ConvolveCF makes use of the factorization: it computes the convolution with two 1D passes\n"
+      "instead of the kernel lookup tables, evaluating the factors at the offsets (x-x', 0) and (0, y-y'),\n"
+      "if all of the following hold, otherwise it uses the kernel lookup tables as for any other kernel:\n"
+      "- the mesh is 2D and cf is scalar\n"
+      "- the integration points of all elements form a tensor product grid (e.g. GenerateGridMesh)\n"
+      "- cutoff is 0 (the cutoff by element distance doesn't factor into the two passes)\n"
+      "- cf is cached, i.e. between CacheCF() and ClearCFCache()\n"
+      "both ways give the same result up to rounding")
+    .def ("__init__",
+          [] (SeparableKernelCoefficientFunction *instance, py::object kx, py::object ky)
+          {
+            new (instance) SeparableKernelCoefficientFunction(MakeCoefficient(kx), MakeCoefficient(ky));
+          },
+          py::arg("kx"), py::arg("ky")
+      )
+    ;
+
+  m.def("GridFunctionModified", [](py::object gf)
+        {
+          if (py::isinstance<py::list>(gf) || py::isinstance<py::tuple>(gf))
+            for (auto item : gf)
+              GridFunctionModified(*item.cast<shared_ptr<ngcomp::GridFunction>>());
+          else
+            GridFunctionModified(*gf.cast<shared_ptr<ngcomp::GridFunction>>());
+        },
+        "announce that the coefficients of gf (or of a list of GridFunctions) were changed\n"
+        "ParameterLF, ConvolveCF, FFTConvolve and Cache detect changes of the GridFunctions they depend on\n"
+        "by comparing the coefficients with a copy before cached values are used; this optional fast path\n"
+        "replaces the comparison for gf: from the first call on, changes of gf have to be announced",
+        py::arg("gf"));
+
+  typedef shared_ptr<FFTConvolutionCoefficientFunction> PyFFTConvolveCF;
+  py::class_<FFTConvolutionCoefficientFunction, PyFFTConvolveCF, CoefficientFunction>
+    (m, "FFTConvolve",
+      "convolution of a scalar GridFunction with a translation invariant kernel using the FFT\n"
+      "gf is sampled in the cell centers of a uniform grid of shape grid_shape covering the bounding box of the mesh\n"
+      "the kernel is evaluated at the offset x-y, i.e. it should be a function of x, y, z only\n"
+      "periodic=True treats the bounding box as one period (minimum image convention for the kernel),\n"
+      "otherwise gf is extended by zero\n"
+      "the convolution is recomputed on the next use after gf changed, Update() recomputes it immediately")
+    .def ("__init__",
+          [] (FFTConvolutionCoefficientFunction *instance, py::object kernel, shared_ptr<ngcomp::GridFunction> gf, vector<int> grid_shape, bool periodic)
+          {
+            new (instance) FFTConvolutionCoefficientFunction(MakeCoefficient(kernel), gf, grid_shape, periodic);
+          },
+          py::arg("kernel"), py::arg("gf"), py::arg("grid_shape"), py::arg("periodic")=false
+      )
+    .def("Update", [](PyFFTConvolveCF & self)
+         {
+           self->Update();
+         },
+         "resample gf and recompute the convolution")
     ;
 
   typedef shared_ptr<CacheCoefficientFunction> PyCacheCF;
   py::class_<CacheCoefficientFunction, PyCacheCF, CoefficientFunction>
-    (m, "Cache", "cache results of a coefficient function")
+    (m, "Cache",
+      "cache results of a coefficient function\n"
+      "values are stored per volume element and IntegrationRule (identified by its points), single points\n"
+      "are only taken from the cache if the rule they belong to has been evaluated before\n"
+      "Invalidate() marks all values as outdated, Refresh() recomputes all of them\n"
+      "the values are invalidated on the next use after a GridFunction in cf changed (see GridFunctionModified)")
     .def ("__init__",
           [] (CacheCoefficientFunction *instance, py::object c, shared_ptr<ngcomp::MeshAccess> ma)
           {
@@ -193,6 +427,11 @@ void ExportNgsAppsUtils(py::module &m)
          {
            self->Refresh();
          })
+    .def("Update", [](PyCacheCF & self)
+         {
+           self->Update();
+         },
+         "invalidate the values after the GridFunctions in cf have changed")
     ;
 
   using namespace ngcomp;
@@ -266,8 +505,52 @@ void ExportNgsAppsUtils(py::module &m)
                     for (auto r : refs) nrefs.emplace_back(r.cast<py::tuple>()[0].cast<double>(), r.cast<py::tuple>()[1].cast<double>());
                     new (instance) EikonalSolver2D(fes, nrefs);
                   })
-    .def("Solve", &EikonalSolver2D::solve)
+    .def("Solve", [] (EikonalSolver2D &self, shared_ptr<CoefficientFunction> rhs, string method)
+         {
+           if (method == "sweeping")
+             self.solve(rhs);
+           else if (method == "parallel")
+             self.solveParallel(rhs);
+           else if (method == "fastmarching")
+             self.solveFastMarching(rhs);
+           else
+             throw Exception("EikonalSolver2D: unknown method " + method + ", use sweeping, parallel or fastmarching");
+         },
+         "solve |grad u| = rhs with u = 0 on the boundary at the vertices of the mesh\n"
+         "method='sweeping': Gauss-Seidel sweeps ordered by the distance to the reference points until convergence\n"
+         "method='parallel': the sweeps of all orderings run in parallel on private copies combined by their minimum\n"
+         "method='fastmarching': single pass in the order of the values using a binary heap",
+         py::arg("rhs"), py::arg("method")="sweeping")
+    .def("Update", [] (EikonalSolver2D &self, shared_ptr<CoefficientFunction> rhs, py::object changed)
+         {
+           if (changed.is_none())
+             self.update(rhs);
+           else
+           {
+             vector<int> verts;
+             for (auto v : changed.cast<py::list>())
+             {
+               int vert = v.cast<int>();
+               if (vert < 0 || vert >= self.getNV())
+                 throw Exception("EikonalSolver2D.Update: vertex " + to_string(vert) + " is not in the mesh");
+               verts.push_back(vert);
+             }
+             self.update(rhs, verts);
+           }
+         },
+         "warm start from the current solution after rhs changed at the vertices in the list changed\n"
+         "(changed=None compares the rhs at all vertices): the solution is only recomputed at these vertices\n"
+         "and the ones depending on them, before the first solve this is a full fast marching solve",
+         py::arg("rhs"), py::arg("changed")=py::none())
     .def("GetSolutionGF", &EikonalSolver2D::getSolutionGF);
+  py::class_<EikonalSolver3D, shared_ptr<EikonalSolver3D>>
+    (m, "EikonalSolver3D", "solver for |grad u| = rhs with u = 0 on the boundary at the vertices of a tetrahedral mesh")
+    .def("__init__", [] (EikonalSolver3D *instance, shared_ptr<FESpace> fes)
+                  {
+                    new (instance) EikonalSolver3D(fes);
+                  })
+    .def("Solve", &EikonalSolver3D::solve)
+    .def("GetSolutionGF", &EikonalSolver3D::getSolutionGF);
 }
 
 PYBIND11_PLUGIN(libngsapps_utils)